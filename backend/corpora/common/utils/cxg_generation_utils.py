@@ -2,12 +2,23 @@ import json
 
 import numpy as np
 import tiledb
+from scipy import sparse
 
 from backend.corpora.common.utils.type_conversion_utils import (
     get_encoding_dtype_of_array,
     get_dtype_and_schema_of_array,
 )
 
+# The maximum number of nonzero values of a matrix written to a sparse CXG array at once. Each one is buffered as its
+# coordinates and value, so that a write buffers a few hundred MB at most.
+SPARSE_MATRIX_WRITE_MAX_NNZ = 2**24
+# The approximate memory used by each nonzero value of a block of rows written to a sparse CXG array: its column index
+# and value as read, its row index, and their copies once the explicitly stored zeros are dropped
+SPARSE_MATRIX_BYTES_PER_NNZ = 32
+# The approximate memory used by each element of a block of rows written to a dense CXG array: a float64 block and its
+# float32 copy
+DENSE_MATRIX_BYTES_PER_ELEMENT = 12
+
 
 def convert_dictionary_to_cxg_group(cxg_container, metadata_dict, group_metadata_name="cxg_group_metadata", ctx=None):
     """
@@ -113,12 +124,20 @@ def convert_ndarray_to_cxg_dense_array(ndarray_name, ndarray, ctx):
     tiledb.consolidate(ndarray_name, ctx=ctx)
 
 
-def convert_matrix_to_cxg_array(matrix_name, matrix, encode_as_sparse_array, ctx):
+def convert_matrix_to_cxg_array(matrix_name, matrix, encode_as_sparse_array, ctx, memory_budget_bytes=None):
     """
     Converts a numpy array matrix into a TileDB SparseArray of DenseArray based on whether `encode_as_sparse_array`
     is true or not. Note that when the matrix is encoded as a SparseArray, it only writes the values that are
     nonzero. This means that if you count the number of elements in the SparseArray, it will not equal the total
     number of elements in the matrix, only the number of nonzero elements.
+
+    The matrix is written in blocks of rows. A scipy sparse matrix is only densified, one block at a time, when it is
+    encoded as a DenseArray: when it is encoded as a SparseArray, the coordinates of its nonzero values are taken from
+    its CSR structure, and the blocks of a CSR matrix are sized by their number of nonzero values.
+
+    The matrix may also be the X of an anndata read in backed mode, in which case only a block of rows is read from
+    the H5AD file at a time. If `memory_budget_bytes` is given, the blocks are sized so that each one takes about that
+    much memory at most.
     """
 
     def create_matrix_array(matrix_name, number_of_rows, number_of_columns, encode_as_sparse_array, compression=22):
@@ -151,21 +170,60 @@ def convert_matrix_to_cxg_array(matrix_name, matrix, encode_as_sparse_array, ctx
         )
         tiledb.Array.create(matrix_name, schema)
 
+    def get_indptr():
+        if sparse.isspmatrix_csr(matrix):
+            return matrix.indptr
+        if getattr(matrix, "format_str", None) == "csr":
+            # the sparse matrix of an anndata read in backed mode
+            return matrix.group["indptr"][:]
+        return None
+
+    def row_blocks(stride):
+        indptr = get_indptr() if encode_as_sparse_array else None
+        if indptr is not None:
+            # as many rows as max_nnz nonzero values allow, and at least one
+            max_nnz = (
+                SPARSE_MATRIX_WRITE_MAX_NNZ
+                if memory_budget_bytes is None
+                else max(memory_budget_bytes // SPARSE_MATRIX_BYTES_PER_NNZ, 1)
+            )
+            start_row_index = 0
+            while start_row_index < number_of_rows:
+                end_row_index = np.searchsorted(indptr, indptr[start_row_index] + max_nnz, side="right")
+                end_row_index = min(max(end_row_index - 1, start_row_index + 1), number_of_rows)
+                yield start_row_index, end_row_index
+                start_row_index = end_row_index
+        else:
+            for start_row_index in range(0, number_of_rows, stride):
+                yield start_row_index, min(start_row_index + stride, number_of_rows)
+
+    def nonzero_coordinates(matrix_subset):
+        if isinstance(matrix_subset, np.ndarray):
+            rows, columns = np.nonzero(matrix_subset)
+            return rows, columns, matrix_subset[rows, columns]
+        matrix_subset = sparse.csr_matrix(matrix_subset)
+        rows = np.repeat(np.arange(matrix_subset.shape[0], dtype=np.uint32), np.diff(matrix_subset.indptr))
+        # explicitly stored zeros are not written
+        nonzero = matrix_subset.data != 0
+        return rows[nonzero], matrix_subset.indices[nonzero], matrix_subset.data[nonzero]
+
     number_of_rows = matrix.shape[0]
     number_of_columns = matrix.shape[1]
-    stride = min(int(np.power(10, np.around(np.log10(1e9 / number_of_columns)))), 10_000)
+    if memory_budget_bytes is None:
+        stride = min(int(np.power(10, np.around(np.log10(1e9 / number_of_columns)))), 10_000)
+    else:
+        stride = max(memory_budget_bytes // (number_of_columns * DENSE_MATRIX_BYTES_PER_ELEMENT), 1)
 
     create_matrix_array(matrix_name, number_of_rows, number_of_columns, encode_as_sparse_array)
 
     with tiledb.open(matrix_name, mode="w", ctx=ctx) as array:
-        for start_row_index in range(0, number_of_rows, stride):
-            end_row_index = min(start_row_index + stride, number_of_rows)
+        for start_row_index, end_row_index in row_blocks(stride):
             matrix_subset = matrix[start_row_index:end_row_index, :]
-            if not isinstance(matrix_subset, np.ndarray):
-                matrix_subset = matrix_subset.toarray()
             if encode_as_sparse_array:
-                indices = np.nonzero(matrix_subset)
-                trow = indices[0] + start_row_index
-                array[trow, indices[1]] = matrix_subset[indices[0], indices[1]]
+                rows, columns, values = nonzero_coordinates(matrix_subset)
+                if len(values) > 0:
+                    array[rows + start_row_index, columns] = values
             else:
+                if not isinstance(matrix_subset, np.ndarray):
+                    matrix_subset = matrix_subset.toarray()
                 array[start_row_index:end_row_index, :] = matrix_subset
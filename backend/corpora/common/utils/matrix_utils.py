@@ -1,14 +1,21 @@
 import logging
+from typing import Optional, Tuple
 
 import numpy as np
+from scipy import sparse
+
+# The sparsity of a matrix whose number of non-zero elements is not known from its structure is estimated from at most
+# this many rows, read in evenly spread blocks
+SPARSITY_SAMPLE_ROWS = 10_000
+SPARSITY_SAMPLE_BLOCKS = 10
 
 
 def is_matrix_sparse(matrix: np.ndarray, sparse_threshold):
     """
     Returns whether `matrix` is sparse or not (i.e. dense). This is determined by figuring out whether the matrix has
-    a sparsity percentage below the sparse_threshold, returning the number of non-zeros encountered and number of
-    elements evaluated.  This function may return before evaluating the whole matrix if it can be determined that matrix
-    is not sparse enough.
+    a sparsity percentage below the sparse_threshold. The number of non-zero elements of a sparse matrix is taken from
+    its structure (see get_structural_number_of_non_zero_elements), without reading its values. Otherwise it is
+    estimated from a sample of the matrix's rows, so that only the conversion of the matrix reads all of it.
     """
 
     if sparse_threshold == 100.0:
@@ -16,44 +23,70 @@ def is_matrix_sparse(matrix: np.ndarray, sparse_threshold):
     if sparse_threshold == 0.0:
         return False
 
-    total_number_of_rows = matrix.shape[0]
     total_number_of_columns = matrix.shape[1]
-    total_number_of_matrix_elements = total_number_of_rows * total_number_of_columns
 
-    # For efficiency, we count the number of non-zero elements in chunks of the matrix at a time until we hit the
-    # maximum number of non zero values allowed before the matrix is deemed "dense." This allows the function the
-    # quit early for large dense matrices.
-    row_stride = min(int(np.power(10, np.around(np.log10(1e9 / total_number_of_columns)))), 10_000)
+    number_of_non_zero_elements = get_structural_number_of_non_zero_elements(matrix)
+    if number_of_non_zero_elements is not None:
+        number_of_evaluated_rows, evaluation = matrix.shape[0], "structural"
+    else:
+        number_of_non_zero_elements, number_of_evaluated_rows = sample_number_of_non_zero_elements(matrix)
+        evaluation = "exact" if number_of_evaluated_rows == matrix.shape[0] else "estimate"
 
-    maximum_number_of_non_zero_elements_in_matrix = int(
-        total_number_of_rows * total_number_of_columns * sparse_threshold / 100
+    percentage_of_non_zero_elements = (
+        100.0 * number_of_non_zero_elements / max(number_of_evaluated_rows * total_number_of_columns, 1)
+    )
+    is_sparse = percentage_of_non_zero_elements < sparse_threshold
+    logging.info(
+        f"Matrix is {'' if is_sparse else 'not '}sparse. Percentage of non-zero elements ({evaluation}): "
+        f"{percentage_of_non_zero_elements:6.2f}"
     )
+    return is_sparse
+
+
+def get_structural_number_of_non_zero_elements(matrix) -> Optional[int]:
+    """
+    Returns the number of elements stored by a sparse `matrix`, in O(1): the nnz of a scipy sparse matrix, or the last
+    value of the indptr of the sparse matrix of an anndata read in backed mode. Returns None for any other matrix.
+    Explicitly stored zeros are counted as non-zero elements.
+    """
+    if sparse.issparse(matrix):
+        return matrix.nnz
+    group = getattr(matrix, "group", None)
+    if group is not None and "indptr" in group:
+        return int(group["indptr"][-1])
+    return None
+
+
+def sample_number_of_non_zero_elements(matrix) -> Tuple[int, int]:
+    """
+    Counts the non-zero elements of at most SPARSITY_SAMPLE_ROWS rows of `matrix`, in SPARSITY_SAMPLE_BLOCKS evenly
+    spread blocks of rows. Returns the number of non-zero elements and the number of rows they were counted in.
+    """
+    total_number_of_rows = matrix.shape[0]
+    if total_number_of_rows <= SPARSITY_SAMPLE_ROWS:
+        sample_blocks = [(0, total_number_of_rows)]
+    else:
+        block_number_of_rows = SPARSITY_SAMPLE_ROWS // SPARSITY_SAMPLE_BLOCKS
+        sample_blocks = [
+            (start_row_index, start_row_index + block_number_of_rows)
+            for start_row_index in np.linspace(
+                0, total_number_of_rows - block_number_of_rows, SPARSITY_SAMPLE_BLOCKS, dtype=int
+            )
+        ]
+
+    # Dense subsets are bounded to ~1e9 elements
+    row_stride = min(int(np.power(10, np.around(np.log10(1e9 / matrix.shape[1])))), 10_000)
+
     number_of_non_zero_elements = 0
+    number_of_evaluated_rows = 0
+    for sample_start_row_index, sample_end_row_index in sample_blocks:
+        for start_row_index in range(sample_start_row_index, sample_end_row_index, row_stride):
+            end_row_index = min(start_row_index + row_stride, sample_end_row_index)
 
-    for start_row_index in range(0, total_number_of_rows, row_stride):
-        end_row_index = min(start_row_index + row_stride, total_number_of_rows)
-
-        matrix_subset = matrix[start_row_index:end_row_index, :]
-        if not isinstance(matrix_subset, np.ndarray):
-            matrix_subset = matrix_subset.toarray()
-
-        number_of_non_zero_elements += np.count_nonzero(matrix_subset)
-        if number_of_non_zero_elements > maximum_number_of_non_zero_elements_in_matrix:
-            if end_row_index != total_number_of_rows:
-                percentage_of_non_zero_elements = (
-                    100 * number_of_non_zero_elements / (end_row_index * total_number_of_columns)
-                )
-                logging.info(
-                    f"Matrix is not sparse. Percentage of non-zero elements (estimate): "
-                    f"{percentage_of_non_zero_elements:6.2f}"
-                )
-            else:
-                percentage_of_non_zero_elements = 100 * number_of_non_zero_elements / total_number_of_matrix_elements
-                logging.info(
-                    f"Matrix is not sparse. Percentage of non-zero elements (exact): "
-                    f"{percentage_of_non_zero_elements:6.2f}"
-                )
-            return False
-
-    is_sparse = (100.0 * number_of_non_zero_elements / total_number_of_matrix_elements) < sparse_threshold
-    return is_sparse
+            matrix_subset = matrix[start_row_index:end_row_index, :]
+            if not isinstance(matrix_subset, np.ndarray):
+                matrix_subset = matrix_subset.toarray()
+
+            number_of_non_zero_elements += np.count_nonzero(matrix_subset)
+            number_of_evaluated_rows += end_row_index - start_row_index
+    return number_of_non_zero_elements, number_of_evaluated_rows
@@ -2,6 +2,10 @@ import os
 
 import boto3
 
+# Size of the connection pool of the portal client, which is shared by concurrent transfers: the upload tasks of
+# s3_upload.upload_directory (UPLOAD_THREADS) each make up to UPLOAD_TRANSFER_CONFIG.max_request_concurrency requests
+PORTAL_CLIENT_MAX_POOL_CONNECTIONS = 64
+
 
 class _Buckets:
     _portal_resource = None
@@ -22,7 +26,9 @@ class _Buckets:
             self._portal_client = boto3.client(
                 "s3",
                 endpoint_url=os.getenv("BOTO_ENDPOINT_URL") or None,
-                config=boto3.session.Config(signature_version="s3v4"),
+                config=boto3.session.Config(
+                    signature_version="s3v4", max_pool_connections=PORTAL_CLIENT_MAX_POOL_CONNECTIONS
+                ),
             )
         return self._portal_client
 
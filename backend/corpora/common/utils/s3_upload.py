@@ -0,0 +1,215 @@
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from boto3.s3.transfer import TransferConfig
+
+from backend.corpora.common.utils.math_utils import MB
+from backend.corpora.common.utils.s3_buckets import buckets
+
+logger = logging.getLogger(__name__)
+
+# Number of concurrent upload tasks, each one uploading a large file or a batch of small files. The connection pool of
+# the portal client is sized for these tasks (see s3_buckets.PORTAL_CLIENT_MAX_POOL_CONNECTIONS)
+UPLOAD_THREADS = 16
+
+# Files of at least multipart_threshold bytes are uploaded by concurrent multipart uploads of their parts
+UPLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * MB, multipart_chunksize=64 * MB, max_concurrency=4)
+
+# Smaller files are uploaded by a single PUT each, in batches of at most this many bytes per upload task, as TileDB
+# arrays consist of many small files
+SMALL_FILES_BATCH_BYTES = 64 * MB
+
+# Number of attempts to upload a file, with exponential backoff between attempts
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY_SECONDS = 5
+
+
+@dataclass
+class UploadStats:
+    uploaded_files: int = 0
+    uploaded_bytes: int = 0
+    skipped_files: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput_mb_per_second(self) -> float:
+        return self.uploaded_bytes / MB / self.seconds if self.seconds else 0.0
+
+
+def upload_directory(
+    local_directory: str, s3_uri: str, extra_args: Optional[Dict] = None, max_workers: int = UPLOAD_THREADS
+) -> UploadStats:
+    """
+    Upload the files of the local directory, recursively, under the given S3 prefix (s3://bucket/prefix), preserving
+    their relative paths.
+    * Small files are uploaded in batches, by a single PUT each, with their MD5 checksum verified by S3. Large files
+      are uploaded by multipart uploads, and verified against their size and multipart ETag once uploaded.
+    * The upload can be resumed: the files whose object already exists with the same size and ETag are skipped.
+    * Failed uploads are retried, and the progress and throughput of the upload are logged.
+    `extra_args` are passed to each PUT (e.g. {"ACL": "bucket-owner-full-control"}).
+    """
+    url = urlparse(s3_uri)
+    bucket_name, prefix = url.netloc, url.path.strip("/")
+    extra_args = extra_args or {}
+    s3_client = buckets.portal_client
+
+    files = _list_files(local_directory, prefix)
+    uploaded_objects = _list_objects(s3_client, bucket_name, prefix)
+    upload_tasks = _batch_files(files)
+    logger.info(
+        f"Uploading {len(files)} files ({sum(size for _, _, size in files) / MB:.0f}MB) from {local_directory} to "
+        f"{s3_uri}, in {len(upload_tasks)} tasks"
+    )
+
+    stats = UploadStats()
+    stats_lock = threading.Lock()
+    start = time.perf_counter()
+
+    def upload_files(upload_task: List[Tuple[str, str, int]]) -> None:
+        for local_path, object_key, size in upload_task:
+            uploaded, retries = _upload_file(
+                s3_client, local_path, bucket_name, object_key, size, uploaded_objects.get(object_key), extra_args
+            )
+            with stats_lock:
+                stats.retries += retries
+                if uploaded:
+                    stats.uploaded_files += 1
+                    stats.uploaded_bytes += size
+                else:
+                    stats.skipped_files += 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(upload_files, upload_task) for upload_task in upload_tasks]
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            with stats_lock:
+                stats.seconds = time.perf_counter() - start
+                logger.info(
+                    f"Completed upload task {i + 1} of {len(futures)}: {stats.uploaded_files} files uploaded "
+                    f"({stats.uploaded_bytes / MB:.0f}MB, {stats.throughput_mb_per_second:.1f}MB/s), "
+                    f"{stats.skipped_files} unchanged files skipped, {stats.retries} retries"
+                )
+
+    stats.seconds = time.perf_counter() - start
+    logger.info(f"Uploaded {local_directory} to {s3_uri}: {stats}")
+    return stats
+
+
+def _list_files(local_directory: str, prefix: str) -> List[Tuple[str, str, int]]:
+    files = []
+    for directory, _, filenames in os.walk(local_directory):
+        for filename in sorted(filenames):
+            local_path = os.path.join(directory, filename)
+            relative_path = os.path.relpath(local_path, local_directory).replace(os.sep, "/")
+            object_key = f"{prefix}/{relative_path}" if prefix else relative_path
+            files.append((local_path, object_key, os.path.getsize(local_path)))
+    return files
+
+
+def _list_objects(s3_client, bucket_name: str, prefix: str) -> Dict[str, Tuple[int, str]]:
+    """
+    The size and ETag of each object under the prefix
+    """
+    objects = {}
+    for page in s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket_name, Prefix=f"{prefix}/" if prefix else ""
+    ):
+        for obj in page.get("Contents", []):
+            objects[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+    return objects
+
+
+def _batch_files(files: List[Tuple[str, str, int]]) -> List[List[Tuple[str, str, int]]]:
+    """
+    Each large file is an upload task of its own, and the small files are batched into upload tasks of at most
+    SMALL_FILES_BATCH_BYTES
+    """
+    upload_tasks, batch, batch_bytes = [], [], 0
+    for local_path, object_key, size in files:
+        if size >= UPLOAD_TRANSFER_CONFIG.multipart_threshold:
+            upload_tasks.append([(local_path, object_key, size)])
+            continue
+        if batch and batch_bytes + size > SMALL_FILES_BATCH_BYTES:
+            upload_tasks.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append((local_path, object_key, size))
+        batch_bytes += size
+    if batch:
+        upload_tasks.append(batch)
+    return upload_tasks
+
+
+def _upload_file(
+    s3_client,
+    local_path: str,
+    bucket_name: str,
+    object_key: str,
+    size: int,
+    uploaded_object: Optional[Tuple[int, str]],
+    extra_args: Dict,
+) -> Tuple[bool, int]:
+    """
+    Upload the file, unless the object is already uploaded. Returns whether the file was uploaded, and the number of
+    retries.
+    """
+    is_multipart = size >= UPLOAD_TRANSFER_CONFIG.multipart_threshold
+    if is_multipart:
+        body, etag = None, multipart_etag(local_path, UPLOAD_TRANSFER_CONFIG.multipart_chunksize)
+    else:
+        with open(local_path, "rb") as f:
+            body = f.read()
+        etag = hashlib.md5(body).hexdigest()
+    if uploaded_object == (size, etag):
+        return False, 0
+
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            if is_multipart:
+                s3_client.upload_file(
+                    local_path, bucket_name, object_key, ExtraArgs=extra_args, Config=UPLOAD_TRANSFER_CONFIG
+                )
+                _verify_multipart_upload(s3_client, bucket_name, object_key, size, etag)
+            else:
+                content_md5 = base64.b64encode(bytes.fromhex(etag)).decode()
+                s3_client.put_object(
+                    Bucket=bucket_name, Key=object_key, Body=body, ContentMD5=content_md5, **extra_args
+                )
+            return True, attempt - 1
+        except Exception:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+            logger.warning(
+                f"Failed to upload {local_path} to s3://{bucket_name}/{object_key} "
+                f"(attempt {attempt} of {UPLOAD_ATTEMPTS}), retrying"
+            )
+            time.sleep(UPLOAD_RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+
+
+def _verify_multipart_upload(s3_client, bucket_name: str, object_key: str, size: int, etag: str) -> None:
+    head = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    if head["ContentLength"] != size:
+        raise IOError(f"Uploaded {head['ContentLength']} of the {size} bytes of s3://{bucket_name}/{object_key}")
+    # the ETag of an object encrypted with a KMS key is not derived from its content
+    if head.get("ServerSideEncryption") != "aws:kms" and head["ETag"].strip('"') != etag:
+        raise IOError(f"Checksum mismatch of s3://{bucket_name}/{object_key}: {head['ETag']} instead of {etag}")
+
+
+def multipart_etag(local_path: str, chunksize: int) -> str:
+    """
+    The ETag of the object of a multipart upload of the file, in parts of chunksize bytes: the MD5 of the
+    concatenated MD5 digests of its parts, followed by the number of parts
+    """
+    part_digests = []
+    with open(local_path, "rb") as f:
+        for part in iter(lambda: f.read(chunksize), b""):
+            part_digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
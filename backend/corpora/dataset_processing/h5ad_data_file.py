@@ -25,14 +25,19 @@ class H5ADDataFile:
     """
     Class encapsulating required information about an H5AD datafile that ultimately will be transformed into
     another format (currently just CXG is supported).
+
+    With `backed`, the anndata is read in backed mode: its obs, var, uns and obsm are loaded in memory, but its X
+    matrix stays in the H5AD file, from which it is read in blocks of rows while being written to the CXG.
     """
 
     def __init__(
         self,
         input_filename,
         var_index_column_name=None,
+        backed=False,
     ):
         self.input_filename = input_filename
+        self.backed = backed
         # Set by self.extract_metadata_about_dataset
         self.dataset_title = None
         # These two are set by self.transform_dataframe_index_into_column
@@ -46,13 +51,21 @@ class H5ADDataFile:
 
         self.validate_anndata()
 
-    def to_cxg(self, output_cxg_directory, sparse_threshold, convert_anndata_colors_to_cxg_colors=True):
+    def to_cxg(
+        self,
+        output_cxg_directory,
+        sparse_threshold,
+        convert_anndata_colors_to_cxg_colors=True,
+        x_matrix_memory_budget_bytes=None,
+    ):
         """
         Writes the following attributes of the anndata to CXG: 1) the metadata as metadata attached to an empty
         DenseArray, 2) the obs DataFrame as a DenseArray, 3) the var DataFrame as a DenseArray, 4) all valid
         embeddings stored in obsm, each one as a DenseArray, 5) the main X matrix of the anndata as either a
         SparseArray or DenseArray based on the `sparse_threshold`, and optionally 6) the column shift of the main X
         matrix that might turn an otherwise Dense matrix into a Sparse matrix.
+        The X matrix is written in blocks of rows that take about `x_matrix_memory_budget_bytes` of memory at most,
+        if given.
         """
 
         logging.info("Beginning writing to CXG.")
@@ -81,19 +94,23 @@ class H5ADDataFile:
         self.write_anndata_embeddings_to_cxg(output_cxg_directory, ctx)
         logging.info("\t...dataset embeddings saved")
 
-        self.write_anndata_x_matrix_to_cxg(output_cxg_directory, ctx, sparse_threshold)
+        self.write_anndata_x_matrix_to_cxg(output_cxg_directory, ctx, sparse_threshold, x_matrix_memory_budget_bytes)
         logging.info("\t...dataset X matrix saved")
 
         logging.info("Completed writing to CXG.")
 
-    def write_anndata_x_matrix_to_cxg(self, output_cxg_directory, ctx, sparse_threshold):
+    def write_anndata_x_matrix_to_cxg(
+        self, output_cxg_directory, ctx, sparse_threshold, x_matrix_memory_budget_bytes=None
+    ):
         matrix_container = f"{output_cxg_directory}/X"
 
         x_matrix_data = self.anndata.X
         is_sparse = is_matrix_sparse(x_matrix_data, sparse_threshold)
         logging.info(f"is_sparse: {is_sparse}")
 
-        convert_matrix_to_cxg_array(matrix_container, x_matrix_data, is_sparse, ctx)
+        convert_matrix_to_cxg_array(
+            matrix_container, x_matrix_data, is_sparse, ctx, memory_budget_bytes=x_matrix_memory_budget_bytes
+        )
 
         tiledb.consolidate(matrix_container, ctx=ctx)
         if hasattr(tiledb, "vacuum"):
@@ -165,7 +182,7 @@ class H5ADDataFile:
 
     def extract_anndata_elements_from_file(self):
         logging.info(f"Reading in AnnData dataset: {path.basename(self.input_filename)}")
-        self.anndata = anndata.read_h5ad(self.input_filename)
+        self.anndata = anndata.read_h5ad(self.input_filename, backed="r" if self.backed else None)
         logging.info("Completed reading in AnnData dataset!")
 
         self.obs = self.transform_dataframe_index_into_column(self.anndata.obs, "obs", self.obs_index_column_name)
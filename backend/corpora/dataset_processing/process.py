@@ -126,7 +126,9 @@ import logging
 import os
 import subprocess
 import sys
+import time
 import typing
+from contextlib import contextmanager
 from datetime import datetime
 from os.path import join
 
@@ -145,6 +147,7 @@ from backend.corpora.common.utils.db_helpers import processing_status_updater
 from backend.corpora.common.utils.db_session import db_session_manager
 from backend.corpora.common.utils.dl_sources.url import from_url
 from backend.corpora.common.utils.s3_buckets import buckets
+from backend.corpora.common.utils.s3_upload import upload_directory
 from backend.corpora.dataset_processing.download import download
 from backend.corpora.dataset_processing.exceptions import (
     ProcessingCancelled,
@@ -168,6 +171,9 @@ DEPLOYMENT_STAGE_TO_URL = {
 
 LABELED_H5AD_FILENAME = "local.h5ad"
 
+# The memory budget of the blocks of rows in which the X matrix of a dataset is converted to CXG
+DEFAULT_CXG_X_MATRIX_MEMORY_BUDGET_BYTES = 2 * 1024**3
+
 
 def check_env():
     """Verify that the required environment variables are set."""
@@ -274,6 +280,18 @@ def create_artifacts(
     logger.info(f"Finished creating artifacts for dataset {dataset_id}")
 
 
+@contextmanager
+def timed_stage(stage_timings: typing.Dict[str, float], stage: str):
+    """
+    Records the duration of a stage of the batch job's step, in seconds, including a stage that fails
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timings[stage] = time.perf_counter() - start
+
+
 def cancel_dataset(dataset_id):
     with db_session_manager() as session:
         dataset = Dataset.get(session, dataset_id, include_tombstones=True)
@@ -462,12 +480,19 @@ def make_seurat(local_filename):
 def make_cxg(local_filename):
     """
     Convert the uploaded H5AD file to the CXG format servicing the cellxgene Explorer.
+    The X matrix is read from the H5AD file and written to the CXG in blocks of rows, so that the memory used by the
+    conversion is bounded by the size of the dataset's obs, var and embeddings, plus the
+    CXG_X_MATRIX_MEMORY_BUDGET_BYTES environment variable (by default, DEFAULT_CXG_X_MATRIX_MEMORY_BUDGET_BYTES).
     """
 
     cxg_output_container = local_filename.replace(".h5ad", ".cxg")
     try:
-        h5ad_data_file = H5ADDataFile(local_filename, var_index_column_name="feature_name")
-        h5ad_data_file.to_cxg(cxg_output_container, sparse_threshold=25.0)
+        h5ad_data_file = H5ADDataFile(local_filename, var_index_column_name="feature_name", backed=True)
+        h5ad_data_file.to_cxg(
+            cxg_output_container,
+            sparse_threshold=25.0,
+            x_matrix_memory_budget_bytes=get_cxg_x_matrix_memory_budget_bytes(),
+        )
     except Exception as ex:
         msg = "CXG conversion failed."
         logger.exception(msg)
@@ -476,29 +501,15 @@ def make_cxg(local_filename):
     return cxg_output_container
 
 
+def get_cxg_x_matrix_memory_budget_bytes() -> int:
+    return int(os.getenv("CXG_X_MATRIX_MEMORY_BUDGET_BYTES", DEFAULT_CXG_X_MATRIX_MEMORY_BUDGET_BYTES))
+
+
 def copy_cxg_files_to_cxg_bucket(cxg_dir, s3_uri):
     """
     Copy cxg files to the cellxgene bucket (under the given object key) for access by the explorer
     """
-    command = ["aws"]
-    if os.getenv("BOTO_ENDPOINT_URL"):
-        command.append(f"--endpoint-url={os.getenv('BOTO_ENDPOINT_URL')}")
-
-    command.extend(
-        [
-            "s3",
-            "cp",
-            cxg_dir,
-            s3_uri,
-            "--recursive",
-            "--acl",
-            "bucket-owner-full-control",
-        ]
-    )
-    subprocess.run(
-        command,
-        check=True,
-    )
+    upload_directory(cxg_dir, s3_uri, extra_args={"ACL": "bucket-owner-full-control"})
 
 
 def convert_file_ignore_exceptions(
@@ -539,8 +550,13 @@ def get_bucket_prefix(identifier):
         return identifier
 
 
-def process_cxg(local_filename, dataset_id, cellxgene_bucket):
-    cxg_dir = convert_file_ignore_exceptions(make_cxg, local_filename, "Issue creating cxg.", dataset_id, "cxg_status")
+def process_cxg(local_filename, dataset_id, cellxgene_bucket, stage_timings=None):
+    if stage_timings is None:
+        stage_timings = {}
+    with timed_stage(stage_timings, "cxg_conversion"):
+        cxg_dir = convert_file_ignore_exceptions(
+            make_cxg, local_filename, "Issue creating cxg.", dataset_id, "cxg_status"
+        )
     if cxg_dir:
         with db_session_manager() as session:
             asset = DatasetAsset.create(
@@ -555,7 +571,8 @@ def process_cxg(local_filename, dataset_id, cellxgene_bucket):
             bucket_prefix = get_bucket_prefix(asset_id)
             s3_uri = f"s3://{cellxgene_bucket}/{bucket_prefix}.cxg/"
         update_db(dataset_id, processing_status={"cxg_status": ConversionStatus.UPLOADING})
-        copy_cxg_files_to_cxg_bucket(cxg_dir, s3_uri)
+        with timed_stage(stage_timings, "cxg_upload"):
+            copy_cxg_files_to_cxg_bucket(cxg_dir, s3_uri)
         metadata = {
             "explorer_url": join(
                 DEPLOYMENT_STAGE_TO_URL[os.environ["DEPLOYMENT_STAGE"]],
@@ -663,6 +680,7 @@ def main():
     step_name = os.environ["STEP_NAME"]
     is_last_attempt = os.environ["AWS_BATCH_JOB_ATTEMPT"] == os.getenv("MAX_ATTEMPTS", "1")
     return_value = 0
+    stage_timings = {}
     logger.info(f"Processing dataset {dataset_id}")
     try:
         if step_name == "download-validate":
@@ -670,7 +688,7 @@ def main():
                 process,
             )
 
-            process(dataset_id, os.environ["DROPBOX_URL"], os.environ["ARTIFACT_BUCKET"])
+            process(dataset_id, os.environ["DROPBOX_URL"], os.environ["ARTIFACT_BUCKET"], stage_timings)
         elif step_name == "cxg":
             from backend.corpora.dataset_processing.process_cxg import process
 
@@ -678,11 +696,12 @@ def main():
                 dataset_id,
                 os.environ["ARTIFACT_BUCKET"],
                 os.environ["CELLXGENE_BUCKET"],
+                stage_timings,
             )
         elif step_name == "seurat":
             from backend.corpora.dataset_processing.process_seurat import process
 
-            process(dataset_id, os.environ["ARTIFACT_BUCKET"])
+            process(dataset_id, os.environ["ARTIFACT_BUCKET"], stage_timings)
         elif step_name == "cxg_remaster":
             from backend.corpora.dataset_processing.remaster_cxg import process
 
@@ -705,6 +724,8 @@ def main():
         logger.exception(f"An unexpected error occurred while processing the data set: {e}")
         return_value = 1
 
+    if stage_timings:
+        logger.info(f"Batch Job Stage Timings (s): {stage_timings}")
     return return_value
 
 
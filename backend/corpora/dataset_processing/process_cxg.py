@@ -1,17 +1,19 @@
 #!/usr/bin/env python3
 import logging
+from typing import Dict
 
 from backend.corpora.dataset_processing.process import (
     download_from_s3,
     process_cxg,
     get_bucket_prefix,
+    timed_stage,
 )
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def process(dataset_id: str, artifact_bucket: str, cellxgene_bucket: str):
+def process(dataset_id: str, artifact_bucket: str, cellxgene_bucket: str, stage_timings: Dict[str, float]):
     """
     1. Download the labeled dataset from the artifact bucket
     2. Convert the labeled dataset to CXG
@@ -20,6 +22,7 @@ def process(dataset_id: str, artifact_bucket: str, cellxgene_bucket: str):
     :param artifact_bucket:
     :param labeled_h5ad_filename:
     :param cellxgene_bucket:
+    :param stage_timings: the duration of each of these stages is recorded in it, in seconds
     :return:
     """
 
@@ -28,7 +31,8 @@ def process(dataset_id: str, artifact_bucket: str, cellxgene_bucket: str):
     # Download the labeled dataset from the artifact bucket
     bucket_prefix = get_bucket_prefix(dataset_id)
     object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
-    download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
+    with timed_stage(stage_timings, "download"):
+        download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
 
     # Convert the labeled dataset to CXG and upload it to the cellxgene bucket
-    process_cxg(labeled_h5ad_filename, dataset_id, cellxgene_bucket)
+    process_cxg(labeled_h5ad_filename, dataset_id, cellxgene_bucket, stage_timings)
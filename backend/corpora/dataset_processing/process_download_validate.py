@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import logging
+from typing import Dict
 
 from backend.corpora.dataset_processing.process import (
     update_db,
@@ -8,6 +9,7 @@ from backend.corpora.dataset_processing.process import (
     extract_metadata,
     create_artifact,
     get_bucket_prefix,
+    timed_stage,
 )
 
 logger = logging.getLogger(__name__)
@@ -20,7 +22,7 @@ from backend.corpora.common.corpora_orm import (
 )
 
 
-def process(dataset_id: str, dropbox_url: str, artifact_bucket: str):
+def process(dataset_id: str, dropbox_url: str, artifact_bucket: str, stage_timings: Dict[str, float]):
     """
     1. Download the original dataset from Dropbox
     2. Validate and label it
@@ -28,22 +30,26 @@ def process(dataset_id: str, dropbox_url: str, artifact_bucket: str):
     :param dataset_id:
     :param dropbox_url:
     :param artifact_bucket:
+    :param stage_timings: the duration of each of these stages is recorded in it, in seconds
     :return:
     """
 
     update_db(dataset_id, processing_status=dict(processing_status=ProcessingStatus.PENDING))
 
     # Download the original dataset from Dropbox
-    local_filename = download_from_source_uri(
-        dataset_id=dataset_id,
-        source_uri=dropbox_url,
-        local_path="raw.h5ad",
-    )
+    with timed_stage(stage_timings, "download"):
+        local_filename = download_from_source_uri(
+            dataset_id=dataset_id,
+            source_uri=dropbox_url,
+            local_path="raw.h5ad",
+        )
 
     # Validate and label the dataset
-    file_with_labels, can_convert_to_seurat = validate_h5ad_file_and_add_labels(dataset_id, local_filename)
+    with timed_stage(stage_timings, "validation"):
+        file_with_labels, can_convert_to_seurat = validate_h5ad_file_and_add_labels(dataset_id, local_filename)
     # Process metadata
-    metadata = extract_metadata(file_with_labels)
+    with timed_stage(stage_timings, "metadata"):
+        metadata = extract_metadata(file_with_labels)
     update_db(dataset_id, metadata)
 
     if not can_convert_to_seurat:
@@ -52,6 +58,7 @@ def process(dataset_id: str, dropbox_url: str, artifact_bucket: str):
 
     # Upload the labeled dataset to the artifact bucket
     bucket_prefix = get_bucket_prefix(dataset_id)
-    create_artifact(
-        file_with_labels, DatasetArtifactFileType.H5AD, bucket_prefix, dataset_id, artifact_bucket, "h5ad_status"
-    )
+    with timed_stage(stage_timings, "h5ad_upload"):
+        create_artifact(
+            file_with_labels, DatasetArtifactFileType.H5AD, bucket_prefix, dataset_id, artifact_bucket, "h5ad_status"
+        )
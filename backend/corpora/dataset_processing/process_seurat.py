@@ -10,8 +10,10 @@ from backend.corpora.dataset_processing.process import (
     create_artifact,
     get_bucket_prefix,
     replace_artifact,
+    timed_stage,
 )
 from datetime import datetime
+from typing import Dict
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -19,7 +21,7 @@ logging.basicConfig(level=logging.INFO)
 from backend.corpora.common.corpora_orm import ConversionStatus, DatasetArtifactFileType
 
 
-def process(dataset_id: str, artifact_bucket: str):
+def process(dataset_id: str, artifact_bucket: str, stage_timings: Dict[str, float]):
     """
     1. Download the labeled dataset from the artifact bucket
     2. Convert it to Seurat format
@@ -28,6 +30,7 @@ def process(dataset_id: str, artifact_bucket: str):
     :param dataset_id:
     :param labeled_h5ad_filename:
     :param local_filename:
+    :param stage_timings: the duration of each of these stages is recorded in it, in seconds
     :return:
     """
 
@@ -53,79 +56,22 @@ def process(dataset_id: str, artifact_bucket: str):
         artifact_key = h5ad_uri.split("/")[-2]
 
         if artifact_key == dataset_id and not rds_artifacts:  # Case 1
-
             bucket_prefix = get_bucket_prefix(dataset_id)
-            object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
-            download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
-
-            seurat_filename = convert_file_ignore_exceptions(
-                make_seurat,
-                labeled_h5ad_filename,
-                "Failed to convert dataset to Seurat format.",
-                dataset_id,
-                "rds_status",
-            )
-
-            if seurat_filename:
-                create_artifact(
-                    seurat_filename,
-                    DatasetArtifactFileType.RDS,
-                    bucket_prefix,
-                    dataset_id,
-                    artifact_bucket,
-                    "rds_status",
-                )
-
         elif artifact_key == dataset_id and rds_artifacts:  # Case 2
             logger.warning(f"Reprocessing Seurat for existing dataset {artifact_key}, will replace the S3 file only")
             bucket_prefix = get_bucket_prefix(dataset_id)
-            object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
-            download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
-
-            seurat_filename = convert_file_ignore_exceptions(
-                make_seurat,
-                labeled_h5ad_filename,
-                "Failed to convert dataset to Seurat format.",
-                dataset_id,
-                "rds_status",
-            )
-
-            if seurat_filename:
-                replace_artifact(seurat_filename, bucket_prefix, artifact_bucket)
-                rds_artifact = rds_artifacts[0]  # Only one RDS artifact for dataset will ever exist
-                rds_artifact.updated_at = datetime.utcnow()
-
         elif artifact_key != dataset_id and not rds_artifacts:  # Case 3
             logger.warning(f"Found existing artifacts in {artifact_key} but no RDS, creating a new artifact")
             bucket_prefix = get_bucket_prefix(artifact_key)
-            object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
-            download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
-
-            seurat_filename = convert_file_ignore_exceptions(
-                make_seurat,
-                labeled_h5ad_filename,
-                "Failed to convert dataset to Seurat format.",
-                dataset_id,
-                "rds_status",
-            )
-
-            if seurat_filename:
-                create_artifact(
-                    seurat_filename,
-                    DatasetArtifactFileType.RDS,
-                    bucket_prefix,
-                    dataset_id,
-                    artifact_bucket,
-                    "rds_status",
-                )
-
         else:  # Case 4
             logger.warning(f"Found existing artifacts in {artifact_key} including an RDS, replacing it")
-
             bucket_prefix = get_bucket_prefix(artifact_key)
-            object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
+
+        object_key = f"{bucket_prefix}/{labeled_h5ad_filename}"
+        with timed_stage(stage_timings, "download"):
             download_from_s3(artifact_bucket, object_key, labeled_h5ad_filename)
 
+        with timed_stage(stage_timings, "seurat_conversion"):
             seurat_filename = convert_file_ignore_exceptions(
                 make_seurat,
                 labeled_h5ad_filename,
@@ -134,7 +80,18 @@ def process(dataset_id: str, artifact_bucket: str):
                 "rds_status",
             )
 
-            if seurat_filename:
-                replace_artifact(seurat_filename, bucket_prefix, artifact_bucket)
-                rds_artifact = rds_artifacts[0]  # Only one RDS artifact for dataset will ever exist
-                rds_artifact.updated_at = datetime.utcnow()
+        if seurat_filename:
+            with timed_stage(stage_timings, "seurat_upload"):
+                if rds_artifacts:  # Cases 2 and 4
+                    replace_artifact(seurat_filename, bucket_prefix, artifact_bucket)
+                    rds_artifact = rds_artifacts[0]  # Only one RDS artifact for dataset will ever exist
+                    rds_artifact.updated_at = datetime.utcnow()
+                else:  # Cases 1 and 3
+                    create_artifact(
+                        seurat_filename,
+                        DatasetArtifactFileType.RDS,
+                        bucket_prefix,
+                        dataset_id,
+                        artifact_bucket,
+                        "rds_status",
+                    )
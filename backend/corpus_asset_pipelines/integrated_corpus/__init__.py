@@ -1,10 +1,21 @@
-from backend.corpus_asset_pipelines.integrated_corpus.job import build_integrated_corpus, extract_datasets
+from backend.corpus_asset_pipelines.integrated_corpus.job import (
+    build_integrated_corpus,
+    extract_changed_datasets,
+    extract_datasets,
+)
 
 
-def run(dataset_directory: list, corpus_path: str, extract_data: bool):
+def run(dataset_directory: list, corpus_path: str, extract_data: bool, max_workers: int = 1, incremental: bool = False):
     """
-    Copy relevant datasets and integrate cells into data corpus matrix
+    Copy relevant datasets and integrate cells into data corpus matrix, loading up to max_workers datasets
+    concurrently. The datasets are loaded as they are copied.
+    With incremental, corpus_path holds the corpus of a previous snapshot, and only the datasets that were added since
+    are copied and integrated, while the datasets that were removed since are removed from it.
     """
+    dataset_ids = None
     if extract_data:
-        extract_datasets(dataset_directory)
-    build_integrated_corpus(dataset_directory, corpus_path)
+        if incremental:
+            dataset_ids = extract_changed_datasets(dataset_directory, corpus_path)
+        else:
+            dataset_ids = extract_datasets(dataset_directory)
+    build_integrated_corpus(dataset_directory, corpus_path, max_workers, dataset_ids)
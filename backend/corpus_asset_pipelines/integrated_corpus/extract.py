@@ -1,20 +1,39 @@
 import logging
-import subprocess
-from typing import Dict, Union
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, Union
+from urllib.parse import urlparse
 
 import anndata
 import numpy as np
 from anndata._core.views import ArrayView
+from boto3.s3.transfer import TransferConfig
 from scipy import sparse
 
 from backend.corpora.common.corpora_orm import DatasetArtifactFileType
 from backend.corpora.common.entities import Dataset, Collection, DatasetAsset
 from backend.corpora.common.utils.db_session import db_session_manager
+from backend.corpora.common.utils.math_utils import MB
+from backend.corpora.common.utils.s3_buckets import buckets
 from backend.wmg.data.constants import INCLUDED_ASSAYS
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Number of datasets downloaded concurrently
+DOWNLOAD_THREADS = 8
+
+# Each dataset is downloaded by concurrent ranged GETs of its parts
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * MB, multipart_chunksize=64 * MB, max_concurrency=8)
+
+# Number of attempts to download a dataset, with exponential backoff between attempts
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_RETRY_DELAY_SECONDS = 5
+
+# Suffix of the file that records the ETag of a downloaded dataset, next to it
+DOWNLOADED_ETAG_SUFFIX = ".etag"
+
 
 def get_X_raw(anndata_object: anndata.AnnData) -> Union[np.ndarray, sparse.spmatrix, ArrayView]:
     """
@@ -58,11 +77,85 @@ def get_dataset_s3_uris() -> Dict:
 
 def copy_datasets_to_instance(s3_uris: Dict, dataset_directory: str):
     """Copy given list of s3 uris to the provided path"""
-    for dataset in s3_uris:
-        copy_command = ["aws", "s3", "cp", s3_uris[dataset], f"./{dataset_directory}/{dataset}/local.h5ad"]
-        subprocess.run(copy_command)
+    for _ in download_datasets(s3_uris, dataset_directory):
+        pass
+
+
+def download_datasets(s3_uris: Dict, dataset_directory: str, max_workers: int = DOWNLOAD_THREADS) -> Iterator[str]:
+    """
+    Download the given datasets (s3 uri by dataset id) to {dataset_directory}/{dataset_id}/local.h5ad, up to
+    max_workers concurrently, and yield the id of each dataset as soon as it is downloaded, so that it can be loaded
+    while the others are downloading. The datasets that failed to download are logged and not yielded.
+    """
+    start = time.perf_counter()
+    downloaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_dataset, s3_uri, f"{dataset_directory}/{dataset_id}/local.h5ad"): dataset_id
+            for dataset_id, s3_uri in s3_uris.items()
+        }
+        for i, future in enumerate(as_completed(futures)):
+            dataset_id = futures[future]
+            try:
+                downloaded_bytes += future.result()
+            except Exception:
+                logger.exception(f"Failed to download dataset {dataset_id}, not loading")
+                continue
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Downloaded dataset {i + 1} of {len(futures)} ({dataset_id}), "
+                f"{downloaded_bytes / MB:.0f}MB in {elapsed:.0f}s, {downloaded_bytes / MB / elapsed:.1f}MB/s"
+            )
+            yield dataset_id
+
+
+def download_dataset(s3_uri: str, local_path: str) -> int:
+    """
+    Download the S3 object to local_path, unless it was already downloaded there: the ETag of each downloaded object
+    is recorded next to it, and an object is downloaded again only if its ETag or size changed. The object is
+    downloaded to a temporary file, so an interrupted download is never mistaken for a complete one. Failed downloads
+    are retried.
+    Returns the number of bytes downloaded.
+    """
+    url = urlparse(s3_uri)
+    bucket_name, object_key = url.netloc, url.path.lstrip("/")
+    etag_path = f"{local_path}{DOWNLOADED_ETAG_SUFFIX}"
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        try:
+            head = buckets.portal_client.head_object(Bucket=bucket_name, Key=object_key)
+            if _is_downloaded(local_path, etag_path, head["ETag"], head["ContentLength"]):
+                logger.info(f"{local_path} is up to date with {s3_uri}, not downloading")
+                return 0
+
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            download_path = f"{local_path}.download"
+            buckets.portal_client.download_file(bucket_name, object_key, download_path, Config=DOWNLOAD_TRANSFER_CONFIG)
+            os.replace(download_path, local_path)
+            with open(etag_path, "w") as etag_file:
+                etag_file.write(head["ETag"])
+            return head["ContentLength"]
+        except Exception:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            logger.warning(f"Failed to download {s3_uri} (attempt {attempt} of {DOWNLOAD_ATTEMPTS}), retrying")
+            time.sleep(DOWNLOAD_RETRY_DELAY_SECONDS * 2 ** (attempt - 1))
+
+
+def _is_downloaded(local_path: str, etag_path: str, etag: str, size: int) -> bool:
+    if not os.path.isfile(local_path) or not os.path.isfile(etag_path) or os.path.getsize(local_path) != size:
+        return False
+    with open(etag_path) as etag_file:
+        return etag_file.read() == etag
 
 
 def extract_h5ad(h5ad_path: str) -> anndata.AnnData:
     logger.info(f"Extracting {h5ad_path}...")
     return anndata.read_h5ad(h5ad_path)
+
+
+def extract_backed_h5ad(h5ad_path: str) -> anndata.AnnData:
+    """
+    Open the h5ad in backed mode, which reads the obs, var and uns, but leaves the expression matrices on disk. The
+    caller must close the file (`anndata_object.file.close()`).
+    """
+    return anndata.read_h5ad(h5ad_path, backed="r")
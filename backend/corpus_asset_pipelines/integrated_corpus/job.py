@@ -1,52 +1,81 @@
 import gc
 import logging
+import multiprocessing
 import os
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional
 
 import tiledb
 
 from backend.corpus_asset_pipelines.integrated_corpus import extract
 from backend.corpus_asset_pipelines.integrated_corpus import load
-from backend.corpus_asset_pipelines.integrated_corpus.transform import (
-    apply_pre_concatenation_filters,
+from backend.corpus_asset_pipelines.integrated_corpus.transform import compute_pre_concatenation_filter_mask
+from backend.corpus_asset_pipelines.integrated_corpus.validate import (
+    get_dataset_id,
+    should_load_dataset,
+    validate_backed_dataset_properties,
 )
-from backend.corpus_asset_pipelines.integrated_corpus.validate import should_load_dataset, validate_dataset_properties
 from backend.wmg.data.schemas.corpus_schema import INTEGRATED_ARRAY_NAME, OBS_ARRAY_NAME, VAR_ARRAY_NAME
 from backend.wmg.data.tiledb import create_ctx
-from backend.wmg.data.utils import log_func_runtime
+from backend.wmg.data.utils import get_all_dataset_ids, log_func_runtime
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-@log_func_runtime
-def extract_datasets(dataset_directory: List):
+def extract_datasets(dataset_directory: List) -> Iterator[str]:
+    """
+    Copy the datasets to the instance. Returns the ids of the datasets as they are downloaded (see download_datasets).
+    The downloads start once the first id is requested, and then all proceed, max_workers at a time, however slowly
+    the ids are consumed.
+    """
     s3_uris = extract.get_dataset_s3_uris()
-    extract.copy_datasets_to_instance(s3_uris, dataset_directory)
-    logger.info("Copied datasets to instance")
+    return extract.download_datasets(s3_uris, dataset_directory)
+
+
+def extract_changed_datasets(dataset_directory: List, corpus_path: str) -> Iterator[str]:
+    """
+    Copy the datasets that are not yet in the corpus of a previous snapshot, and remove the datasets that are no
+    longer included from it. Datasets are identified by their id, so a dataset is only reloaded if its id changes.
+    Returns the ids of the added datasets as they are downloaded, see extract_datasets.
+    """
+    s3_uris = extract.get_dataset_s3_uris()
+    corpus_dataset_ids = set(get_all_dataset_ids(corpus_path))
+    added_dataset_ids = sorted(set(s3_uris) - corpus_dataset_ids)
+    removed_dataset_ids = sorted(corpus_dataset_ids - set(s3_uris))
+    logger.info(f"{len(added_dataset_ids)} datasets added, {len(removed_dataset_ids)} datasets removed")
+
+    if removed_dataset_ids:
+        load.remove_datasets_from_corpus(corpus_path, removed_dataset_ids)
+    os.makedirs(dataset_directory, exist_ok=True)
+    return extract.download_datasets(
+        {dataset_id: s3_uris[dataset_id] for dataset_id in added_dataset_ids}, dataset_directory
+    )
 
 
 @log_func_runtime
-def build_integrated_corpus(dataset_directory: List, corpus_path: str):
+def build_integrated_corpus(
+    dataset_directory: List, corpus_path: str, max_workers: int = 1, dataset_ids: Optional[Iterable[str]] = None
+):
     """
     Given the path to a directory containing one or more h5ad files and a group name, call the h5ad loading function
-    on all files, loading/concatenating the datasets together under the group name
-
-    @mdunitz TODO: As the number of datasets grows this will become a bottleneck step.
-                    hopefully this code will be removed in the near future as we switch to SOMA
-                    if this becomes too slow before soma is ready for prod this step can be safely parallelized
-                    with some consideration given to the load step to avoid collisions of the feature (obs) indices
-                    in the integrated corpus
+    on all files, loading/concatenating the datasets together under the group name.
+    If dataset_ids is given, only these datasets are loaded, in their order. They can be yielded as they are
+    downloaded (see extract_datasets), so that datasets are loaded while others are still downloading.
+    With max_workers > 1, the datasets are loaded concurrently by a pool of processes, see
+    process_h5ads_for_corpus_in_parallel.
     """
     with tiledb.scope_ctx(create_ctx()):
-        dataset_count = len(os.listdir(dataset_directory))
-        for dataset in enumerate(os.listdir(dataset_directory)):
-            logger.info(f"Processing dataset {dataset[0] + 1} of {dataset_count}")
-            h5ad_file_path = f"{dataset_directory}/{dataset[1]}/local.h5ad"
-            process_h5ad_for_corpus(
-                h5ad_file_path, corpus_path
-            )  # TODO Can this be parallelized? need to be careful handling global indexes but tiledb has a lock I think
-            gc.collect()
+        if dataset_ids is None:
+            dataset_ids = os.listdir(dataset_directory)
+        h5ad_file_paths = (f"{dataset_directory}/{dataset_id}/local.h5ad" for dataset_id in dataset_ids)
+        if max_workers > 1:
+            process_h5ads_for_corpus_in_parallel(h5ad_file_paths, corpus_path, max_workers)
+        else:
+            for i, h5ad_file_path in enumerate(h5ad_file_paths):
+                logger.info(f"Processing dataset {i + 1}: {h5ad_file_path}")
+                process_h5ad_for_corpus(h5ad_file_path, corpus_path)
+                gc.collect()
 
         logger.info("all loaded, now consolidating.")
 
@@ -55,25 +84,83 @@ def build_integrated_corpus(dataset_directory: List, corpus_path: str):
             tiledb.consolidate(arr_path)
             tiledb.vacuum(arr_path)
 
+    # the dataset ids of the corpus are cached, see should_load_dataset
+    get_all_dataset_ids.cache_clear()
+
 
-def process_h5ad_for_corpus(h5ad_path: str, corpus_path: str):
+def process_h5ad_for_corpus(
+    h5ad_path: str, corpus_path: str, first_obs_idx: Optional[int] = None, rankit_max_workers: Optional[int] = None
+):
     """
     Given the location of a h5ad dataset and a group name, check the dataset is not already loaded
     then read the dataset into the tiledb object (under group name), updating the var and feature indexes
-    to avoid collisions within the larger tiledb object
+    to avoid collisions within the larger tiledb object.
+    If first_obs_idx is given, the dataset was already checked and its obs index range reserved, by
+    process_h5ads_for_corpus_in_parallel, and rankit_max_workers is its share of the CPUs.
     """
-    dataset_id = should_load_dataset(h5ad_path, corpus_path)
-    if not dataset_id:
-        return
+    if first_obs_idx is None:
+        dataset_id = should_load_dataset(h5ad_path, corpus_path)
+        if not dataset_id:
+            return
+    else:
+        dataset_id = get_dataset_id(h5ad_path)
 
-    # extract
-    anndata_object = extract.extract_h5ad(h5ad_path=h5ad_path)
+    # extract, in backed mode: the expression matrices stay on disk, and are read in blocks of rows
+    anndata_object = extract.extract_backed_h5ad(h5ad_path)
+    try:
+        if not validate_backed_dataset_properties(anndata_object):
+            return
 
-    # transform
-    apply_pre_concatenation_filters(anndata_object)
-    logger.info(f"loaded: shape={anndata_object.shape}")
-    if not validate_dataset_properties(anndata_object):
-        return
+        # transform
+        obs_mask = compute_pre_concatenation_filter_mask(anndata_object)
+        logger.info(f"loaded: shape={(int(obs_mask.sum()), anndata_object.n_vars)}")
 
-    # load
-    load.load_dataset(corpus_path, anndata_object, dataset_id)
+        # load
+        load.load_dataset(corpus_path, anndata_object, dataset_id, first_obs_idx, obs_mask, rankit_max_workers)
+    finally:
+        anndata_object.file.close()
+
+
+@log_func_runtime
+def process_h5ads_for_corpus_in_parallel(h5ad_paths: Iterable[str], corpus_path: str, max_workers: int):
+    """
+    Load the given h5ad datasets into the corpus concurrently, each in its own process. Each dataset is first scanned
+    in backed mode (reading its obs, var and uns, but not its expression matrices), to add its genes to the global var
+    array and to reserve a disjoint obs index range for it, sized by its unfiltered cell count. A process then writes
+    its own obs and X fragments, while the next datasets are scanned. Cells removed by the pre-concatenation filters
+    leave gaps at the end of their dataset's obs index range.
+    The CPUs are divided between the processes, each of which runs rankit on a thread pool.
+    """
+    rankit_max_workers = max(1, (os.cpu_count() or 1) // max_workers)
+    # spawned rather than forked, as the parent process holds TileDB contexts and their threads
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = []
+        for h5ad_path in h5ad_paths:
+            if not should_load_dataset(h5ad_path, corpus_path):
+                continue
+            backed_anndata_object = extract.extract_backed_h5ad(h5ad_path)
+            try:
+                if not validate_backed_dataset_properties(backed_anndata_object):
+                    continue
+                n_obs, var = backed_anndata_object.n_obs, backed_anndata_object.var
+            finally:
+                backed_anndata_object.file.close()
+
+            load.update_corpus_var(corpus_path, var)
+            first_obs_idx = load.reserve_corpus_obs(corpus_path, n_obs)
+            futures.append(
+                executor.submit(
+                    _process_h5ad_for_corpus_in_worker, h5ad_path, corpus_path, first_obs_idx, rankit_max_workers
+                )
+            )
+            logger.info(f"Loading dataset {len(futures)} with {max_workers} processes: {h5ad_path}")
+
+        for i, future in enumerate(futures):
+            # raise any loading error
+            future.result()
+            logger.info(f"Processed dataset {i + 1} of {len(futures)}")
+
+
+def _process_h5ad_for_corpus_in_worker(h5ad_path: str, corpus_path: str, first_obs_idx: int, rankit_max_workers: int):
+    with tiledb.scope_ctx(create_ctx()):
+        process_h5ad_for_corpus(h5ad_path, corpus_path, first_obs_idx, rankit_max_workers)
@@ -1,25 +1,45 @@
 import logging
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import pandas as pd
 import tiledb
 
 from backend.corpus_asset_pipelines.integrated_corpus.transform import transform_dataset_raw_counts_to_rankit
-from backend.wmg.data.schemas.corpus_schema import obs_labels, var_labels, VAR_ARRAY_NAME, OBS_ARRAY_NAME
-from backend.wmg.data.utils import log_func_runtime
+from backend.wmg.data.schemas.corpus_schema import (
+    obs_labels,
+    var_labels,
+    INTEGRATED_ARRAY_NAME,
+    VAR_ARRAY_NAME,
+    OBS_ARRAY_NAME,
+)
+from backend.wmg.data.utils import get_all_dataset_ids, log_func_runtime
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
 @log_func_runtime
-def load_dataset(corpus_path: str, anndata_object: pd.DataFrame, dataset_id: str):
+def load_dataset(
+    corpus_path: str,
+    anndata_object: pd.DataFrame,
+    dataset_id: str,
+    first_obs_idx: Optional[int] = None,
+    obs_mask: Optional[np.ndarray] = None,
+    rankit_max_workers: Optional[int] = None,
+):
     """
     Read given anndata dataset into the tiledb object (under corpus name), updating the var and feature indexes
-    to avoid collisions within the larger tiledb object
+    to avoid collisions within the larger tiledb object.
+    If first_obs_idx is given, the dataset's obs index range was reserved (see reserve_corpus_obs) and its genes were
+    already added to the global var array, so that datasets can be loaded concurrently.
+    If obs_mask is given, only the cells it selects are loaded. The anndata_object may be opened in backed mode, as its
+    expression matrix is read in blocks of rows. rankit_max_workers is the number of threads that normalize it.
     """
-    var_df = update_corpus_var(corpus_path, anndata_object)
+    if first_obs_idx is None:
+        var_df = update_corpus_var(corpus_path, anndata_object.var)
+    else:
+        var_df = read_corpus_var(corpus_path)
 
     # Calculate mapping between var/feature coordinates in anndata_object (local h5ad file) and corpus (global tdb object) # noqa E501
     global_var_index = np.zeros((anndata_object.shape[1],), dtype=np.uint32)
@@ -29,19 +49,20 @@ def load_dataset(corpus_path: str, anndata_object: pd.DataFrame, dataset_id: str
         global_coord = var_feature_to_coord_map[gene_ontology_term_id]
         global_var_index[idx] = global_coord
 
-    first_obs_idx = update_corpus_obs(corpus_path, anndata_object, dataset_id)
+    first_obs_idx = update_corpus_obs(corpus_path, anndata_object, dataset_id, first_obs_idx, obs_mask)
     # todo refactor: separate rankit transformation from loading the tiledb object when working with the x matrices
-    transform_dataset_raw_counts_to_rankit(anndata_object, corpus_path, global_var_index, first_obs_idx)
+    transform_dataset_raw_counts_to_rankit(
+        anndata_object, corpus_path, global_var_index, first_obs_idx, obs_mask, rankit_max_workers
+    )
 
 
-def update_corpus_var(corpus_path: str, anndata_object: pd.DataFrame) -> pd.DataFrame:
+def update_corpus_var(corpus_path: str, addit_var: pd.DataFrame) -> pd.DataFrame:
     """
     Update the global var (gene) array. Adds any gene_ids we have not seen before.
     Returns the global var array as dataframe
     """
 
     var_array_path = f"{corpus_path}/{VAR_ARRAY_NAME}"
-    addit_var = anndata_object.var
     with tiledb.open(var_array_path, "r") as var:
         var_df = var.df[:]
         missing_var = set(addit_var.index.to_numpy(dtype=str)) - set(
@@ -52,33 +73,127 @@ def update_corpus_var(corpus_path: str, anndata_object: pd.DataFrame) -> pd.Data
         logger.info(f"Adding {len(missing_var)} gene records...")
         missing_var_df = addit_var[addit_var.index.isin(missing_var)]
         update_corpus_axis(missing_var_df, var_array_path, var_labels)
-    with tiledb.open(var_array_path, "r") as var:
-        var_df = var.df[:]
-        var_df.index = var_df.gene_ontology_term_id
+    var_df = read_corpus_var(corpus_path)
 
     logger.info(f"Global var index length: {var_df.shape}")
     return var_df
 
 
-def update_corpus_obs(corpus_path: str, anndata_object: pd.DataFrame, dataset_id: str) -> int:
+def read_corpus_var(corpus_path: str) -> pd.DataFrame:
+    """
+    Returns the global var array as dataframe, indexed by gene_ontology_term_id
+    """
+    with tiledb.open(f"{corpus_path}/{VAR_ARRAY_NAME}", "r") as var:
+        var_df = var.df[:]
+        var_df.index = var_df.gene_ontology_term_id
+    return var_df
+
+
+def update_corpus_obs(
+    corpus_path: str,
+    anndata_object: pd.DataFrame,
+    dataset_id: str,
+    first_obs_idx: Optional[int] = None,
+    obs_mask: Optional[np.ndarray] = None,
+) -> int:
     """
     Add the dataset_id to the obs dataframe and
-    update the Corpus obs by adding the anndata_object
+    update the Corpus obs by adding the anndata_object (only the cells selected by obs_mask, if given), from
+    first_obs_idx if the obs index range was reserved
     Returns an int representing the starting index for this dataset's obs in the corpus df
     """
     obs_array_path = f"{corpus_path}/{OBS_ARRAY_NAME}"
-    obs = anndata_object.obs
+    obs = anndata_object.obs if obs_mask is None else anndata_object.obs[obs_mask].copy()
     obs["dataset_id"] = dataset_id
-    return update_corpus_axis(obs, obs_array_path, obs_labels)
+    return update_corpus_axis(obs, obs_array_path, obs_labels, first_obs_idx)
 
 
-def update_corpus_axis(df: pd.DataFrame, array_name: str, label_info: List) -> int:
+def reserve_corpus_obs(corpus_path: str, n_obs: int) -> int:
     """
-    Safely add given dataframe to extend the specified array with the appropriate encoding
-    typically used to update integrated_corpus obs/var frames for each new dataset
+    Reserve a range of n_obs indices of the Corpus obs, for a dataset to be loaded later (possibly concurrently with
+    other datasets) by update_corpus_obs
+    Returns an int representing the starting index of the reserved range
     """
-    with tiledb.open(array_name) as array:
+    with tiledb.open(f"{corpus_path}/{OBS_ARRAY_NAME}") as array:
         starting_join_index = array.meta.get("next_join_index", 0)
+    with tiledb.open(f"{corpus_path}/{OBS_ARRAY_NAME}", mode="w") as array:
+        array.meta["next_join_index"] = starting_join_index + n_obs
+    return starting_join_index
+
+
+def remove_datasets_from_corpus(corpus_path: str, dataset_ids: List[str]):
+    """
+    Remove the cells of the given datasets from the Corpus, by rewriting the obs array without them, and the
+    integrated array without their expression values (see remove_obs_from_integrated_array). Their obs index ranges
+    are not reused.
+    """
+    obs_array_path = f"{corpus_path}/{OBS_ARRAY_NAME}"
+    with tiledb.open(obs_array_path) as obs:
+        schema = obs.schema
+        next_join_index = obs.meta.get("next_join_index", 0)
+        obs_df = obs.df[:]
+    is_removed = obs_df.dataset_id.isin(dataset_ids).values
+    removed_obs_idx = obs_df.obs_idx.values[is_removed]
+    obs_df = obs_df[~is_removed]
+    logger.info(f"Removing {len(dataset_ids)} datasets from the corpus, {len(obs_df)} cells remaining")
+
+    tiledb.remove(obs_array_path)
+    tiledb.Array.create(obs_array_path, schema)
+    with tiledb.open(obs_array_path, mode="w") as obs:
+        if len(obs_df) > 0:
+            coords = tuple(obs_df[dim.name].values for dim in schema.domain)
+            obs[coords] = {schema.attr(i).name: obs_df[schema.attr(i).name].values for i in range(schema.nattr)}
+        obs.meta["next_join_index"] = next_join_index
+    get_all_dataset_ids.cache_clear()
+
+    remove_obs_from_integrated_array(corpus_path, removed_obs_idx, next_join_index)
+
+
+@log_func_runtime
+def remove_obs_from_integrated_array(corpus_path: str, obs_idx: np.ndarray, n_obs_idx: int):
+    """
+    Rewrite the integrated array without the expression values of the given obs_idx (all lower than n_obs_idx, the
+    next_join_index of the obs array). TileDB arrays do not support deletes, so the array is copied in chunks, except
+    for these values, to a new array that then replaces it.
+    """
+    if len(obs_idx) == 0:
+        return
+    array_path = f"{corpus_path}/{INTEGRATED_ARRAY_NAME}"
+    rewritten_array_path = f"{array_path}_rewritten"
+    is_removed = np.zeros(n_obs_idx, dtype=bool)
+    is_removed[obs_idx] = True
+
+    n_kept, n_removed = 0, 0
+    with tiledb.open(array_path) as X:
+        tiledb.Array.create(rewritten_array_path, X.schema)
+        with tiledb.open(rewritten_array_path, mode="w") as rewritten_X:
+            for chunk in X.query(return_incomplete=True, order="U", attrs=["rankit"]).df[:]:
+                kept = ~is_removed[chunk["obs_idx"].values]
+                if kept.any():
+                    rewritten_X[chunk["obs_idx"].values[kept], chunk["var_idx"].values[kept]] = {
+                        "rankit": chunk["rankit"].values[kept]
+                    }
+                n_kept += int(kept.sum())
+                n_removed += len(kept) - int(kept.sum())
+    logger.info(f"Removed {n_removed} expression values from the integrated array, {n_kept} remaining")
+
+    tiledb.remove(array_path)
+    tiledb.move(rewritten_array_path, array_path)
+
+
+def update_corpus_axis(
+    df: pd.DataFrame, array_name: str, label_info: List, starting_join_index: Optional[int] = None
+) -> int:
+    """
+    Safely add given dataframe to extend the specified array with the appropriate encoding
+    typically used to update integrated_corpus obs/var frames for each new dataset.
+    If starting_join_index is given, the rows are written to that previously reserved range, and the array's
+    next_join_index is left unchanged.
+    """
+    reserved = starting_join_index is not None
+    if not reserved:
+        with tiledb.open(array_name) as array:
+            starting_join_index = array.meta.get("next_join_index", 0)
 
     with tiledb.open(array_name, mode="w") as array:
         data = {}
@@ -90,5 +205,6 @@ def update_corpus_axis(df: pd.DataFrame, array_name: str, label_info: List) -> i
             else:
                 data[lbl.key] = datum
         array[tuple(coords)] = data
-        array.meta["next_join_index"] = starting_join_index + len(coords[0])
+        if not reserved:
+            array.meta["next_join_index"] = starting_join_index + len(coords[0])
     return starting_join_index
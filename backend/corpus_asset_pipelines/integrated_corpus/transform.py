@@ -1,11 +1,11 @@
 import gc
 import logging
 import time
+from typing import Optional
 
 import anndata
 import numpy
 import numpy as np
-import scanpy
 import tiledb
 from scipy import sparse
 from scipy.sparse import csr_matrix, coo_matrix
@@ -26,39 +26,73 @@ logging.basicConfig(level=logging.INFO)
 def apply_pre_concatenation_filters(
     anndata_object: anndata.AnnData, min_genes: int = GENE_EXPRESSION_COUNT_MIN_THRESHOLD
 ) -> anndata.AnnData:
+    return anndata_object[compute_pre_concatenation_filter_mask(anndata_object, min_genes)].copy()
+
+
+def compute_pre_concatenation_filter_mask(
+    anndata_object: anndata.AnnData, min_genes: int = GENE_EXPRESSION_COUNT_MIN_THRESHOLD
+) -> np.ndarray:
+    """
+    Returns the mask of the cells that pass the pre-concatenation filters. The anndata_object may be opened in backed
+    mode, as its X is read in blocks of rows.
+    """
     # Filter out cells with low coverage (less than GENE_EXPRESSION_COUNT_MIN_THRESHOLD unique genes expressed)
-    scanpy.pp.filter_cells(anndata_object, min_genes=min_genes)
+    n_genes = np.zeros(anndata_object.n_obs, dtype=np.int64)
+    stride = rows_per_block(anndata_object.n_vars)
+    for start in range(0, anndata_object.n_obs, stride):
+        end = min(start + stride, anndata_object.n_obs)
+        n_genes[start:end] = np.diff((sparse.csr_matrix(anndata_object.X[start:end, :]) > 0).indptr)
 
     # Filter out cells generated by assays that dont provide gene length normalization
     included_assay_ontology_ids = list(INCLUDED_ASSAYS.keys())
-    anndata_object = anndata_object[
-        anndata_object.obs["assay_ontology_term_id"].isin(included_assay_ontology_ids), :
-    ].copy()
-    return anndata_object
+    return (n_genes >= min_genes) & anndata_object.obs["assay_ontology_term_id"].isin(
+        included_assay_ontology_ids
+    ).values
+
+
+def rows_per_block(n_vars: int) -> int:
+    """
+    Number of rows of an expression matrix that are read and transformed at a time
+    """
+    return max(int(np.power(10, np.around(np.log10(1e9 / max(n_vars, 1))))), 10_000)
 
 
 def transform_dataset_raw_counts_to_rankit(
-    anndata_object: anndata.AnnData, corpus_path: str, global_var_index: numpy.ndarray, first_obs_idx: int
+    anndata_object: anndata.AnnData,
+    corpus_path: str,
+    global_var_index: numpy.ndarray,
+    first_obs_idx: int,
+    obs_mask: Optional[np.ndarray] = None,
+    rankit_max_workers: Optional[int] = None,
 ):
     """
-    Apply rankit normalization to raw count expression values and save to the tiledb corpus object
+    Apply rankit normalization to raw count expression values and save to the tiledb corpus object.
+    The raw counts are read in blocks of rows, so the anndata_object may be opened in backed mode. If obs_mask is
+    given, only the rows it selects are saved, from first_obs_idx. rankit runs on rankit_max_workers threads.
     """
     array_name = f"{corpus_path}/{INTEGRATED_ARRAY_NAME}"
     expression_matrix = get_X_raw(anndata_object)
-    stride = max(int(np.power(10, np.around(np.log10(1e9 / expression_matrix.shape[1])))), 10_000)
+    stride = rows_per_block(expression_matrix.shape[1])
+    n_saved_rows = 0
     with tiledb.open(array_name, mode="w") as array:
         for start in range(0, expression_matrix.shape[0], stride):
             end = min(start + stride, expression_matrix.shape[0])
             raw_expression_csr_matrix = sparse.csr_matrix(expression_matrix[start:end, :])
+            if obs_mask is not None:
+                raw_expression_csr_matrix = raw_expression_csr_matrix[obs_mask[start:end]]
+            block_first_row = n_saved_rows
+            n_saved_rows += raw_expression_csr_matrix.shape[0]
+            if raw_expression_csr_matrix.nnz == 0:
+                continue
 
             # Compute RankIt
-            rankit_integrated_csr_matrix = rankit(raw_expression_csr_matrix)
+            rankit_integrated_csr_matrix = rankit(raw_expression_csr_matrix, max_workers=rankit_max_workers)
 
             rankit_integrated_coo_matrix = filter_out_rankits_with_low_expression_counts(
                 rankit_integrated_csr_matrix, raw_expression_csr_matrix, expect_majority_filtered=True
             )
 
-            global_rows = rankit_integrated_coo_matrix.row + start + first_obs_idx
+            global_rows = rankit_integrated_coo_matrix.row + block_first_row + first_obs_idx
             global_cols = global_var_index[rankit_integrated_coo_matrix.col]
 
             rankit_data = rankit_integrated_coo_matrix.data
@@ -2,6 +2,7 @@ import logging
 import os
 
 import anndata
+import h5py
 from scipy import sparse
 
 from backend.corpus_asset_pipelines.integrated_corpus.extract import get_X_raw
@@ -34,10 +35,24 @@ def get_dataset_id(h5ad_path: str) -> str:
 
 def validate_dataset_properties(anndata_object: anndata.AnnData) -> bool:
     expression_matrix = get_X_raw(anndata_object)
-    if not sparse.issparse(expression_matrix):
+    return _validate_properties(sparse.issparse(expression_matrix), anndata_object.uns.get("schema_version", None))
+
+
+def validate_backed_dataset_properties(backed_anndata_object: anndata.AnnData) -> bool:
+    """
+    Same as validate_dataset_properties, for an AnnData object opened in backed mode, without reading its expression
+    matrices
+    """
+    raw_expression_matrix_key = "raw/X" if "raw" in backed_anndata_object.file else "X"
+    # sparse matrices are stored as h5 groups (of data, indices and indptr datasets), and dense matrices as datasets
+    is_sparse = isinstance(backed_anndata_object.file[raw_expression_matrix_key], h5py.Group)
+    return _validate_properties(is_sparse, backed_anndata_object.uns.get("schema_version", None))
+
+
+def _validate_properties(is_sparse: bool, schema_version: str) -> bool:
+    if not is_sparse:
         logger.warning("No dense handling yet, not loading")
         return False
-    schema_version = anndata_object.uns.get("schema_version", None)
     if not schema_version:
         logger.warning("Unknown schema, not loading")
         return False
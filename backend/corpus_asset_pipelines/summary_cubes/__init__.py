@@ -7,19 +7,30 @@ from backend.corpora.common.utils.slack import (
 )
 
 from backend.corpus_asset_pipelines.summary_cubes.expression_summary.job import create_expression_summary_cube
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import update_expression_summary_partials
 from backend.wmg.data.validation.validation import Validation
 from backend.corpus_asset_pipelines.summary_cubes.cell_count import create_cell_count_cube
+from backend.corpus_asset_pipelines.summary_cubes.term_id_codes import create_term_id_codes
+from backend.corpus_asset_pipelines.summary_cubes.filter_dimensions_index import create_filter_dimensions_index
 
 
 def run(corpus_path: str, validate_cube: bool):
     """
     Build expression summary cube and cell count cube based
-    on cell data stored in integrated corpus
+    on cell data stored in integrated corpus, and the filter
+    dimensions index based on the cell count cube
     validate expression summary cube based on biological expectations
     if indicated by param
+    The expression data is only reduced for the datasets that have no
+    expression summary partial yet, e.g. the datasets added since the
+    snapshot that the partials were copied from; the cubes are then
+    recomposed from the partials
     """
-    create_expression_summary_cube(corpus_path)
-    create_cell_count_cube(corpus_path)
+    term_id_codes = create_term_id_codes(corpus_path)
+    update_expression_summary_partials(corpus_path)
+    create_expression_summary_cube(corpus_path, term_id_codes)
+    create_cell_count_cube(corpus_path, term_id_codes)
+    create_filter_dimensions_index(corpus_path)
     if validate_cube:
         if Validation(corpus_path).validate_cube() is False:
             pipeline_failure_message = gen_wmg_pipeline_failure_message(
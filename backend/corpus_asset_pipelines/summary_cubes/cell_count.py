@@ -1,12 +1,22 @@
 import logging
 
+import numpy as np
 import pandas as pd
 import tiledb
 
-from backend.wmg.data.schemas.corpus_schema import OBS_ARRAY_NAME
-from backend.wmg.data.schemas.cube_schema import cell_counts_schema
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import (
+    extract_partial_groups,
+    list_partials,
+)
+from backend.wmg.data.schemas.cube_schema import (
+    cell_counts_schema,
+    cell_counts_indexed_dims,
+    cell_counts_logical_dims,
+    cell_counts_non_indexed_dims,
+)
 from backend.wmg.data.snapshot import CELL_COUNTS_CUBE_NAME
-from backend.wmg.data.utils import create_empty_cube, log_func_runtime
+from backend.wmg.data.term_id_codes import TermIdCodes
+from backend.wmg.data.utils import create_empty_cube, get_all_dataset_ids, log_func_runtime
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -14,53 +24,53 @@ logging.basicConfig(level=logging.INFO)
 
 def extract(corpus_path: str) -> pd.DataFrame:
     """
-    get obs data from integrated corpus
+    get the groups of the expression summary partials of the datasets in the integrated corpus
     """
-    return tiledb.open(f"{corpus_path}/{OBS_ARRAY_NAME}")
+    partial_dataset_ids = set(list_partials(corpus_path))
+    return pd.concat(
+        [
+            extract_partial_groups(corpus_path, dataset_id)
+            for dataset_id in get_all_dataset_ids(corpus_path)
+            if dataset_id in partial_dataset_ids
+        ],
+        ignore_index=True,
+    )
 
 
-def transform(obs: pd.DataFrame) -> pd.DataFrame:
+def transform(groups: pd.DataFrame) -> pd.DataFrame:
     """
-    Create cell count cube data frame by grouping data in the
-    integrated corpus obs arrays on relevant features
+    Create cell count cube data frame by summing the cell counts of the
+    expression summary partials' groups on relevant features
     """
-    df = (
-        obs.df[:]
-        .groupby(
-            by=[
-                "dataset_id",
-                "cell_type_ontology_term_id",
-                "tissue_ontology_term_id",
-                "assay_ontology_term_id",
-                "development_stage_ontology_term_id",
-                "disease_ontology_term_id",
-                "ethnicity_ontology_term_id",
-                "sex_ontology_term_id",
-                "organism_ontology_term_id",
-            ],
-            as_index=False,
-        )
-        .size()
-    ).rename(columns={"size": "n_cells"})
+    df = groups.groupby(by=cell_counts_logical_dims, as_index=False)["n_cells"].sum()
     return df
 
 
-def load(corpus_path: str, df: pd.DataFrame) -> str:
+def load(corpus_path: str, df: pd.DataFrame, term_id_codes: TermIdCodes) -> str:
     """
-    write cell count cube to disk
+    write cell count cube to disk, with term ids replaced by their codes
     """
     uri = f"{corpus_path}/{CELL_COUNTS_CUBE_NAME}"
     create_empty_cube(uri, cell_counts_schema)
-    tiledb.from_pandas(uri, df, mode="append")
+    dims = [term_id_codes.encode_array(dim_name, df[dim_name].values) for dim_name in cell_counts_indexed_dims]
+    vals = {
+        **{
+            dim_name: term_id_codes.encode_array(dim_name, df[dim_name].values)
+            for dim_name in cell_counts_non_indexed_dims
+        },
+        "n_cells": df["n_cells"].values.astype(np.uint32),
+    }
+    with tiledb.open(uri, "w") as cube:
+        cube[tuple(dims)] = vals
     return uri
 
 
 @log_func_runtime
-def create_cell_count_cube(corpus_path: str):
+def create_cell_count_cube(corpus_path: str, term_id_codes: TermIdCodes):
     """
     Create cell count cube and write to disk
     """
-    obs = extract(corpus_path)
-    df = transform(obs)
-    uri = load(corpus_path, df)
+    groups = extract(corpus_path)
+    df = transform(groups)
+    uri = load(corpus_path, df, term_id_codes)
     logger.info(f"Cell count cube created and stored at {uri}")
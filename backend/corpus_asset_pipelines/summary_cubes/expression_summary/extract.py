@@ -1,7 +1,10 @@
+from typing import Iterator, List, Optional
+
 import pandas as pd
 import tiledb
 
 from backend.wmg.data.schemas.corpus_schema import VAR_ARRAY_NAME, OBS_ARRAY_NAME
+from backend.wmg.data.utils import get_all_dataset_ids
 
 
 def extract_var_data(tdb_group: str, ctx: tiledb.Ctx) -> list:
@@ -14,16 +17,25 @@ def extract_var_data(tdb_group: str, ctx: tiledb.Ctx) -> list:
         return gene_ontology_term_ids
 
 
-def extract_obs_data(tdb_group: str, cube_dims: list) -> pd.DataFrame:
+def extract_obs_data(
+    tdb_group: str, cube_dims: list, dataset_ids: Optional[List[str]] = None
+) -> Iterator[pd.DataFrame]:
     """
-    Extract obs (cell) data from the concatenated corpus
+    Extract obs (cell) data from the concatenated corpus, in batches of the cells of one dataset (of each of the given
+    datasets if dataset_ids is given). Only the obs_idx and the cube dimensions are read, as ascii bytes.
     """
+    if dataset_ids is None:
+        dataset_ids = get_all_dataset_ids(tdb_group)
     with tiledb.open(f"{tdb_group}/{OBS_ARRAY_NAME}") as obs:
-        cell_labels = obs.query(use_arrow=False).df[:]
-    cell_labels.sort_values(by=["obs_idx"], inplace=True, ignore_index=True)
-
-    cell_labels = pd.DataFrame(
-        data={k: cell_labels[k].astype("category") for k in cube_dims},
-        index=cell_labels.obs_idx,
-    )
-    return cell_labels
+        dim_names = [obs.schema.domain.dim(i).name for i in range(obs.schema.domain.ndim)]
+        columns = ["obs_idx"] + cube_dims
+        query = obs.query(
+            dims=[column for column in columns if column in dim_names],
+            attrs=[column for column in columns if column not in dim_names],
+            use_arrow=False,
+        )
+        # dataset_id is a dimension of the obs array, so the cells of a dataset are read as a range of it. The
+        # batches are not read as the incomplete results of a single query, because TileDB-Py does not decode the
+        # incomplete results of string columns that are all empty.
+        for dataset_id in dataset_ids:
+            yield query.df[dataset_id:dataset_id]
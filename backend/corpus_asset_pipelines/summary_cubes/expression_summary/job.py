@@ -1,34 +1,25 @@
 import logging
 
-import numpy as np
-import pandas as pd
 import tiledb
 
-from backend.corpus_asset_pipelines.summary_cubes.expression_summary.extract import extract_var_data
-from backend.corpus_asset_pipelines.summary_cubes.expression_summary.load import build_in_mem_cube
-from backend.corpus_asset_pipelines.summary_cubes.expression_summary.transform import transform
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.load import CubeWriter, build_in_mem_cube
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import (
+    extract_partial,
+    list_partials,
+    regroup_partial,
+)
 from backend.wmg.data.schemas.cube_schema import expression_summary_schema
 from backend.wmg.data.snapshot import EXPRESSION_SUMMARY_CUBE_NAME
+from backend.wmg.data.term_id_codes import TermIdCodes
 from backend.wmg.data.tiledb import create_ctx
-from backend.wmg.data.utils import log_func_runtime, create_empty_cube
+from backend.wmg.data.utils import get_all_dataset_ids, log_func_runtime, create_empty_cube
 from backend.wmg.data.schemas.cube_schema import cube_non_indexed_dims, cube_indexed_dims_no_gene_ontology
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def _load(
-    uri: str, gene_ontology_term_ids: list, cube_index: pd.DataFrame, cube_sum: np.ndarray, cube_nnz: np.ndarray
-) -> (list, dict):
-    """
-    Build expression summary cube in memory and write to disk
-    """
-    dims, vals = build_in_mem_cube(gene_ontology_term_ids, cube_index, cube_non_indexed_dims, cube_sum, cube_nnz)
-
-    logger.debug("Saving cube to tiledb")
-    with tiledb.open(uri, "w") as cube:
-        cube[tuple(dims)] = vals
-
+def _consolidate(uri: str):
     logger.debug("Cube created, start consolidation")
     tiledb.consolidate(uri)
 
@@ -37,9 +28,11 @@ def _load(
 
 
 @log_func_runtime
-def create_expression_summary_cube(corpus_path: str):
+def create_expression_summary_cube(corpus_path: str, term_id_codes: TermIdCodes):
     """
-    Create queryable cube and write to disk
+    Create queryable cube and write to disk. The cube is recomposed from the partials of the datasets of the corpus
+    (see update_expression_summary_partials), without reading the expression data. The cube rows are written in
+    batches of a bounded number of cells (see CubeWriter), which bounds the memory used to write the cube.
     """
     uri = f"{corpus_path}/{EXPRESSION_SUMMARY_CUBE_NAME}"
     ctx = create_ctx()
@@ -49,9 +42,16 @@ def create_expression_summary_cube(corpus_path: str):
         # Create cube
         create_empty_cube(uri, expression_summary_schema)
 
-        # extract data
-        gene_ontology_term_ids = extract_var_data(corpus_path, ctx)
-
-        # transform
-        cube_index, cube_sum, cube_nnz = transform(corpus_path, gene_ontology_term_ids, cube_dims)
-        _load(uri, gene_ontology_term_ids, cube_index, cube_sum, cube_nnz)
+        # the datasets whose cells are all excluded from the cube have no partial
+        partial_dataset_ids = set(list_partials(corpus_path))
+        with tiledb.open(uri, "w") as cube:
+            writer = CubeWriter(cube)
+            for dataset_id in get_all_dataset_ids(corpus_path):
+                if dataset_id not in partial_dataset_ids:
+                    continue
+                partial = regroup_partial(extract_partial(corpus_path, dataset_id), cube_dims)
+                writer.append(*build_in_mem_cube(partial, cube_non_indexed_dims, term_id_codes))
+            writer.flush()
+        logger.info(f"Wrote the expression summary cube in {writer.n_writes} batches")
+
+        _consolidate(uri)
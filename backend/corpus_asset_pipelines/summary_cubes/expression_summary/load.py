@@ -1,68 +1,89 @@
 import logging
 
 import numpy as np
-import pandas as pd
+import tiledb
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import Partial
+from backend.wmg.data.term_id_codes import TermIdCodes
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Number of cube cells written to the cube per TileDB write (i.e. per fragment). With 10 uint32 dimensions and codes,
+# and the uint64 nnz, this bounds the write buffers to ~112MB.
+WRITE_BATCH_CELLS = 2**21
+
 
-def build_in_mem_cube(
-    gene_ids: pd.DataFrame, cube_index: pd.DataFrame, other_cube_attrs: list, cube_sum: np.ndarray, cube_nnz: np.ndarray
-):
+def build_in_mem_cube(partial: Partial, other_cube_attrs: list, term_id_codes: TermIdCodes):
     """
-    Build the cube in memory, calculating the gene expression value for each combination of attributes
+    Build the cube rows of a dataset's partial in memory, one row per gene with non-zero expression for each
+    combination of attributes. Term ids are stored as their codes; the gene codes are the var_idx of the integrated
+    corpus.
     """
-    logger.info("Building in-mem cube")
+    groups, gene_ontology_term_ids, values = partial
 
-    # Count total values so we can allocate buffers once
-    total_vals = 0
-    for cube_idx in cube_index.cube_idx.values:
-        mask = cube_nnz[cube_idx] != 0
-        total_vals += np.count_nonzero(mask)
+    # encode the term ids of each group, and of each gene of the partial
+    group_codes = {
+        dim_name: term_id_codes.encode_array(dim_name, groups[dim_name].values)
+        for dim_name in groups.columns
+        if dim_name != "n_cells"
+    }
+    gene_codes = term_id_codes.encode_array("gene_ontology_term_id", gene_ontology_term_ids)
 
-    # allocate buffers
+    group_idx = values.group_idx.values
     dims = [
-        np.empty((total_vals,), dtype=object),
-        np.empty((total_vals,), dtype=object),
-        np.empty((total_vals,), dtype=object),
+        gene_codes[values.gene_idx.values],
+        group_codes["tissue_ontology_term_id"][group_idx],
+        group_codes["organism_ontology_term_id"][group_idx],
     ]
     vals = {
-        "sum": np.empty((total_vals,)),
-        "nnz": np.empty((total_vals,), dtype=np.uint64),
-        "n_cells": np.empty((total_vals,), dtype=np.uint32),
-        **{k: np.empty((total_vals,), dtype=object) for k in other_cube_attrs},
+        "sum": values["sum"].values,
+        "nnz": values["nnz"].values.astype(np.uint64),
+        "n_cells": groups.n_cells.values.astype(np.uint32)[group_idx],
+        **{k: group_codes[k][group_idx] for k in other_cube_attrs},
     }
+    return dims, vals
 
-    # populate buffers
-    idx = 0
-
-    for grp in cube_index.to_records():
-        (
-            tissue_ontology_term_id,
-            organism_ontology_term_id,
-            *attr_values,
-            n,
-            cube_idx,
-        ) = grp.tolist()
-        mask = cube_nnz[cube_idx] != 0
-        n_vals = np.count_nonzero(mask)
-        if n_vals == 0:  # Used to maintain sparsity
-            continue
-
-        logger.debug(grp)
-
-        dims[0][idx : idx + n_vals] = gene_ids.gene_ontology_term_id.values[mask]
-        dims[1][idx : idx + n_vals] = tissue_ontology_term_id
-        dims[2][idx : idx + n_vals] = organism_ontology_term_id
 
-        vals["sum"][idx : idx + n_vals] = cube_sum[cube_idx, mask]
-        vals["nnz"][idx : idx + n_vals] = cube_nnz[cube_idx, mask]
-        vals["n_cells"][idx : idx + n_vals] = n  # wasteful
+class CubeWriter:
+    """
+    Writes cube cells to an open cube in batches of at most `batch_cells` cells. The cells are copied into buffers
+    typed like the cube's dimensions and attributes, so the cells of consecutive partials are written together, and the
+    cells of a large partial are split across several writes.
+    """
 
-        for i, k in enumerate(other_cube_attrs):
-            vals[k][idx : idx + n_vals] = attr_values[i]
+    def __init__(self, cube: tiledb.SparseArray, batch_cells: int = WRITE_BATCH_CELLS):
+        schema = cube.schema
+        self.cube = cube
+        self.batch_cells = batch_cells
+        self.dim_buffers = [np.empty(batch_cells, dtype=schema.domain.dim(i).dtype) for i in range(schema.domain.ndim)]
+        self.attr_buffers = {
+            schema.attr(i).name: np.empty(batch_cells, dtype=schema.attr(i).dtype) for i in range(schema.nattr)
+        }
+        self.n_buffered = 0
+        self.n_writes = 0
 
-        idx += n_vals
+    def append(self, dims: list, vals: dict) -> None:
+        n_cells = len(dims[0])
+        start = 0
+        while start < n_cells:
+            n = min(n_cells - start, self.batch_cells - self.n_buffered)
+            buffer_slice = slice(self.n_buffered, self.n_buffered + n)
+            for buffer, dim in zip(self.dim_buffers, dims):
+                buffer[buffer_slice] = dim[start : start + n]
+            for name, buffer in self.attr_buffers.items():
+                buffer[buffer_slice] = vals[name][start : start + n]
+            self.n_buffered += n
+            start += n
+            if self.n_buffered == self.batch_cells:
+                self.flush()
 
-    return dims, vals
+    def flush(self) -> None:
+        if self.n_buffered == 0:
+            return
+        self.cube[tuple(buffer[: self.n_buffered] for buffer in self.dim_buffers)] = {
+            name: buffer[: self.n_buffered] for name, buffer in self.attr_buffers.items()
+        }
+        logger.debug(f"Wrote {self.n_buffered} cells to the cube")
+        self.n_buffered = 0
+        self.n_writes += 1
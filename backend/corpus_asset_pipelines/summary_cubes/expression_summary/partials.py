@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import tiledb
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.extract import extract_var_data
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.transform import transform as reduce_expression
+from backend.wmg.data.schemas.cube_schema import (
+    cube_indexed_dims_no_gene_ontology,
+    cube_non_indexed_dims,
+    expression_summary_partial_dims,
+    expression_summary_partial_schema,
+)
+from backend.wmg.data.term_id_codes import term_id_as_str
+from backend.wmg.data.tiledb import create_ctx
+from backend.wmg.data.utils import create_empty_cube, get_all_dataset_ids, log_func_runtime
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+EXPRESSION_SUMMARY_PARTIALS_NAME = "expression_summary_partials"
+
+# A partial: its groups (one row per combination of the cube dimensions, with its n_cells), its gene ids, and the sum
+# and nnz of each (group_idx, gene_idx) with non-zero expression
+Partial = Tuple[pd.DataFrame, List[str], pd.DataFrame]
+
+
+def partials_path(corpus_path: str) -> str:
+    return f"{corpus_path}/{EXPRESSION_SUMMARY_PARTIALS_NAME}"
+
+
+def list_partials(corpus_path: str) -> List[str]:
+    """
+    The ids of the datasets that have a partial
+    """
+    path = partials_path(corpus_path)
+    return sorted(os.listdir(path)) if os.path.isdir(path) else []
+
+
+def extract(
+    corpus_path: str, dataset_ids: List[str], ctx: tiledb.Ctx, max_accumulator_bytes: Optional[int] = None
+) -> (pd.DataFrame, Iterator[Tuple[pd.DataFrame, np.ndarray, np.ndarray]]):
+    """
+    Reduce the expression data of the given datasets, by cube row and gene, in chunks of cube rows
+    """
+    cube_dims = cube_indexed_dims_no_gene_ontology + cube_non_indexed_dims
+    gene_ontology_term_ids = extract_var_data(corpus_path, ctx)
+    reduced_chunks = reduce_expression(
+        corpus_path, gene_ontology_term_ids, cube_dims, dataset_ids, max_accumulator_bytes
+    )
+    return gene_ontology_term_ids, reduced_chunks
+
+
+def transform(
+    gene_ontology_term_ids: pd.DataFrame, reduced_chunks: Iterator[Tuple[pd.DataFrame, np.ndarray, np.ndarray]]
+) -> Iterator[Tuple[str, Partial]]:
+    """
+    Convert the chunks of reduced expression data into the partial of each dataset, keeping only the (group, gene)
+    cells with non-zero expression. The chunks are ordered by dataset, and a dataset's cube rows may span several
+    chunks, so a dataset's partial is yielded once the chunks of the next dataset start.
+    """
+    # the gene codes of the integrated corpus, i.e. the columns of the reduced chunks, are the var_idx
+    gene_ids = np.array(
+        [term_id_as_str(gene_id) for gene_id in gene_ontology_term_ids.gene_ontology_term_id], dtype=object
+    )
+
+    dataset_id, pieces = None, []
+    for cube_index, cube_sum, cube_nnz in reduced_chunks:
+        groups = cube_index.index.to_frame(index=False)
+        for dim_name in groups.columns:
+            groups[dim_name] = [term_id_as_str(term_id) for term_id in groups[dim_name]]
+        groups["n_cells"] = cube_index.n.values
+        cube_idx = cube_index.cube_idx.values
+
+        for chunk_dataset_id, dataset_groups in groups.groupby("dataset_id", sort=False):
+            if chunk_dataset_id != dataset_id:
+                if pieces:
+                    yield dataset_id, _merge_pieces(pieces, gene_ids)
+                dataset_id, pieces = chunk_dataset_id, []
+            rows = cube_idx[dataset_groups.index.values]
+            group_idx, gene_codes = np.nonzero(cube_nnz[rows])
+            pieces.append(
+                (
+                    dataset_groups.reset_index(drop=True),
+                    gene_codes,
+                    pd.DataFrame(
+                        {
+                            "group_idx": group_idx.astype(np.uint32),
+                            "sum": cube_sum[rows[group_idx], gene_codes],
+                            "nnz": cube_nnz[rows[group_idx], gene_codes],
+                        }
+                    ),
+                )
+            )
+    if pieces:
+        yield dataset_id, _merge_pieces(pieces, gene_ids)
+
+
+def _merge_pieces(pieces: List[Tuple[pd.DataFrame, np.ndarray, pd.DataFrame]], gene_ids: np.ndarray) -> Partial:
+    """
+    Merge the pieces of a dataset's partial, from consecutive chunks of cube rows, into its partial
+    """
+    group_offsets = np.cumsum([0] + [len(groups) for groups, _, _ in pieces[:-1]])
+    values = pd.concat(
+        [
+            piece_values.assign(group_idx=(piece_values.group_idx.values + group_offset).astype(np.uint32))
+            for (_, _, piece_values), group_offset in zip(pieces, group_offsets)
+        ],
+        ignore_index=True,
+    )
+    dataset_gene_codes, gene_idx = np.unique(
+        np.concatenate([gene_codes for _, gene_codes, _ in pieces]), return_inverse=True
+    )
+    values.insert(1, "gene_idx", gene_idx.astype(np.uint32))
+    groups = pd.concat([groups for groups, _, _ in pieces], ignore_index=True)
+    return groups, gene_ids[dataset_gene_codes].tolist(), values
+
+
+def load(corpus_path: str, dataset_id: str, partial: Partial) -> str:
+    """
+    write the partial of a dataset to disk
+    """
+    groups, gene_ids, values = partial
+    uri = f"{partials_path(corpus_path)}/{dataset_id}"
+    create_empty_cube(uri, expression_summary_partial_schema)
+    with tiledb.open(uri, "w") as array:
+        if len(values) > 0:
+            array[values.group_idx.values, values.gene_idx.values] = {
+                "sum": values["sum"].values,
+                "nnz": values["nnz"].values,
+            }
+        array.meta["groups"] = groups.to_json(orient="split", index=False)
+        array.meta["gene_ontology_term_ids"] = json.dumps(gene_ids)
+    return uri
+
+
+def extract_partial(corpus_path: str, dataset_id: str) -> Partial:
+    """
+    read the partial of a dataset from disk
+    """
+    with tiledb.open(f"{partials_path(corpus_path)}/{dataset_id}") as array:
+        groups = pd.read_json(array.meta["groups"], orient="split", dtype=False)
+        gene_ids = json.loads(array.meta["gene_ontology_term_ids"])
+        values = array.df[:]
+    return groups, gene_ids, values
+
+
+def extract_partial_groups(corpus_path: str, dataset_id: str) -> pd.DataFrame:
+    """
+    read the groups of the partial of a dataset from disk
+    """
+    with tiledb.open(f"{partials_path(corpus_path)}/{dataset_id}") as array:
+        return pd.read_json(array.meta["groups"], orient="split", dtype=False)
+
+
+def extract_partial_gene_ids_by_organism(corpus_path: str, dataset_id: str) -> Dict[str, List[str]]:
+    """
+    read the gene ids of the partial of a dataset from disk, grouped by the organism of the groups that express them.
+    The values of the partial are only read when its groups are of several organisms.
+    """
+    with tiledb.open(f"{partials_path(corpus_path)}/{dataset_id}") as array:
+        organisms = pd.read_json(array.meta["groups"], orient="split", dtype=False).organism_ontology_term_id.values
+        gene_ids = np.array(json.loads(array.meta["gene_ontology_term_ids"]), dtype=object)
+        if len(set(organisms)) <= 1:
+            return {organisms[0]: gene_ids.tolist()} if len(organisms) > 0 and len(gene_ids) > 0 else {}
+        values = array.query(attrs=[], dims=expression_summary_partial_dims).df[:]
+
+    organism_genes = pd.DataFrame(
+        {"organism": organisms[values.group_idx.values], "gene_idx": values.gene_idx.values}
+    ).drop_duplicates()
+    return {
+        organism: gene_ids[np.sort(gene_idx.values)].tolist()
+        for organism, gene_idx in organism_genes.groupby("organism").gene_idx
+    }
+
+
+def regroup_partial(partial: Partial, cube_dims: List[str]) -> Partial:
+    """
+    Aggregate the groups of a partial by the given cube dimensions, which allows cubes with fewer dimensions than the
+    partials to be recomposed without reducing the expression data again
+    """
+    groups, gene_ids, values = partial
+    missing_dims = set(cube_dims) - set(groups.columns)
+    if missing_dims:
+        raise ValueError(f"The partial has no {missing_dims} dimensions, the expression data must be reduced again")
+    if set(groups.columns) == {*cube_dims, "n_cells"}:
+        return partial
+
+    group_mapping = groups.groupby(cube_dims, sort=False).ngroup().values.astype(np.uint32)
+    groups = groups.groupby(cube_dims, as_index=False, sort=False)["n_cells"].sum()
+    values = (
+        values.assign(group_idx=group_mapping[values.group_idx.values])
+        .groupby(["group_idx", "gene_idx"], as_index=False)
+        .agg({"sum": "sum", "nnz": "sum"})
+    )
+    return groups, gene_ids, values
+
+
+@log_func_runtime
+def update_expression_summary_partials(
+    corpus_path: str, max_accumulator_bytes: Optional[int] = None
+) -> (List[str], List[str]):
+    """
+    Reduce the expression data of the datasets of the corpus that have no partial yet, and delete the partials of the
+    datasets that are no longer in the corpus. Returns the ids of the added and removed partials.
+    Each partial is written as soon as its dataset is reduced, so only the reduction accumulators of a chunk of cube
+    rows (see transform of expression_summary.transform) and the non-zero values of a dataset are held in memory.
+    """
+    corpus_dataset_ids = set(get_all_dataset_ids(corpus_path))
+    partial_dataset_ids = set(list_partials(corpus_path))
+    added_dataset_ids = sorted(corpus_dataset_ids - partial_dataset_ids)
+    removed_dataset_ids = sorted(partial_dataset_ids - corpus_dataset_ids)
+    logger.info(
+        f"Creating {len(added_dataset_ids)} and deleting {len(removed_dataset_ids)} expression summary partials"
+    )
+
+    for dataset_id in removed_dataset_ids:
+        shutil.rmtree(f"{partials_path(corpus_path)}/{dataset_id}")
+
+    if added_dataset_ids:
+        ctx = create_ctx()
+        with tiledb.scope_ctx(ctx):
+            os.makedirs(partials_path(corpus_path), exist_ok=True)
+            reduced = extract(corpus_path, added_dataset_ids, ctx, max_accumulator_bytes)
+            for dataset_id, partial in transform(*reduced):
+                load(corpus_path, dataset_id, partial)
+    return added_dataset_ids, removed_dataset_ids
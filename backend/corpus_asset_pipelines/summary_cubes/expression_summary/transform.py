@@ -1,5 +1,9 @@
-import concurrent
+import concurrent.futures
+import itertools
 import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numba as nb
 import numpy as np
@@ -10,53 +14,122 @@ import tiledb
 from backend.corpora.common.utils.math_utils import MB
 from backend.corpus_asset_pipelines.summary_cubes.expression_summary.extract import extract_obs_data
 
-from backend.wmg.data.schemas.corpus_schema import INTEGRATED_ARRAY_NAME
-from backend.wmg.data.tiledb import create_ctx
+from backend.wmg.data.schemas.corpus_schema import INTEGRATED_ARRAY_NAME, OBS_ARRAY_NAME
+from backend.wmg.data.tiledb import create_ctx, virtual_memory_size
 from backend.wmg.data.utils import log_func_runtime
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Fraction of the host memory that the dense sum and nnz accumulators of a chunk of cube rows may take
+ACCUMULATOR_VM_FRACTION = 0.25
+ACCUMULATOR_BYTES_PER_VALUE = np.dtype(np.float32).itemsize + np.dtype(np.uint64).itemsize
+
+# cube_idx of the obs_idx that are not reduced, while the cube index is built
+UNREDUCED_CUBE_IDX = np.iinfo(np.uint32).max
+
+# Total size of the read buffers of the concurrent queries of reduce_X, and the minimum size for each query
+REDUCE_X_READ_BUFFER_BYTES = 512 * MB
+REDUCE_X_MIN_READ_BUFFER_BYTES = 64 * MB
+
 
 def transform(
-    corpus_path: str, gene_ontology_term_ids: list, cube_dims: list
-) -> (pd.DataFrame, np.ndarray, np.ndarray):
+    corpus_path: str,
+    gene_ontology_term_ids: list,
+    cube_dims: list,
+    dataset_ids: Optional[List[str]] = None,
+    max_accumulator_bytes: Optional[int] = None,
+) -> Iterator[Tuple[pd.DataFrame, np.ndarray, np.ndarray]]:
     """
     Build the summary cube with rankit expression sum, nnz (num cells with non zero expression) values for
-    each gene for each possible group of cell attributes (cube row)
+    each gene for each possible group of cell attributes (cube row).
+    If dataset_ids is given, only the cells of these datasets are reduced.
+    The cube rows are reduced in chunks, so that the dense sum and nnz accumulators of a chunk take at most
+    max_accumulator_bytes (but hold at least one cube row). The cube rows are ordered by dataset, and only the
+    expression data of the datasets of a chunk is read to reduce it. Each chunk's cube index, with its cube_idx
+    renumbered from 0, is yielded with its accumulators.
     """
 
-    cell_labels, cube_index = make_cube_index(corpus_path, cube_dims)
-    n_groups = len(cube_index)
+    cube_index, cube_indices, obs_idx_ranges = make_cube_index(corpus_path, cube_dims, dataset_ids)
     n_genes = len(gene_ontology_term_ids)
-
-    cube_sum = np.zeros((n_groups, n_genes), dtype=np.float32)
-    cube_nnz = np.zeros((n_groups, n_genes), dtype=np.uint64)
-
-    reduce_X(corpus_path, cell_labels.cube_idx.values, cube_sum, cube_nnz)
-    return cube_index, cube_sum, cube_nnz
+    if max_accumulator_bytes is None:
+        max_accumulator_bytes = virtual_memory_size(ACCUMULATOR_VM_FRACTION)
+    chunk_size = max(1, max_accumulator_bytes // (max(n_genes, 1) * ACCUMULATOR_BYTES_PER_VALUE))
+
+    cube_index = cube_index.sort_index(level="dataset_id", sort_remaining=False)
+    for start in range(0, len(cube_index), chunk_size):
+        chunk = cube_index.iloc[start : start + chunk_size]
+        logger.info(f"reduce cube rows {start} to {start + len(chunk)} of {len(cube_index)}")
+
+        # maps the cube_idx of the chunk's rows to their position in the chunk, and every other cube_idx (as well as
+        # the len(cube_index) of the obs_idx that are not reduced, which index the last element) to -1
+        chunk_positions = np.full(len(cube_index) + 1, -1, dtype=np.int32)
+        chunk_positions[chunk.cube_idx.values] = np.arange(len(chunk))
+
+        cube_sum = np.zeros((len(chunk), n_genes), dtype=np.float32)
+        cube_nnz = np.zeros((len(chunk), n_genes), dtype=np.uint64)
+        chunk_dataset_ids = chunk.index.get_level_values("dataset_id").unique()
+        reduce_X(
+            corpus_path,
+            chunk_positions[cube_indices],
+            cube_sum,
+            cube_nnz,
+            [obs_idx_ranges[dataset_id] for dataset_id in chunk_dataset_ids],
+        )
+        yield chunk.assign(cube_idx=np.arange(len(chunk))), cube_sum, cube_nnz
 
 
 @log_func_runtime
-def reduce_X(tdb_group: str, cube_indices: np.ndarray, cube_sum: np.ndarray, cube_nnz: np.ndarray):
+def reduce_X(
+    tdb_group: str,
+    cube_indices: np.ndarray,
+    cube_sum: np.ndarray,
+    cube_nnz: np.ndarray,
+    obs_idx_ranges: Optional[List[Tuple[int, int]]] = None,
+    max_workers: Optional[int] = None,
+):
     """
     Reduce the expression data stored in the integrated corpus by summing it by gene for each cube row (unique combo
-    of cell attributes)
+    of cell attributes). If obs_idx_ranges is given, only the expression data of the cells in these (inclusive) ranges
+    is read.
+    The genes are partitioned into ranges of whole var_idx tiles of the integrated array, which up to max_workers
+    threads read and reduce concurrently. Each thread only writes the columns of its own genes into cube_sum and
+    cube_nnz, so the accumulators are shared without locking, and the reads of some threads overlap with the
+    reduction of others.
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        cfg = {
-            "py.init_buffer_bytes": 512 * MB,
-            "py.exact_init_buffer_bytes": "true",
-        }
-        with tiledb.open(f"{tdb_group}/{INTEGRATED_ARRAY_NAME}", ctx=create_ctx(config_overrides=cfg)) as expression:
+    n_genes = cube_sum.shape[1]
+    if (obs_idx_ranges is not None and len(obs_idx_ranges) == 0) or n_genes == 0:
+        return
+    max_workers = max_workers or os.cpu_count() or 1
+    # the read buffers of the concurrent queries share a budget
+    cfg = {
+        "py.init_buffer_bytes": max(REDUCE_X_MIN_READ_BUFFER_BYTES, REDUCE_X_READ_BUFFER_BYTES // max_workers),
+        "py.exact_init_buffer_bytes": "true",
+    }
+    ctx = create_ctx(config_overrides=cfg)
+    uri = f"{tdb_group}/{INTEGRATED_ARRAY_NAME}"
+    with tiledb.open(uri, ctx=ctx) as expression:
+        var_tile_extent = int(expression.schema.domain.dim("var_idx").tile)
+    n_var_tiles = -(-n_genes // var_tile_extent)
+    partition_size = -(-n_var_tiles // max_workers) * var_tile_extent
+    var_idx_ranges = [(start, min(start + partition_size, n_genes) - 1) for start in range(0, n_genes, partition_size)]
+    obs_idx_slices = slice(None) if obs_idx_ranges is None else [slice(start, end) for start, end in obs_idx_ranges]
+
+    def reduce_partition(partition: int) -> None:
+        var_idx_start, var_idx_end = var_idx_ranges[partition]
+        read_seconds, reduce_seconds = 0.0, 0.0
+        with tiledb.open(uri, ctx=ctx) as expression:
             iterable = expression.query(return_incomplete=True, order="U", attrs=["rankit"])
-            future = None
-            for i, result in enumerate(iterable.df[:]):
-                logger.info(f"reduce integrated expression data, iter {i}")
-                if future is not None:
-                    future.result()  # forces a wait
-                future = executor.submit(
-                    gene_expression_sum_x_cube_dimension,
+            results = iter(iterable.df[obs_idx_slices, slice(var_idx_start, var_idx_end)])
+            for i in itertools.count():
+                start = time.perf_counter()
+                result = next(results, None)
+                if result is None:
+                    break
+                read_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                gene_expression_sum_x_cube_dimension(
                     result["rankit"].values,
                     result["obs_idx"].values,
                     result["var_idx"].values,
@@ -64,9 +137,23 @@ def reduce_X(tdb_group: str, cube_indices: np.ndarray, cube_sum: np.ndarray, cub
                     cube_sum,
                     cube_nnz,
                 )
+                reduce_time = time.perf_counter() - start
+                logger.info(
+                    f"reduce integrated expression data, genes {var_idx_start}-{var_idx_end}, iter {i}: "
+                    f"{len(result)} values, read {read_time:.3f}s, reduce {reduce_time:.3f}s"
+                )
+                read_seconds += read_time
+                reduce_seconds += reduce_time
+        logger.info(
+            f"reduced integrated expression data, genes {var_idx_start}-{var_idx_end}: "
+            f"read {read_seconds:.3f}s, reduce {reduce_seconds:.3f}s"
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results, to raise any error
+        list(executor.map(reduce_partition, range(len(var_idx_ranges))))
 
 
-# TODO: this could be further optimize by parallel chunking.  Might help large arrays if compute ends up being a bottleneck. # noqa E501
 @nb.njit(fastmath=True, error_model="numpy", parallel=False, nogil=True)
 def gene_expression_sum_x_cube_dimension(
     rankit_values: np.ndarray,
@@ -85,23 +172,82 @@ def gene_expression_sum_x_cube_dimension(
         if np.isfinite(val):
             cidx = var_idx[k]
             grp_idx = cube_indices[obs_idxs[k]]
-            sum_into[grp_idx, cidx] += val
-            nnz_into[grp_idx, cidx] += 1
+            if grp_idx >= 0:
+                sum_into[grp_idx, cidx] += val
+                nnz_into[grp_idx, cidx] += 1
 
 
-def make_cube_index(tdb_group: str, cube_dims: list) -> (pd.DataFrame, pd.DataFrame):
+def make_cube_index(
+    tdb_group: str, cube_dims: list, dataset_ids: Optional[List[str]] = None
+) -> (pd.DataFrame, np.ndarray, Dict[str, Tuple[int, int]]):
     """
-    Create index for queryable dimensions
+    Create index for queryable dimensions, for the cells of the given datasets if dataset_ids is given.
+    The obs are read one dataset at a time (see extract_obs_data). The cube dimensions of each dataset's cells are
+    encoded to integer codes, and each new combination of codes is assigned the next cube_idx, so only the cube_idx of
+    each obs_idx is kept for all the cells. Returns:
+    - the cube index: the number of cells (n) and the cube_idx of each combination of the cube dimensions
+    - the cube_idx of each obs_idx of the integrated corpus, as a uint32 array. The obs_idx that are not reduced map
+      to len(cube_index): obs_idx may have gaps, as datasets loaded in parallel reserve obs_idx ranges sized by their
+      unfiltered cell counts, cells may be excluded from the cube index, and the obs_idx ranges of datasets removed
+      from the corpus are not reused (see remove_datasets_from_corpus)
+    - the (inclusive) obs_idx range of the cells of each dataset, which are stored in a single range of the
+      integrated corpus
     """
-    cell_labels = extract_obs_data(tdb_group, cube_dims)
-    # number of cells with specific tuple of dims
-    cube_index = pd.DataFrame(cell_labels.value_counts(), columns=["n"])
-    cube_index["cube_idx"] = range(len(cube_index))
-
-    cell_labels = cell_labels.join(cube_index.cube_idx, on=cube_dims)
-
-    # we failed to correctly create the corpus if these are false
-    assert len(cell_labels.index) == cell_labels.index[-1] + 1
-    assert cell_labels.index[0] == 0
-
-    return cell_labels, cube_index
+    dataset_id_pos = cube_dims.index("dataset_id")
+    with tiledb.open(f"{tdb_group}/{OBS_ARRAY_NAME}") as obs:
+        n_obs_idx = obs.meta.get("next_join_index", 0)
+    cube_indices = np.full(n_obs_idx, UNREDUCED_CUBE_IDX, dtype=np.uint32)
+    term_id_codes = [{} for _ in cube_dims]
+    cube_idxs, n_cells = {}, []
+    obs_idx_ranges = {}
+
+    for cell_labels in extract_obs_data(tdb_group, cube_dims, dataset_ids):
+        obs_idx = cell_labels.obs_idx.values
+        if len(obs_idx) == 0:
+            continue
+        if obs_idx.max() >= len(cube_indices):
+            cube_indices = np.concatenate(
+                [cube_indices, np.full(obs_idx.max() + 1 - len(cube_indices), UNREDUCED_CUBE_IDX, dtype=np.uint32)]
+            )
+
+        codes = np.empty((len(obs_idx), len(cube_dims)), dtype=np.uint32)
+        for i, dim_name in enumerate(cube_dims):
+            batch_codes, term_ids = pd.factorize(cell_labels[dim_name].values)
+            term_ids_codes = [term_id_codes[i].setdefault(term_id, len(term_id_codes[i])) for term_id in term_ids]
+            codes[:, i] = np.array(term_ids_codes, dtype=np.uint32)[batch_codes]
+
+        combinations, combination_idx, combination_n_cells = np.unique(
+            codes, axis=0, return_inverse=True, return_counts=True
+        )
+        combination_cube_idx = np.empty(len(combinations), dtype=np.uint32)
+        for i, (combination, n) in enumerate(zip(map(tuple, combinations.tolist()), combination_n_cells.tolist())):
+            cube_idx = cube_idxs.setdefault(combination, len(cube_idxs))
+            if cube_idx == len(n_cells):
+                n_cells.append(0)
+            n_cells[cube_idx] += n
+            combination_cube_idx[i] = cube_idx
+        # we failed to correctly create the corpus if this is false
+        assert (cube_indices[obs_idx] == UNREDUCED_CUBE_IDX).all()
+        cube_indices[obs_idx] = combination_cube_idx[combination_idx]
+
+        obs_idx_min_max = pd.Series(obs_idx).groupby(codes[:, dataset_id_pos]).agg(["min", "max"])
+        for code, start, end in obs_idx_min_max.itertuples(index=True):
+            if code in obs_idx_ranges:
+                start, end = min(start, obs_idx_ranges[code][0]), max(end, obs_idx_ranges[code][1])
+            obs_idx_ranges[code] = (int(start), int(end))
+
+    term_ids = [np.array(list(codes), dtype=object) for codes in term_id_codes]
+    combinations = np.array(list(cube_idxs), dtype=np.uint32).reshape(len(cube_idxs), len(cube_dims))
+    cube_index = pd.DataFrame(
+        {"n": np.array(n_cells, dtype=np.int64), "cube_idx": np.arange(len(cube_idxs))},
+        index=pd.MultiIndex.from_arrays(
+            [term_ids[i][combinations[:, i]] for i in range(len(cube_dims))], names=cube_dims
+        ),
+    )
+    cube_indices[cube_indices == UNREDUCED_CUBE_IDX] = len(cube_index)
+    dataset_term_ids = term_ids[dataset_id_pos]
+    return (
+        cube_index,
+        cube_indices,
+        {dataset_term_ids[code]: obs_idx_range for code, obs_idx_range in obs_idx_ranges.items()},
+    )
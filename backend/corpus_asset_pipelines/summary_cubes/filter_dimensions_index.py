@@ -0,0 +1,57 @@
+import logging
+
+import pandas as pd
+import tiledb
+
+from backend.wmg.data.schemas.cube_schema import (
+    cell_counts_indexed_dims,
+    filter_dimensions_index_dims,
+    secondary_filter_dims,
+)
+from backend.wmg.data.snapshot import CELL_COUNTS_CUBE_NAME, FILTER_DIMENSIONS_INDEX_FILENAME
+from backend.wmg.data.tiledb import create_ctx
+from backend.wmg.data.utils import log_func_runtime
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+def extract(corpus_path: str) -> pd.DataFrame:
+    """
+    get the (still encoded) filter dimension columns of the cell count cube
+    """
+    with tiledb.open(f"{corpus_path}/{CELL_COUNTS_CUBE_NAME}", ctx=create_ctx()) as cube:
+        return cube.query(dims=cell_counts_indexed_dims, attrs=secondary_filter_dims, use_arrow=False).df[:]
+
+
+def transform(cell_counts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce the cell counts to the distinct combinations of tissue, organism and secondary filter dimension codes
+    """
+    return (
+        cell_counts[filter_dimensions_index_dims]
+        .drop_duplicates()
+        .sort_values(by=filter_dimensions_index_dims)
+        .reset_index(drop=True)
+    )
+
+
+def load(corpus_path: str, filter_dimensions_index: pd.DataFrame) -> str:
+    """
+    write filter dimensions index to disk, alongside the cubes
+    """
+    uri = f"{corpus_path}/{FILTER_DIMENSIONS_INDEX_FILENAME}"
+    filter_dimensions_index.to_json(uri, orient="split", index=False)
+    return uri
+
+
+@log_func_runtime
+def create_filter_dimensions_index(corpus_path: str):
+    """
+    Create the index used to answer which secondary filter dimension values remain available for a query's criteria,
+    and write it to disk
+    """
+    cell_counts = extract(corpus_path)
+    filter_dimensions_index = transform(cell_counts)
+    uri = load(corpus_path, filter_dimensions_index)
+    logger.info(f"Filter dimensions index with {len(filter_dimensions_index)} entries created and stored at {uri}")
@@ -0,0 +1,65 @@
+import logging
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.extract import extract_obs_data, extract_var_data
+from backend.wmg.data.schemas.cube_schema import cube_indexed_dims_no_gene_ontology, cube_non_indexed_dims
+from backend.wmg.data.snapshot import TERM_ID_CODES_FILENAME
+from backend.wmg.data.term_id_codes import TermIdCodes, term_id_as_str
+from backend.wmg.data.tiledb import create_ctx
+from backend.wmg.data.utils import log_func_runtime
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+def extract(corpus_path: str) -> (pd.DataFrame, Dict[str, set]):
+    """
+    get the var (gene) data, and the distinct term ids of each cube dimension of the obs data, from integrated corpus.
+    The obs data is read one dataset at a time, so that the cells of the whole corpus are never held in memory.
+    """
+    gene_ontology_term_ids = extract_var_data(corpus_path, create_ctx())
+    cube_dims = cube_indexed_dims_no_gene_ontology + cube_non_indexed_dims
+    obs_term_ids_by_dim = {dim_name: set() for dim_name in cube_dims}
+    for obs_df in extract_obs_data(corpus_path, cube_dims):
+        for dim_name in cube_dims:
+            obs_term_ids_by_dim[dim_name].update(obs_df[dim_name].unique())
+    return gene_ontology_term_ids, obs_term_ids_by_dim
+
+
+def transform(gene_ontology_term_ids: pd.DataFrame, obs_term_ids_by_dim: Dict[str, set]) -> TermIdCodes:
+    """
+    Assign a dense code to each term id of each cube dimension. Gene codes are the var_idx of the integrated corpus,
+    while the codes of the other dimensions are the positions of their sorted, distinct term ids.
+    """
+    # the gene codes must be usable as positions in the gene dictionary
+    assert np.array_equal(gene_ontology_term_ids.var_idx.values, np.arange(len(gene_ontology_term_ids)))
+
+    term_ids_by_dim = {"gene_ontology_term_id": gene_ontology_term_ids.gene_ontology_term_id.tolist()}
+    for dim_name, term_ids in obs_term_ids_by_dim.items():
+        term_ids_by_dim[dim_name] = sorted(term_id_as_str(term_id) for term_id in term_ids)
+    return TermIdCodes(term_ids_by_dim)
+
+
+def load(corpus_path: str, term_id_codes: TermIdCodes) -> str:
+    """
+    write term id codes to disk, alongside the cubes
+    """
+    uri = f"{corpus_path}/{TERM_ID_CODES_FILENAME}"
+    with open(uri, "w") as f:
+        f.write(term_id_codes.to_json())
+    return uri
+
+
+@log_func_runtime
+def create_term_id_codes(corpus_path: str) -> TermIdCodes:
+    """
+    Create the term id dictionaries shared by the expression summary and cell count cubes, and write them to disk
+    """
+    gene_ontology_term_ids, obs_term_ids_by_dim = extract(corpus_path)
+    term_id_codes = transform(gene_ontology_term_ids, obs_term_ids_by_dim)
+    uri = load(corpus_path, term_id_codes)
+    logger.info(f"Term id codes created and stored at {uri}")
+    return term_id_codes
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Set
+
+from pandas import DataFrame
+
+from backend.wmg.config import WmgConfig
+from backend.wmg.data.query import WmgQueryCriteria
+
+logger = logging.getLogger("wmg")
+
+
+class QueryResultCache:
+    """
+    A thread-safe, least-recently-used cache of query results, bounded by the total size of the cached results, as
+    measured by `size_fn`. Entries are only valid for the snapshot they were computed from, so the cache is emptied as
+    soon as a result for a newer snapshot is cached. The results of requests that started on a snapshot that has since
+    been superseded are not cached, as they would otherwise empty the cache of the newer snapshot. Snapshots only move
+    forward, so a snapshot that is served again after being superseded is not cached until the cache is cleared.
+    """
+
+    def __init__(self, max_bytes: int, size_fn: Callable[[Any], int] = len):
+        self.max_bytes = max_bytes
+        self._size_fn = size_fn
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+        self._n_bytes = 0
+        self._snapshot_identifier: Optional[str] = None
+        self._superseded_snapshot_identifiers: Set[str] = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, snapshot_identifier: str, key: str, value: Any) -> None:
+        size = self._size_fn(value)
+        with self._lock:
+            if snapshot_identifier in self._superseded_snapshot_identifiers:
+                return
+            if snapshot_identifier != self._snapshot_identifier:
+                if self._snapshot_identifier is not None:
+                    logger.info(f"clearing query result cache of snapshot {self._snapshot_identifier}: {self._stats()}")
+                    self._superseded_snapshot_identifiers.add(self._snapshot_identifier)
+                self._clear()
+                self._snapshot_identifier = snapshot_identifier
+            if size > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self._n_bytes += size
+            while self._n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._n_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+            self._snapshot_identifier = None
+            self._superseded_snapshot_identifiers.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return self._stats()
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._n_bytes = 0
+
+    def _stats(self) -> Dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            entries=len(self._entries),
+            bytes=self._n_bytes,
+        )
+
+
+def dataframe_size(df: DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# The serialized query responses
+_query_result_cache: Optional[QueryResultCache] = None
+# The intermediate query results (DataFrames) from which responses are built: cell count aggregates per set of
+# non-gene criteria, and expression summary aggregates per gene and set of non-gene criteria
+_query_partial_result_cache: Optional[QueryResultCache] = None
+_query_result_cache_lock = threading.Lock()
+
+
+def get_query_result_cache() -> QueryResultCache:
+    global _query_result_cache
+
+    if _query_result_cache is None:
+        with _query_result_cache_lock:
+            if _query_result_cache is None:
+                _query_result_cache = QueryResultCache(max_bytes=int(WmgConfig().query_result_cache_max_bytes))
+    return _query_result_cache
+
+
+def get_query_partial_result_cache() -> QueryResultCache:
+    global _query_partial_result_cache
+
+    if _query_partial_result_cache is None:
+        with _query_result_cache_lock:
+            if _query_partial_result_cache is None:
+                _query_partial_result_cache = QueryResultCache(
+                    max_bytes=int(WmgConfig().query_partial_result_cache_max_bytes), size_fn=dataframe_size
+                )
+    return _query_partial_result_cache
+
+
+def clear_query_caches() -> None:
+    get_query_result_cache().clear()
+    get_query_partial_result_cache().clear()
+
+
+def build_query_cache_key(
+    snapshot_identifier: str,
+    criteria: WmgQueryCriteria,
+    include_filter_dims: bool,
+    response_format: str,
+    datasets_metadata_version: Optional[str] = None,
+) -> str:
+    """
+    Returns a key that identifies the response to a query. The order of the term ids in the criteria does not affect
+    the response, with the exception of the gene term ids, whose labels are returned in the requested order. The
+    datasets metadata of the filter dims are read from the DB rather than from the snapshot, so their version is part
+    of the key of responses that include them. The key is also used as the ETag of the response.
+    """
+    return _hash_key(
+        snapshot_identifier,
+        canonicalize_criteria(criteria),
+        include_filter_dims,
+        response_format,
+        datasets_metadata_version,
+    )
+
+
+def build_partial_result_cache_key(snapshot_identifier: str, criteria: WmgQueryCriteria, *result_ids: str) -> str:
+    """
+    Returns a key that identifies an intermediate query result, by its snapshot, its non-gene criteria and the given
+    result ids (e.g. the name of the result and the gene it is computed for)
+    """
+    non_gene_criteria = canonicalize_criteria(criteria.copy(exclude={"gene_ontology_term_ids"}))
+    return _hash_key(snapshot_identifier, non_gene_criteria, *result_ids)
+
+
+def canonicalize_criteria(criteria: WmgQueryCriteria) -> Dict[str, Any]:
+    return {
+        criterion_name: (
+            sorted(term_ids) if isinstance(term_ids, list) and criterion_name != "gene_ontology_term_ids" else term_ids
+        )
+        for criterion_name, term_ids in criteria.dict().items()
+    }
+
+
+def _hash_key(*key_parts: Any) -> str:
+    return hashlib.sha256(json.dumps(list(key_parts), sort_keys=True).encode("utf-8")).hexdigest()
@@ -1,23 +1,39 @@
 from collections import defaultdict
 from typing import Dict, List, Any, Iterable, Tuple
-from math import isnan
 
 import connexion
-from flask import jsonify
+import numpy as np
+import orjson
+import pandas as pd
+from flask import jsonify, Response
 from pandas import DataFrame
+from sqlalchemy import func
 
+from backend.corpora.common.corpora_orm import DbCollection, DbDataset
 from backend.corpora.common.entities import Dataset
 from backend.corpora.common.utils.db_session import db_session_manager
-from backend.wmg.data.ontology_labels import ontology_term_label, gene_term_label
+from backend.wmg.api.query_cache import (
+    build_query_cache_key,
+    build_partial_result_cache_key,
+    get_query_partial_result_cache,
+    get_query_result_cache,
+)
+from backend.wmg.data.ontology_labels import (
+    build_gene_id_label_mapping,
+    build_ontology_term_id_label_mapping,
+    ontology_term_label,
+)
 from backend.wmg.data.query import (
     WmgQuery,
     WmgQueryCriteria,
 )
+from backend.wmg.data.schemas.cube_schema import secondary_filter_dims
 from backend.wmg.data.snapshot import load_snapshot, WmgSnapshot
 
-# TODO: add cache directives: no-cache (i.e. revalidate); impl etag
-#  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell-data
-#  -portal/2132
+# Response formats of the query endpoint. The compact format represents the expression summary and cell types as
+# column arrays, in which the term ids are replaced by their positions in per-column term id lists.
+NESTED_RESPONSE_FORMAT = "nested"
+COMPACT_RESPONSE_FORMAT = "compact"
 
 
 def primary_filter_dimensions():
@@ -28,33 +44,69 @@ def primary_filter_dimensions():
 def query():
     request = connexion.request.json
     criteria = WmgQueryCriteria(**request["filter"])
+    include_filter_dims = request.get("include_filter_dims", False)
+    response_format = request.get("response_format", NESTED_RESPONSE_FORMAT)
 
     snapshot: WmgSnapshot = load_snapshot()
-    query = WmgQuery(snapshot)
-    expression_summary = query.expression_summary(criteria)
-    cell_counts = query.cell_counts(criteria)
-    dot_plot_matrix_df, cell_counts_cell_type_agg = get_dot_plot_data(expression_summary, cell_counts)
-
-    include_filter_dims = request.get("include_filter_dims", False)
 
-    response_filter_dims_values = (
-        build_filter_dims_values(criteria, query, expression_summary) if include_filter_dims else {}
+    # The response is fully determined by the snapshot and the request, and by the datasets metadata in the DB when
+    # filter dims are included, so the cache key doubles as the ETag; clients must revalidate, which is free when
+    # neither the snapshot nor the datasets metadata have changed
+    datasets_metadata_version = fetch_datasets_metadata_version() if include_filter_dims else None
+    cache_key = build_query_cache_key(
+        snapshot.snapshot_identifier, criteria, include_filter_dims, response_format, datasets_metadata_version
     )
-    return jsonify(
-        dict(
-            snapshot_id=snapshot.snapshot_identifier,
-            expression_summary=build_expression_summary(dot_plot_matrix_df),
-            term_id_labels=dict(
-                genes=build_gene_id_label_mapping(criteria.gene_ontology_term_ids),
-                cell_types=build_ordered_cell_types_by_tissue(
-                    cell_counts, cell_counts_cell_type_agg.T, snapshot.cell_type_orderings
-                ),
-            ),
-            filter_dims=response_filter_dims_values,
+    if connexion.request.if_none_match.contains(cache_key):
+        return cacheable_response(Response(status=304), cache_key)
+
+    query_result_cache = get_query_result_cache()
+    response_body = query_result_cache.get(cache_key)
+    if response_body is None:
+        response_body = orjson.dumps(
+            build_query_response(snapshot, criteria, include_filter_dims, response_format),
+            option=orjson.OPT_SERIALIZE_NUMPY,
         )
+        query_result_cache.put(snapshot.snapshot_identifier, cache_key, response_body)
+
+    return cacheable_response(Response(response_body, mimetype="application/json"), cache_key)
+
+
+def build_query_response(
+    snapshot: WmgSnapshot, criteria: WmgQueryCriteria, include_filter_dims: bool, response_format: str
+) -> Dict:
+    query = WmgQuery(snapshot)
+    cell_counts_cell_type_agg, cell_counts_tissue_agg = get_cell_counts_aggs(snapshot, query, criteria)
+    expr_summary_agg = get_expression_summary_agg(snapshot, query, criteria)
+    dot_plot_matrix_df = join_cell_counts_aggs(expr_summary_agg, cell_counts_cell_type_agg, cell_counts_tissue_agg)
+
+    ordered_cell_types = build_ordered_cell_types(cell_counts_cell_type_agg, snapshot.cell_type_orderings)
+
+    response_filter_dims_values = build_filter_dims_values(criteria, query) if include_filter_dims else {}
+
+    if response_format == COMPACT_RESPONSE_FORMAT:
+        response_expression_summary = build_compact_expression_summary(dot_plot_matrix_df)
+        response_cell_types = build_compact_ordered_cell_types_by_tissue(ordered_cell_types)
+    else:
+        response_expression_summary = build_expression_summary(dot_plot_matrix_df)
+        response_cell_types = build_ordered_cell_types_by_tissue(ordered_cell_types)
+
+    return dict(
+        snapshot_id=snapshot.snapshot_identifier,
+        expression_summary=response_expression_summary,
+        term_id_labels=dict(
+            genes=build_gene_id_label_mapping(criteria.gene_ontology_term_ids),
+            cell_types=response_cell_types,
+        ),
+        filter_dims=response_filter_dims_values,
     )
 
 
+def cacheable_response(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
 # TODO: Read this from generated data artifact instead of DB.
 #  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell-data
 #  -portal/2086. This code is without a unit test, but we are intending to replace it.
@@ -79,29 +131,23 @@ def fetch_datasets_metadata(dataset_ids: Iterable[str]) -> List[Dict]:
         return [get_dataset(dataset_id) for dataset_id in dataset_ids]
 
 
-def find_dim_option_values(criteria: Dict, query: WmgQuery, dimension: str) -> set:
-    """Find values for the specified dimension that satisfy the given filtering criteria,
-    ignoring any criteria specified for the given dimension."""
-    filter_options_criteria = criteria.copy(update={dimension + "s": []}, deep=True)
-    # todo can we query cell_counts for a performance gain?
-    query_result = query.expression_summary(filter_options_criteria)
-    filter_dims = query_result.groupby(dimension).groups.keys()
-    return filter_dims
+def fetch_datasets_metadata_version() -> str:
+    """
+    Returns a version of the datasets metadata returned by fetch_datasets_metadata, which changes whenever a dataset or
+    collection is added, deleted or updated. Cached responses that include datasets metadata are keyed by it.
+    """
+    with db_session_manager() as session:
+        dataset_count, dataset_updated_at = session.query(
+            func.count(DbDataset.id), func.max(DbDataset.updated_at)
+        ).one()
+        collection_count, collection_updated_at = session.query(
+            func.count(DbCollection.id), func.max(DbCollection.updated_at)
+        ).one()
+    return f"{dataset_count}:{dataset_updated_at}:{collection_count}:{collection_updated_at}"
 
 
-def build_filter_dims_values(criteria: WmgQueryCriteria, query: WmgQuery, expression_summary: DataFrame) -> Dict:
-    dims = {
-        "dataset_id": "",
-        "disease_ontology_term_id": "",
-        "sex_ontology_term_id": "",
-        "development_stage_ontology_term_id": "",
-        "ethnicity_ontology_term_id": "",
-    }
-    for dim in dims:
-        if len(criteria.dict()[dim + "s"]) == 0:
-            dims[dim] = expression_summary.groupby(dim).groups.keys()
-        else:
-            dims[dim] = find_dim_option_values(criteria, query, dim)
+def build_filter_dims_values(criteria: WmgQueryCriteria, query: WmgQuery) -> Dict:
+    dims = query.list_filter_dimension_term_ids(criteria, secondary_filter_dims)
 
     response_filter_dims_values = dict(
         datasets=fetch_datasets_metadata(dims["dataset_id"]),
@@ -114,22 +160,58 @@ def build_filter_dims_values(criteria: WmgQueryCriteria, query: WmgQuery, expres
     return response_filter_dims_values
 
 
+def build_expression_summary_stats(query_result: DataFrame) -> Dict[str, np.ndarray]:
+    # Compute the statistics of all rows at once, column-wise
+    nnz = np.ascontiguousarray(query_result["nnz"].values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return dict(
+            n=nnz,
+            me=query_result["sum"].values / nnz,
+            pc=nnz / query_result["n_cells_cell_type"].values,
+            tpc=nnz / query_result["n_cells_tissue"].values,
+        )
+
+
 def build_expression_summary(query_result: DataFrame) -> dict:
+    stats_columns = dict(
+        id=query_result["cell_type_ontology_term_id"].values.tolist(),
+        **{stat_name: values.tolist() for stat_name, values in build_expression_summary_stats(query_result).items()},
+    )
+    stats = [dict(zip(stats_columns.keys(), row_stats)) for row_stats in zip(*stats_columns.values())]
+
     # Create nested dicts with gene_ontology_term_id, tissue_ontology_term_id keys, respectively
-    structured_result: Dict[str, Dict[str, List[Dict[str, Any]]]] = defaultdict(lambda: defaultdict(list))
-    for row in query_result.itertuples(index=False):
-        structured_result[row.gene_ontology_term_id][row.tissue_ontology_term_id].append(
-            dict(
-                id=row.cell_type_ontology_term_id,
-                n=row.nnz,
-                me=row.sum / row.nnz,
-                pc=row.nnz / row.n_cells_cell_type,
-                tpc=row.nnz / row.n_cells_tissue,
-            )
-        )
+    structured_result: Dict[str, Dict[str, List[Dict[str, Any]]]] = defaultdict(dict)
+    groups = query_result.groupby(["gene_ontology_term_id", "tissue_ontology_term_id"], sort=False).indices
+    for (gene_ontology_term_id, tissue_ontology_term_id), row_positions in groups.items():
+        structured_result[gene_ontology_term_id][tissue_ontology_term_id] = [stats[i] for i in row_positions]
     return structured_result
 
 
+def build_compact_expression_summary(query_result: DataFrame) -> dict:
+    # One array per column, with the term ids of each row replaced by their position in the column's term_ids list
+    gene_codes, gene_ontology_term_ids = factorize_term_ids(query_result["gene_ontology_term_id"])
+    tissue_codes, tissue_ontology_term_ids = factorize_term_ids(query_result["tissue_ontology_term_id"])
+    cell_type_codes, cell_type_ontology_term_ids = factorize_term_ids(query_result["cell_type_ontology_term_id"])
+    return dict(
+        term_ids=dict(
+            genes=gene_ontology_term_ids,
+            tissues=tissue_ontology_term_ids,
+            cell_types=cell_type_ontology_term_ids,
+        ),
+        columns=dict(
+            gene=gene_codes,
+            tissue=tissue_codes,
+            cell_type=cell_type_codes,
+            **build_expression_summary_stats(query_result),
+        ),
+    )
+
+
+def factorize_term_ids(term_ids: pd.Series) -> Tuple[np.ndarray, List[str]]:
+    codes, unique_term_ids = pd.factorize(term_ids, sort=True)
+    return codes, unique_term_ids.tolist()
+
+
 def agg_cell_type_counts(cell_counts: DataFrame) -> DataFrame:
     # Aggregate cube data by tissue, cell type
     cell_counts_cell_type_agg = cell_counts.groupby(
@@ -157,81 +239,171 @@ def get_dot_plot_data(query_result: DataFrame, cell_counts: DataFrame) -> Tuple[
 def build_dot_plot_matrix(
     query_result: DataFrame, cell_counts_cell_type_agg: DataFrame, cell_counts_tissue_agg: DataFrame
 ) -> DataFrame:
+    return join_cell_counts_aggs(
+        agg_expression_summary(query_result), cell_counts_cell_type_agg, cell_counts_tissue_agg
+    )
+
+
+def agg_expression_summary(query_result: DataFrame) -> DataFrame:
     # Aggregate cube data by gene, tissue, cell type
-    expr_summary_agg = query_result.groupby(
+    return query_result.groupby(
         ["gene_ontology_term_id", "tissue_ontology_term_id", "cell_type_ontology_term_id"], as_index=False
     ).sum()
+
+
+def join_cell_counts_aggs(
+    expr_summary_agg: DataFrame, cell_counts_cell_type_agg: DataFrame, cell_counts_tissue_agg: DataFrame
+) -> DataFrame:
     return expr_summary_agg.join(
         cell_counts_cell_type_agg, on=["tissue_ontology_term_id", "cell_type_ontology_term_id"], how="left"
     ).join(cell_counts_tissue_agg, on=["tissue_ontology_term_id"], how="left")
 
 
-def build_gene_id_label_mapping(gene_ontology_term_ids: List[str]) -> List[dict]:
-    return [
-        {gene_ontology_term_id: gene_term_label(gene_ontology_term_id)}
+def get_cell_counts_aggs(
+    snapshot: WmgSnapshot, query: WmgQuery, criteria: WmgQueryCriteria
+) -> Tuple[DataFrame, DataFrame]:
+    """
+    Returns the cell counts aggregated by tissue and cell type, and by tissue. These do not depend on the genes of the
+    query, so they are cached per set of non-gene criteria.
+    """
+    cache = get_query_partial_result_cache()
+    cell_type_agg_key = build_partial_result_cache_key(snapshot.snapshot_identifier, criteria, "cell_type_agg")
+    tissue_agg_key = build_partial_result_cache_key(snapshot.snapshot_identifier, criteria, "tissue_agg")
+
+    cell_counts_cell_type_agg = cache.get(cell_type_agg_key)
+    cell_counts_tissue_agg = cache.get(tissue_agg_key)
+    if cell_counts_cell_type_agg is None or cell_counts_tissue_agg is None:
+        cell_counts = query.cell_counts(criteria)
+        cell_counts_cell_type_agg = agg_cell_type_counts(cell_counts)
+        cell_counts_tissue_agg = agg_tissue_counts(cell_counts)
+        cache.put(snapshot.snapshot_identifier, cell_type_agg_key, cell_counts_cell_type_agg)
+        cache.put(snapshot.snapshot_identifier, tissue_agg_key, cell_counts_tissue_agg)
+    return cell_counts_cell_type_agg, cell_counts_tissue_agg
+
+
+def get_expression_summary_agg(snapshot: WmgSnapshot, query: WmgQuery, criteria: WmgQueryCriteria) -> DataFrame:
+    """
+    Returns the expression summary aggregated by gene, tissue and cell type. The aggregate of each gene is cached per
+    set of non-gene criteria, so that only the genes that were not previously requested with the same criteria are
+    read from the cube, in a single query. This makes adding a gene to a query cost a single gene's read.
+    """
+    cache = get_query_partial_result_cache()
+    gene_ontology_term_ids = sorted(criteria.gene_ontology_term_ids)
+    gene_agg_keys = {
+        gene_ontology_term_id: build_partial_result_cache_key(
+            snapshot.snapshot_identifier, criteria, "expr_summary_agg", gene_ontology_term_id
+        )
         for gene_ontology_term_id in gene_ontology_term_ids
-    ]
-
+    }
 
-def build_ontology_term_id_label_mapping(ontology_term_ids: Iterable[str]) -> List[dict]:
-    return [{ontology_term_id: ontology_term_label(ontology_term_id)} for ontology_term_id in ontology_term_ids]
+    gene_aggs = {gene_ontology_term_id: cache.get(key) for gene_ontology_term_id, key in gene_agg_keys.items()}
+    uncached_gene_ontology_term_ids = [gene_id for gene_id, gene_agg in gene_aggs.items() if gene_agg is None]
+    if uncached_gene_ontology_term_ids or not gene_ontology_term_ids:
+        expr_summary_agg = agg_expression_summary(
+            query.expression_summary(criteria.copy(update=dict(gene_ontology_term_ids=uncached_gene_ontology_term_ids)))
+        )
+        expr_summary_agg_by_gene = expr_summary_agg.groupby("gene_ontology_term_id", sort=False).indices
+        for gene_ontology_term_id in uncached_gene_ontology_term_ids:
+            gene_agg = expr_summary_agg.iloc[expr_summary_agg_by_gene.get(gene_ontology_term_id, [])]
+            cache.put(snapshot.snapshot_identifier, gene_agg_keys[gene_ontology_term_id], gene_agg)
+            gene_aggs[gene_ontology_term_id] = gene_agg
+        if not gene_ontology_term_ids:
+            return expr_summary_agg
 
+    # the per-gene aggregates are sorted by tissue and cell type, so concatenating them in gene order yields the same
+    # ordering as aggregating all of the genes at once
+    return pd.concat(gene_aggs.values(), ignore_index=True)
 
-def build_ordered_cell_types_by_tissue(
-    cell_counts: DataFrame,
-    cell_counts_cell_type_agg_T: DataFrame,
-    cell_type_orderings: DataFrame,
-) -> Dict[str, List[Dict[str, str]]]:
-    distinct_tissues_cell_types: DataFrame = cell_counts.groupby(
-        ["tissue_ontology_term_id", "cell_type_ontology_term_id"], as_index=False
-    ).first()[["tissue_ontology_term_id", "cell_type_ontology_term_id", "n_total_cells"]]
 
+def build_ordered_cell_types(cell_counts_cell_type_agg: DataFrame, cell_type_orderings: DataFrame) -> DataFrame:
     joined = cell_type_orderings.merge(
-        distinct_tissues_cell_types, on=["tissue_ontology_term_id", "cell_type_ontology_term_id"], how="left"
+        cell_counts_cell_type_agg["n_cells_cell_type"],
+        left_on=["tissue_ontology_term_id", "cell_type_ontology_term_id"],
+        right_index=True,
+        how="left",
     )
 
     # Updates depths based on the rows that need to be removed
     joined = build_ordered_cell_types_by_tissue_update_depths(joined)
 
     # Remove cell types without counts
-    joined = joined[joined["n_total_cells"].notnull()]
+    return joined[joined["n_cells_cell_type"].notnull()]
+
+
+def build_ordered_cell_types_by_tissue(ordered_cell_types: DataFrame) -> Dict[str, List[Dict[str, Any]]]:
+    cell_type_ontology_term_ids = ordered_cell_types["cell_type_ontology_term_id"].values
+    cell_type_labels = {
+        cell_type_ontology_term_id: ontology_term_label(cell_type_ontology_term_id)
+        for cell_type_ontology_term_id in np.unique(cell_type_ontology_term_ids)
+    }
 
-    structured_result: Dict[str, List[Dict[str, str]]] = defaultdict(list)
-    for row in joined.itertuples(index=False):
-        structured_result[row.tissue_ontology_term_id].append(
+    structured_result: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for tissue_ontology_term_id, cell_type_ontology_term_id, total_count, depth in zip(
+        ordered_cell_types["tissue_ontology_term_id"].values,
+        cell_type_ontology_term_ids,
+        ordered_cell_types["n_cells_cell_type"].values.astype(int).tolist(),
+        ordered_cell_types["depth"].values.tolist(),
+    ):
+        structured_result[tissue_ontology_term_id].append(
             {
-                "cell_type_ontology_term_id": row.cell_type_ontology_term_id,
-                "cell_type": ontology_term_label(row.cell_type_ontology_term_id),
-                "total_count": int(
-                    cell_counts_cell_type_agg_T[row.tissue_ontology_term_id][row.cell_type_ontology_term_id][
-                        "n_cells_cell_type"
-                    ]
-                ),
-                "depth": row.depth,
+                "cell_type_ontology_term_id": cell_type_ontology_term_id,
+                "cell_type": cell_type_labels[cell_type_ontology_term_id],
+                "total_count": total_count,
+                "depth": depth,
             }
         )
 
     return structured_result
 
 
+def build_compact_ordered_cell_types_by_tissue(ordered_cell_types: DataFrame) -> dict:
+    # One array per column, in display order, with the term ids of each row replaced by their position in the
+    # column's term_ids list; the cell type labels are in the same order as the cell type term ids
+    tissue_codes, tissue_ontology_term_ids = factorize_term_ids(ordered_cell_types["tissue_ontology_term_id"])
+    cell_type_codes, cell_type_ontology_term_ids = factorize_term_ids(ordered_cell_types["cell_type_ontology_term_id"])
+    return dict(
+        term_ids=dict(
+            tissues=tissue_ontology_term_ids,
+            cell_types=cell_type_ontology_term_ids,
+        ),
+        cell_type_labels=[
+            ontology_term_label(cell_type_ontology_term_id)
+            for cell_type_ontology_term_id in cell_type_ontology_term_ids
+        ],
+        columns=dict(
+            tissue=tissue_codes,
+            cell_type=cell_type_codes,
+            total_count=ordered_cell_types["n_cells_cell_type"].values.astype(int),
+            depth=np.ascontiguousarray(ordered_cell_types["depth"].values),
+        ),
+    )
+
+
 def build_ordered_cell_types_by_tissue_update_depths(x: DataFrame):
     """
     Updates the depths of the cell ontology tree based on cell types that have to be removed
-    because they have 0 counts
+    because they have 0 counts. The cell types are in depth-first order, so the descendants of
+    a removed cell type are the rows that follow it, up to the next row of the same or lower depth.
+    Each descendant moves up one level per removed ancestor.
     """
 
-    depth_col = x.columns.get_loc("depth")
-    n_cells_col = x.columns.get_loc("n_total_cells")
-
-    x["depth"] = x["depth"].astype("int")
-
-    for i in range(len(x)):
-        if isnan(x.iloc[i, n_cells_col]):
-            original_depth = x.iloc[i, depth_col]
-            for j in range(i + 1, len(x)):
-                if original_depth < x.iloc[j, depth_col]:
-                    x.iloc[j, depth_col] -= 1
-                else:
-                    break
+    depths = x["depth"].values.astype("int")
+    n_rows = len(depths)
+    removed = np.flatnonzero(x["n_cells_cell_type"].isnull().values)
+
+    # Find the end of each removed cell type's subtree, one distinct depth at a time
+    subtree_ends = np.full(len(removed), n_rows)
+    for depth in np.unique(depths[removed]):
+        subtree_boundaries = np.append(np.flatnonzero(depths <= depth), n_rows)
+        is_at_depth = depths[removed] == depth
+        subtree_ends[is_at_depth] = subtree_boundaries[
+            np.searchsorted(subtree_boundaries, removed[is_at_depth], side="right")
+        ]
+
+    # Decrement the depths within each subtree, by way of a difference array
+    depth_deltas = np.zeros(n_rows + 1, dtype=int)
+    np.add.at(depth_deltas, removed + 1, -1)
+    np.add.at(depth_deltas, subtree_ends, 1)
+    x["depth"] = depths + np.cumsum(depth_deltas[:-1])
 
     return x
@@ -9,5 +9,15 @@ class WmgConfig(SecretConfig):
 
     def get_defaults_template(self):
         deployment_stage = os.getenv("DEPLOYMENT_STAGE", "test")
-        defaults_template = {"bucket": f"wmg-{deployment_stage}", "data_path_prefix": "", "tiledb_config_overrides": {}}
+        defaults_template = {
+            "bucket": f"wmg-{deployment_stage}",
+            "data_path_prefix": "",
+            "tiledb_config_overrides": {},
+            "snapshot_refresh_interval_seconds": 60,
+            "query_result_cache_max_bytes": 256 * 1024 * 1024,
+            "query_partial_result_cache_max_bytes": 512 * 1024 * 1024,
+            # local directory to which each host downloads the snapshots once, for all of its API server processes;
+            # snapshots are read directly from S3 when empty
+            "snapshot_local_mirror_dir": "",
+        }
         return defaults_template
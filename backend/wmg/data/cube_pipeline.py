@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import pathlib
 import sys
 import time
@@ -13,14 +14,16 @@ from backend.corpora.common.utils.slack import (
 )
 from backend.corpus_asset_pipelines import integrated_corpus
 from backend.corpus_asset_pipelines import summary_cubes
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import EXPRESSION_SUMMARY_PARTIALS_NAME
 
-from backend.wmg.data.load_cube import upload_artifacts_to_s3, make_snapshot_active
-from backend.wmg.data.schemas.corpus_schema import create_tdb
-from backend.wmg.data.transform import (
-    generate_primary_filter_dimensions,
-    get_cell_types_by_tissue,
-    generate_cell_ordering,
+from backend.wmg.data.load_cube import (
+    download_artifacts_from_s3,
+    make_snapshot_active,
+    read_snapshot_id,
+    upload_artifacts_to_s3,
 )
+from backend.wmg.data.schemas.corpus_schema import INTEGRATED_ARRAY_NAME, OBS_ARRAY_NAME, VAR_ARRAY_NAME, create_tdb
+from backend.wmg.data.transform import generate_snapshot_artifacts
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +35,8 @@ def load_data_and_create_cube(
     snapshot_path=None,
     extract_data=True,
     validate_cube=True,
+    integrated_corpus_max_workers: int = 1,
+    incremental: bool = False,
 ):
     """
     Function to copy H5AD datasets (from a preconfiugred s3 bucket) to the path given then,
@@ -41,21 +46,33 @@ def load_data_and_create_cube(
     the given dimensions/data) is then generated and stored under big-cube.
     A per-tissue mapping of cell ontologies is generated and the files are copied to s3 under a shared timestamp,.
     On success the least recent set of files are removed from s3
+    Up to integrated_corpus_max_workers datasets are loaded into the integrated corpus concurrently
+    With incremental, the integrated corpus and the expression summary partials are copied from the latest snapshot,
+    and only the datasets that were added since are integrated and reduced
     """
     if not snapshot_path:
         snapshot_id = int(time.time())
         snapshot_path = f"{pathlib.Path().resolve()}/{snapshot_id}"
     corpus_path = f"{snapshot_path}/{corpus_name}"
-    if not tiledb.VFS().is_dir(corpus_path):
+    if incremental:
+        previous_snapshot_id = read_snapshot_id()
+        logger.info(f"Building snapshot incrementally from snapshot {previous_snapshot_id}")
+        download_artifacts_from_s3(
+            snapshot_path,
+            previous_snapshot_id,
+            [
+                os.path.normpath(f"{corpus_name}/{name}")
+                for name in (OBS_ARRAY_NAME, VAR_ARRAY_NAME, INTEGRATED_ARRAY_NAME, EXPRESSION_SUMMARY_PARTIALS_NAME)
+            ],
+        )
+    elif not tiledb.VFS().is_dir(corpus_path):
         create_tdb(snapshot_path, corpus_name)
 
-    integrated_corpus.run(path_to_h5ad_datasets, corpus_path, extract_data)
+    integrated_corpus.run(path_to_h5ad_datasets, corpus_path, extract_data, integrated_corpus_max_workers, incremental)
     summary_cubes.run(corpus_path, validate_cube)
 
-    cell_type_by_tissue = get_cell_types_by_tissue(corpus_path)
-    generate_cell_ordering(snapshot_path, cell_type_by_tissue)
-    generate_primary_filter_dimensions(snapshot_path, corpus_name, snapshot_id)
-    logger.info("Generated cell ordering json file")
+    generate_snapshot_artifacts(snapshot_path, corpus_name, snapshot_id)
+    logger.info("Generated cell ordering and primary filter dimensions json files")
     upload_artifacts_to_s3(snapshot_path, snapshot_id)
     logger.info("Copied snapshot to s3")
     if validate_cube:
@@ -71,7 +88,12 @@ if __name__ == "__main__":
     """
     # todo pass in validate_cubes as env arg
     try:
-        snapshot_id = load_data_and_create_cube("datasets", ".")
+        snapshot_id = load_data_and_create_cube(
+            "datasets",
+            ".",
+            integrated_corpus_max_workers=int(os.getenv("INTEGRATED_CORPUS_MAX_WORKERS", "1")),
+            incremental=os.getenv("INCREMENTAL_CUBE_BUILD", "false").lower() == "true",
+        )
         pipeline_success_message = gen_wmg_pipeline_success_message(snapshot_id)
         data = json.dumps(pipeline_success_message, indent=2)
         notify_slack(data)
@@ -1,6 +1,8 @@
 import boto3
 import os
-import subprocess
+
+from backend.corpora.common.utils.s3_upload import upload_directory
+from backend.wmg.data.snapshot_mirror import download_s3_prefix
 
 
 stack_name = os.environ.get("REMOTE_DEV_PREFIX")
@@ -55,8 +57,38 @@ def remove_oldest_datasets(timestamp):
 
 
 def upload_artifacts_to_s3(snapshot_path, timestamp):
-    sync_command = ["aws", "s3", "sync", snapshot_path, f"{_get_wmg_bucket_path()}/{timestamp}"]
-    subprocess.run(sync_command)
+    """
+    Upload the snapshot (cubes, integrated corpus and json files) under timestamp. The files that were already
+    uploaded, e.g. by an interrupted upload, are skipped.
+    """
+    upload_directory(snapshot_path, f"{_get_wmg_bucket_path()}/{timestamp}")
+
+
+def download_artifacts_from_s3(snapshot_path, timestamp, artifact_names):
+    """
+    Download the given artifacts (files or TileDB arrays, i.e. directories) of the snapshot stored under timestamp
+    """
+    wmg_bucket = boto3.resource("s3").Bucket(wmg_bucket_name)
+    snapshot_prefix = f"{stack_name.strip('/')}/{timestamp}" if stack_name else str(timestamp)
+    for artifact_name in artifact_names:
+        artifact_key = f"{snapshot_prefix}/{artifact_name}"
+        local_path = os.path.join(snapshot_path, artifact_name)
+        # a file's key is listed first among the keys it is a prefix of
+        if any(obj.key == artifact_key for obj in wmg_bucket.objects.filter(Prefix=artifact_key).limit(1)):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            wmg_bucket.download_file(artifact_key, local_path)
+        else:
+            download_s3_prefix(wmg_bucket, artifact_key, local_path)
+
+
+def read_snapshot_id():
+    """
+    Read the timestamp of the latest snapshot from s3
+    """
+    s3 = boto3.resource("s3")
+    file_key = "latest_snapshot_identifier"
+    file_path = f"{stack_name.strip('/')}/{file_key}" if stack_name else f"{file_key}"
+    return s3.Object(wmg_bucket_name, file_path).get()["Body"].read().decode("utf-8").strip()
 
 
 def write_snapshot_id(timestamp):
@@ -2,7 +2,7 @@ import csv
 import gzip
 import json
 import pathlib
-from typing import IO, Dict, Optional
+from typing import IO, Dict, Iterable, List, Optional
 
 # TODO: Place this module into a common ontology util package with ontology_mapping.py and
 #  extract_ontology_terms_from_owl.py. https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues
@@ -41,6 +41,17 @@ def gene_term_label(gene_ontology_term_id: str) -> Optional[str]:
     return gene_term_id_labels.get(gene_ontology_term_id)
 
 
+def build_gene_id_label_mapping(gene_ontology_term_ids: Iterable[str]) -> List[dict]:
+    return [
+        {gene_ontology_term_id: gene_term_label(gene_ontology_term_id)}
+        for gene_ontology_term_id in gene_ontology_term_ids
+    ]
+
+
+def build_ontology_term_id_label_mapping(ontology_term_ids: Iterable[str]) -> List[dict]:
+    return [{ontology_term_id: ontology_term_label(ontology_term_id)} for ontology_term_id in ontology_term_ids]
+
+
 def __load_ontologies() -> None:
     global ontology_term_id_labels
 
@@ -1,13 +1,18 @@
 from typing import List, Dict
 
+import numpy as np
 import tiledb
 from pandas import DataFrame
 from pydantic import BaseModel, Field
 from tiledb import Array
 
+from backend.wmg.data.schemas.cube_schema import (
+    cube_indexed_dims,
+    cell_counts_indexed_dims,
+    filter_dimensions_index_dims,
+)
 from backend.wmg.data.snapshot import WmgSnapshot
-
-EMPTY_DIM_VALUES = ""
+from backend.wmg.data.term_id_codes import TermIdCodes, NO_MATCH_CODE
 
 
 class WmgQueryCriteria(BaseModel):
@@ -32,99 +37,116 @@ class WmgQuery:
         return self._query(
             cube=self._snapshot.expression_summary_cube,
             criteria=criteria,
-            indexed_dims=["gene_ontology_term_ids", "tissue_ontology_term_ids", "organism_ontology_term_id"],
+            indexed_dims=cube_indexed_dims,
         )
 
     def cell_counts(self, criteria: WmgQueryCriteria) -> DataFrame:
         cell_counts = self._query(
             self._snapshot.cell_counts_cube,
             criteria.copy(exclude={"gene_ontology_term_ids"}),
-            indexed_dims=["tissue_ontology_term_ids", "organism_ontology_term_id"],
+            indexed_dims=cell_counts_indexed_dims,
         )
         cell_counts.rename(columns={"n_cells": "n_total_cells"}, inplace=True)  # expressed & non-expressed cells
         return cell_counts
 
-    # TODO: refactor for readability: https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues
-    #  /chanzuckerberg/single-cell-data-portal/2133
-    @staticmethod
-    def _query(cube: Array, criteria: WmgQueryCriteria, indexed_dims: List[str]) -> DataFrame:
-
-        # As TileDB API does not yet support logical OR'ing of attribute values in query conditions, the best we can do
-        # for a single TileDB query is to have TileDB perform the filtering for only the attributes that have
-        # a single criterion value specified by the user. We can then perform the filtering client-side for the
-        # multi-valued attributes, albeit at the cost of retrieving extra data from the TileDB engine. Note, however,
-        # that this extra data is always being retrieved by TileDB from the filesystem (and so across the network), so
-        # the performance impact should not be as bad as it may at first appear.
-
-        # Filter single-valued attribute criterion using TileDB filtering, using QueryCondition
-        # TODO: Benchmark whether this is faster than just doing all the attribute filtering in Pandas
-        single_valued_attrs = {
-            depluralize(attr_name): vals[0]
-            for attr_name, vals in criteria.dict(exclude=set(indexed_dims)).items()
-            if len(vals) == 1
-        }
-        single_valued_attr_conds = [f"{k} == val('{v}')" for k, v in single_valued_attrs.items()]
-        query_cond_expr = " and ".join(single_valued_attr_conds)
-        attr_cond = tiledb.QueryCondition(query_cond_expr) if query_cond_expr else None
-
-        tiledb_dims_query = tuple([criteria.dict()[dim_name] or EMPTY_DIM_VALUES for dim_name in indexed_dims])
-
-        # FIXME: HACK of the century. Prevent realloc() error & crash when query returns an empty result. This forces
-        #  two queries when there should just one.
-        if (
-            len(
-                cube.query(
-                    attr_cond=attr_cond, attrs=single_valued_attrs, dims=["organism_ontology_term_id"]
-                ).multi_index[tiledb_dims_query]["organism_ontology_term_id"]
+    def _query(self, cube: Array, criteria: WmgQueryCriteria, indexed_dims: List[str]) -> DataFrame:
+        # The cubes store integer codes in place of term ids, so the criteria are translated to codes here, and the
+        # query results are translated back to term ids before being returned.
+        term_id_codes = self._snapshot.term_id_codes
+        encoded_criteria = encode_criteria(criteria, term_id_codes)
+
+        # As TileDB API does not yet support logical OR'ing of attribute values in query conditions, TileDB can only
+        # filter exactly on the attributes that have a single criterion value specified by the user. Multi-valued
+        # attribute criteria are pushed down to TileDB as a [min, max] range over the criterion codes, which discards
+        # most non-matching cells before they are transferred from the filesystem (and so across the network). The
+        # exact set membership filtering is then performed client-side on the (much smaller) result.
+        attr_cond_expr = build_attr_query_cond_expr(encoded_criteria, indexed_dims)
+        attr_cond = tiledb.QueryCondition(attr_cond_expr) if attr_cond_expr else None
+
+        # an indexed dimension without criteria (i.e. no genes) matches nothing
+        tiledb_dims_query = tuple([encoded_criteria[dim_name] or [NO_MATCH_CODE] for dim_name in indexed_dims])
+
+        # Read the cube exactly once. Arrow must not be used here, since TileDB's Arrow conversion fails with a
+        # realloc() error & crash when the query returns an empty result, whereas the non-Arrow read path returns an
+        # empty DataFrame with the expected columns.
+        query_result_df = cube.query(attr_cond=attr_cond, use_arrow=False).df[tiledb_dims_query]
+
+        multi_valued_attrs = multi_valued_attr_criteria(encoded_criteria, indexed_dims)
+        if multi_valued_attrs and not query_result_df.empty:
+            mask = np.logical_and.reduce(
+                [query_result_df[attr_name].isin(codes).values for attr_name, codes in multi_valued_attrs.items()]
             )
-            == 0
-        ):
-            # Return an expected empty DataFrame, but without crashing, thanks to use_arrow=False
-            return cube.query(attr_cond=attr_cond, use_arrow=False).df[tiledb_dims_query]
-
-        query_result_df = cube.query(attr_cond=attr_cond, use_arrow=True).df[tiledb_dims_query]
-
-        # Filter multi-valued attribute criteria using Pandas filtering
-        multi_valued_attrs = {
-            depluralize(attr_name): vals
-            for attr_name, vals in criteria.dict(exclude=set(indexed_dims)).items()
-            if len(vals) > 1
+            query_result_df = query_result_df[mask]
+
+        return term_id_codes.decode_df(query_result_df)
+
+    def list_filter_dimension_term_ids(self, criteria: WmgQueryCriteria, dim_names: List[str]) -> Dict[str, List[str]]:
+        """
+        For each of the given secondary filter dimensions, lists the term ids that remain available given the criteria
+        of all the *other* dimensions. This is answered in memory from the snapshot's filter dimensions index, rather
+        than by re-querying a cube for each dimension.
+        """
+        term_id_codes = self._snapshot.term_id_codes
+        encoded_criteria = encode_criteria(criteria, term_id_codes)
+        index = self._snapshot.filter_dimensions_index
+
+        masks = {
+            dim_name: index[dim_name].isin(encoded_criteria[dim_name]).values
+            for dim_name in filter_dimensions_index_dims
+            if encoded_criteria[dim_name]
         }
-        if multi_valued_attrs:
-            # Note that this is a Pandas query expression, which happens to be very similar to TileDB Python
-            # QueryCondition expression. But don't confuse the two! Pandas query expressions _do_ support logical OR'ing
-            # in filtering expressions
-            multi_valued_attr_conds = [f"{k} in {v}" for k, v in multi_valued_attrs.items()]
-            query_result_df = query_result_df.query(" and ".join(multi_valued_attr_conds))
-
-        return query_result_df
-
-    def list_primary_filter_dimension_term_ids(self, primary_dim_name: str):
-        # TODO: Query the cell counts cube, for efficiency:
-        #  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell
-        #  -data-portal/2134
-        return (
-            self._snapshot.expression_summary_cube.query(attrs=[], dims=[primary_dim_name])
-            .df[:]
-            .groupby([primary_dim_name])
-            .first()
-            .index.tolist()
-        )
 
-    def list_grouped_primary_filter_dimensions_term_ids(
-        self, primary_dim_name: str, group_by_dim: str
-    ) -> Dict[str, List[str]]:
-        # TODO: Query the cell counts cube, for efficiency:
-        #  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell
-        #  -data-portal/2134
-        return (
-            self._snapshot.expression_summary_cube.query(attrs=[], dims=[primary_dim_name, group_by_dim])
-            .df[:]
-            .drop_duplicates()
-            .groupby(group_by_dim)
-            .agg(list)
-            .to_dict()[primary_dim_name]
-        )
+        term_ids = {}
+        for dim_name in dim_names:
+            # tissue and organism criteria are required, so there is always at least one other dimension's mask
+            other_masks = [mask for other_dim_name, mask in masks.items() if other_dim_name != dim_name]
+            codes = np.unique(index[dim_name].values[np.logical_and.reduce(other_masks)])
+            term_ids[dim_name] = term_id_codes.decode(dim_name, codes).tolist()
+        return term_ids
+
+
+def encode_criteria(criteria: WmgQueryCriteria, term_id_codes: TermIdCodes) -> Dict[str, List[int]]:
+    """
+    Translates the term ids of each criterion to their integer codes, keyed by the (singular) cube dimension name. A
+    criterion whose term ids are all unknown to the snapshot is translated to NO_MATCH_CODE, so that it matches nothing.
+    """
+    encoded_criteria = {}
+    for criterion_name, term_ids in criteria.dict().items():
+        if isinstance(term_ids, str):
+            dim_name, term_ids = criterion_name, [term_ids]
+        else:
+            dim_name = depluralize(criterion_name)
+        encoded_criteria[dim_name] = (term_id_codes.encode(dim_name, term_ids) or [NO_MATCH_CODE]) if term_ids else []
+    return encoded_criteria
+
+
+def single_valued_attr_criteria(encoded_criteria: Dict[str, List[int]], indexed_dims: List[str]) -> Dict[str, int]:
+    return {
+        dim_name: codes[0]
+        for dim_name, codes in encoded_criteria.items()
+        if dim_name not in indexed_dims and len(codes) == 1
+    }
+
+
+def multi_valued_attr_criteria(encoded_criteria: Dict[str, List[int]], indexed_dims: List[str]) -> Dict[str, List[int]]:
+    return {
+        dim_name: codes
+        for dim_name, codes in encoded_criteria.items()
+        if dim_name not in indexed_dims and len(codes) > 1
+    }
+
+
+def build_attr_query_cond_expr(encoded_criteria: Dict[str, List[int]], indexed_dims: List[str]) -> str:
+    """
+    Builds the TileDB QueryCondition expression for the non-indexed (attribute) criteria. Single-valued criteria are
+    filtered exactly, while multi-valued criteria are filtered by the range bounding their codes, since TileDB does
+    not support logical OR'ing. Returns an empty string if there are no attribute criteria.
+    """
+    conds = [f"{k} == {v}" for k, v in single_valued_attr_criteria(encoded_criteria, indexed_dims).items()]
+    for k, codes in multi_valued_attr_criteria(encoded_criteria, indexed_dims).items():
+        conds.append(f"{k} >= {min(codes)}")
+        conds.append(f"{k} <= {max(codes)}")
+    return " and ".join(conds)
 
 
 def depluralize(attr_name):
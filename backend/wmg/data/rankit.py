@@ -1,6 +1,20 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
 import numba as nb
 import numpy as np
 import scipy as sc
+import scipy.stats  # noqa: F401, makes sc.stats available
+
+# Number of decimals the rankit quantiles (probability levels) are rounded to. The quantiles can therefore only take
+# QUANTILE_RESOLUTION + 1 distinct values, so their normal distribution values are precomputed in a lookup table.
+QUANTILE_DECIMALS = 5
+QUANTILE_RESOLUTION = 10**QUANTILE_DECIMALS
+
+# Number of rows normalized per task by the rankit thread pool
+RANKIT_BLOCK_ROWS = 1024
 
 
 @nb.jit
@@ -11,7 +25,7 @@ def quantiles(max_rank: int, ranks: np.ndarray) -> np.ndarray:
     return np.array([np.round((i - 0.5) / max_rank, 5) for i in ranks])
 
 
-def rankit(Xraw: sc.sparse.spmatrix, offset: float = 3.0) -> sc.sparse.csr_matrix:
+def rankit(Xraw: sc.sparse.spmatrix, offset: float = 3.0, max_workers: Optional[int] = None) -> sc.sparse.csr_matrix:
     """
     Row-wise normalizes values of a matrix using the rankit method. The target distribution is a normal distribution
     with variance of 1 and mean as set in `offset`
@@ -19,11 +33,35 @@ def rankit(Xraw: sc.sparse.spmatrix, offset: float = 3.0) -> sc.sparse.csr_matri
     In statistics, rankits of a set of data are the expected values of the order statistics of
     a sample from the standard normal distribution the same size as the data
     Caveat: equal values are ranked in undefined order.
+    Blocks of rows are normalized in parallel, by a compiled kernel that returns the same values as `reference_rankit`,
+    on max_workers threads (by default, one per CPU).
     param Xraw: query matrix to be normalized
     param offset: mean for the resulting row-wise values that will follow a normal distribution with variance 1. This
     helps to shift values to a positive scale.
+    param max_workers: number of threads. Callers that run rankit in several processes should pass their share of CPUs
     :returns row-wise normalized matrix using rankit
     """
+    max_workers = max_workers or os.cpu_count() or 1
+    X = Xraw.tocsr(copy=True)  # get Compressed Sparse Row format of raw expression values matrix
+    table = normal_quantiles_table(offset)
+    result = np.empty(X.data.shape[0], dtype=np.float64)
+
+    def rankit_block(start_row: int) -> None:
+        end_row = min(start_row + RANKIT_BLOCK_ROWS, X.shape[0])
+        _rankit_kernel(X.indptr, X.data, table, start_row, end_row, result)
+
+    # the kernel releases the GIL, so the blocks are normalized concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results, to raise any error
+        list(executor.map(rankit_block, range(0, X.shape[0], RANKIT_BLOCK_ROWS)))
+    X.data[:] = result
+    return X
+
+
+def reference_rankit(Xraw: sc.sparse.spmatrix, offset: float = 3.0) -> sc.sparse.csr_matrix:
+    """
+    Row-by-row implementation of `rankit`, using scipy. Kept as the reference for the compiled kernel.
+    """
     X = Xraw.tocsr(copy=True)  # get Compressed Sparse Row format of raw expression values matrix
     indptr = X.indptr  # get row count
     for row in range(0, indptr.shape[0] - 1):
@@ -38,3 +76,42 @@ def rankit(Xraw: sc.sparse.spmatrix, offset: float = 3.0) -> sc.sparse.csr_matri
         normal_quantiles = sc.stats.norm.ppf(prob_level, loc=offset)
         X.data[indptr[row] : indptr[row + 1]] = normal_quantiles
     return X
+
+
+@lru_cache(maxsize=4)
+def normal_quantiles_table(offset: float) -> np.ndarray:
+    """
+    :returns the normal distribution values (with variance 1 and mean `offset`) of every quantile that rankit can
+    produce, indexed by the quantile multiplied by QUANTILE_RESOLUTION
+    """
+    table = sc.stats.norm.ppf(np.arange(QUANTILE_RESOLUTION + 1) / QUANTILE_RESOLUTION, loc=offset)
+    table.flags.writeable = False
+    return table
+
+
+@nb.njit(nogil=True)
+def _rankit_kernel(
+    indptr: np.ndarray, data: np.ndarray, table: np.ndarray, start_row: int, end_row: int, result: np.ndarray
+) -> None:
+    """
+    Write the rankit values of the given rows of the CSR matrix data into result, row by row
+    """
+    for row in range(start_row, end_row):
+        start, end = indptr[row], indptr[row + 1]
+        if start == end:
+            continue
+        row_data = data[start:end]
+        order = np.argsort(row_data, kind="mergesort")
+
+        # dense ranks: equal values share a rank, and ranks have no gaps
+        ranks = np.empty(end - start, dtype=np.int64)
+        rank = 1
+        ranks[order[0]] = rank
+        for i in range(1, order.shape[0]):
+            if row_data[order[i]] != row_data[order[i - 1]]:
+                rank += 1
+            ranks[order[i]] = rank
+
+        for i in range(ranks.shape[0]):
+            # same quantile as `quantiles`, i.e. np.round((rank - 0.5) / max_rank, QUANTILE_DECIMALS), as a table index
+            result[start + i] = table[int(np.rint((ranks[i] - 0.5) / rank * QUANTILE_RESOLUTION))]
@@ -1,3 +1,10 @@
+"""
+Cube layout (v2): every logical cube dimension, whether modeled as a TileDB `Dim` or `Attr`, stores a dense uint32 code
+instead of the variable-length ontology term id (or dataset id). The codes are mapped to term ids by the
+snapshot-level dictionaries of backend/wmg/data/term_id_codes.py, which allows TileDB QueryConditions to be used for
+every filter and avoids string comparisons at query time.
+"""
+
 import numpy as np
 import tiledb
 
@@ -33,9 +40,28 @@ cube_logical_dims = cube_indexed_dims + cube_non_indexed_dims
 
 filters = [tiledb.ZstdFilter(level=+22)]
 
+# Integer codes compress much better once their bytes are shuffled
+code_filters = [tiledb.ByteShuffleFilter(), tiledb.ZstdFilter(level=+22)]
+
+# The domain of the term id codes. The upper bound is reserved for NO_MATCH_CODE.
+code_domain = (np.iinfo(np.uint32).min, np.iinfo(np.uint32).max - 1)
+
+# Tile extents of the indexed dimensions, in number of codes
+code_tile_extents = {
+    "gene_ontology_term_id": 256,
+    "tissue_ontology_term_id": 16,
+    "organism_ontology_term_id": 4,
+}
+
 domain = tiledb.Domain(
     [
-        tiledb.Dim(name=cube_indexed_dim, domain=None, tile=None, dtype="ascii", filters=filters)
+        tiledb.Dim(
+            name=cube_indexed_dim,
+            domain=code_domain,
+            tile=code_tile_extents[cube_indexed_dim],
+            dtype=np.uint32,
+            filters=code_filters,
+        )
         for cube_indexed_dim in cube_indexed_dims
     ]
 )
@@ -52,8 +78,7 @@ cube_logical_attrs = [
 # logical cube attributes, above, along with the non-indexed logical
 # cube dimensions, which we models as TileDB `Attr`s.
 cube_physical_attrs = [
-    tiledb.Attr(name=nonindexed_dim, dtype="ascii", var=True, filters=filters)
-    for nonindexed_dim in cube_non_indexed_dims
+    tiledb.Attr(name=nonindexed_dim, dtype=np.uint32, filters=code_filters) for nonindexed_dim in cube_non_indexed_dims
 ] + cube_logical_attrs
 
 expression_summary_schema = tiledb.ArraySchema(
@@ -77,10 +102,28 @@ cell_counts_non_indexed_dims = cube_non_indexed_dims
 
 cell_counts_logical_dims = cell_counts_indexed_dims + cell_counts_non_indexed_dims
 
+# The secondary filter dimensions, whose available values are reported to the user given the query criteria
+secondary_filter_dims = [
+    "dataset_id",
+    "disease_ontology_term_id",
+    "sex_ontology_term_id",
+    "development_stage_ontology_term_id",
+    "ethnicity_ontology_term_id",
+]
+
+# The columns of the filter dimensions index, which holds the distinct combinations of these dimensions' codes
+filter_dimensions_index_dims = cell_counts_indexed_dims + secondary_filter_dims
+
 
 cell_counts_domain = tiledb.Domain(
     [
-        tiledb.Dim(name=cell_counts_indexed_dim, domain=None, tile=None, dtype="ascii", filters=filters)
+        tiledb.Dim(
+            name=cell_counts_indexed_dim,
+            domain=code_domain,
+            tile=code_tile_extents[cell_counts_indexed_dim],
+            dtype=np.uint32,
+            filters=code_filters,
+        )
         for cell_counts_indexed_dim in cell_counts_indexed_dims
     ]
 )
@@ -91,8 +134,7 @@ cell_counts_logical_attrs = [
 ]
 
 cell_counts_physical_attrs = [
-    tiledb.Attr(name=nonindexed_dim, dtype="ascii", var=True, filters=filters)
-    for nonindexed_dim in cube_non_indexed_dims
+    tiledb.Attr(name=nonindexed_dim, dtype=np.uint32, filters=code_filters) for nonindexed_dim in cube_non_indexed_dims
 ] + cell_counts_logical_attrs
 
 
@@ -105,3 +147,32 @@ cell_counts_schema = tiledb.ArraySchema(
     tile_order="row-major",
     capacity=10000,
 )
+
+
+# Expression Summary Partials Arrays
+
+# The partial aggregates of the expression summary cube for a single dataset, from which the cube is recomposed. The
+# term ids of a partial are not encoded, as the codes are specific to a snapshot. Instead, the partial's groups (the
+# cube rows, without the gene) and its genes are listed in its metadata, and its cells are keyed by their positions
+# in these lists.
+expression_summary_partial_dims = ["group_idx", "gene_idx"]
+
+expression_summary_partial_domain = tiledb.Domain(
+    [
+        tiledb.Dim(name="group_idx", domain=code_domain, tile=16, dtype=np.uint32, filters=code_filters),
+        tiledb.Dim(name="gene_idx", domain=code_domain, tile=256, dtype=np.uint32, filters=code_filters),
+    ]
+)
+
+expression_summary_partial_schema = tiledb.ArraySchema(
+    domain=expression_summary_partial_domain,
+    sparse=True,
+    allows_duplicates=True,
+    attrs=[
+        tiledb.Attr(name="nnz", dtype=np.uint64, filters=filters),
+        tiledb.Attr(name="sum", dtype=np.float32, filters=filters),
+    ],
+    cell_order="row-major",
+    tile_order="row-major",
+    capacity=10000,
+)
@@ -1,9 +1,13 @@
+import _thread
 import json
 import logging
 import os
+import threading
+import time
 from dataclasses import dataclass
-from typing import Optional, Dict
+from typing import IO, Callable, Optional, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 import tiledb
 from pandas import DataFrame
@@ -11,14 +15,25 @@ from tiledb import Array
 
 from backend.corpora.common.utils.s3_buckets import buckets
 from backend.wmg.config import WmgConfig
+from backend.wmg.data.schemas.cube_schema import filter_dimensions_index_dims
+from backend.wmg.data.snapshot_mirror import download_s3_prefix, mirror_snapshot
+from backend.wmg.data.term_id_codes import TermIdCodes
 from backend.wmg.data.tiledb import create_ctx
 
 # Snapshot data artifact file/dir names
 CELL_TYPE_ORDERINGS_FILENAME = "cell_type_orderings.json"
 PRIMARY_FILTER_DIMENSIONS_FILENAME = "primary_filter_dimensions.json"
+TERM_ID_CODES_FILENAME = "term_id_codes.json"
+FILTER_DIMENSIONS_INDEX_FILENAME = "filter_dimensions_index.json"
 EXPRESSION_SUMMARY_CUBE_NAME = "expression_summary"
 CELL_COUNTS_CUBE_NAME = "cell_counts"
 
+# Derived from the filter dimensions index by a local snapshot mirror, to memory-map the index
+FILTER_DIMENSIONS_INDEX_ARRAY_FILENAME = "filter_dimensions_index.npy"
+
+# Number of genes per organism queried when warming the TileDB caches of a newly loaded snapshot
+SNAPSHOT_WARMUP_GENE_COUNT = 10
+
 logger = logging.getLogger("wmg")
 
 
@@ -48,50 +63,248 @@ class WmgSnapshot:
     # precomputed list of ids for all gene and tissue ontology term ids per organism
     primary_filter_dimensions: Dict
 
+    # dictionaries mapping the term ids of each cube dimension to the integer codes stored in the cubes
+    term_id_codes: TermIdCodes
+
+    # Pandas DataFrame containing the distinct combinations of the (encoded) tissue, organism and secondary filter
+    # dimension values of the cell counts cube. Used to find the available secondary filter values of a query.
+    # Columns are listed by filter_dimensions_index_dims in backend/wmg/data/schemas/cube_schema.py.
+    filter_dimensions_index: DataFrame
+
+    # The file holding the shared lock on the local mirror of the snapshot, if it is mirrored. The mirror is kept for as
+    # long as the snapshot is referenced, as the lock is released when the file is closed upon garbage collection.
+    mirror_lock: Optional[IO] = None
+
 
 # Cached data
 cached_snapshot: Optional[WmgSnapshot] = None
 
+# Guards the initial, synchronous snapshot load and the start of the snapshot refresher
+_snapshot_lock = threading.Lock()
+_snapshot_refresher: Optional["_SnapshotRefresher"] = None
+
 
 def load_snapshot() -> WmgSnapshot:
     """
-    Loads and caches the WMG snapshot. Reloads the snapshot data if the latest_snapshot_identifier S3 object has
-    been updated.
+    Loads and caches the WMG snapshot. Only the first call loads the snapshot synchronously; it also starts a
+    background thread that polls the latest_snapshot_identifier S3 object and swaps in an updated (and pre-warmed)
+    snapshot, so that requests never read from S3 themselves.
     @return: WmgSnapshot object
     """
 
     global cached_snapshot
 
-    if new_snapshot_identifier := _update_latest_snapshot_identifier():
-        cached_snapshot = _load_snapshot(new_snapshot_identifier)
+    if cached_snapshot is None or _snapshot_refresher is None or not _snapshot_refresher.is_alive():
+        with _snapshot_lock:
+            if cached_snapshot is None:
+                new_snapshot_identifier = _update_latest_snapshot_identifier()
+                cached_snapshot = _load_snapshot(new_snapshot_identifier)
+            # (re)started if it has died, or was not carried over by a fork of the process
+            _start_snapshot_refresher()
     return cached_snapshot
 
 
+def refresh_snapshot() -> bool:
+    """
+    Loads and warms the latest snapshot, if it differs from the cached snapshot, and atomically swaps it in. Requests
+    that are in flight keep using the snapshot they started with.
+    @return: True if an updated snapshot was swapped in
+    """
+
+    global cached_snapshot
+
+    if new_snapshot_identifier := _update_latest_snapshot_identifier():
+        new_snapshot = _load_snapshot(new_snapshot_identifier)
+        _warm_snapshot(new_snapshot)
+        cached_snapshot = new_snapshot
+        logger.info(f"now serving snapshot {new_snapshot_identifier}")
+        return True
+    return False
+
+
+def _start_snapshot_refresher() -> None:
+    global _snapshot_refresher
+
+    if _snapshot_refresher is not None and _snapshot_refresher.is_alive():
+        return
+    _snapshot_refresher = _SnapshotRefresher(int(WmgConfig().snapshot_refresh_interval_seconds))
+    _snapshot_refresher.start()
+
+
+class _SnapshotRefresher:
+    """
+    Polls for an updated snapshot on an OS thread. The API server runs in gevent workers, which patch the threading
+    module (and the Thread class it had before patching) to start greenlets: the blocking snapshot load and warm up
+    would then stall all of the worker's requests.
+    """
+
+    def __init__(self, refresh_interval_seconds: int):
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self._alive = False
+
+    def start(self) -> None:
+        start_new_thread, sleep = _get_os_threading()
+        self._alive = True
+        try:
+            start_new_thread(self._run, (sleep,))
+        except Exception:
+            self._alive = False
+            raise
+
+    def is_alive(self) -> bool:
+        return self._alive
+
+    def _run(self, sleep: Callable[[float], None]) -> None:
+        try:
+            _refresh_snapshot_periodically(self.refresh_interval_seconds, sleep)
+        finally:
+            self._alive = False
+
+
+def _get_os_threading() -> Tuple[Callable, Callable[[float], None]]:
+    """
+    The functions starting an OS thread and sleeping, from before gevent patched them, if it did.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return _thread.start_new_thread, time.sleep
+    if monkey.is_module_patched("threading"):
+        return monkey.get_original("_thread", "start_new_thread"), monkey.get_original("time", "sleep")
+    return _thread.start_new_thread, time.sleep
+
+
+def _refresh_snapshot_periodically(refresh_interval_seconds: int, sleep: Callable[[float], None] = time.sleep) -> None:
+    while True:
+        sleep(refresh_interval_seconds)
+        try:
+            refresh_snapshot()
+        except Exception:
+            # keep serving the current snapshot and retry on the next poll
+            logger.exception("failed to refresh WMG snapshot")
+
+
+def _warm_snapshot(snapshot: WmgSnapshot) -> None:
+    """
+    Primes the TileDB tile caches of a newly loaded snapshot by running a representative set of queries against it:
+    all tissues of each organism, for the first few genes of that organism.
+    """
+    # must import lazily, as the query module depends upon this module
+    from backend.wmg.data.query import WmgQuery, WmgQueryCriteria
+
+    query = WmgQuery(snapshot)
+    for organism_term in snapshot.primary_filter_dimensions.get("organism_terms", []):
+        organism_ontology_term_id = next(iter(organism_term))
+        tissue_ontology_term_ids = [
+            next(iter(tissue_term))
+            for tissue_term in snapshot.primary_filter_dimensions["tissue_terms"].get(organism_ontology_term_id, [])
+        ]
+        gene_ontology_term_ids = [
+            next(iter(gene_term))
+            for gene_term in snapshot.primary_filter_dimensions["gene_terms"].get(organism_ontology_term_id, [])
+        ][:SNAPSHOT_WARMUP_GENE_COUNT]
+        if not tissue_ontology_term_ids or not gene_ontology_term_ids:
+            continue
+
+        criteria = WmgQueryCriteria(
+            gene_ontology_term_ids=gene_ontology_term_ids,
+            organism_ontology_term_id=organism_ontology_term_id,
+            tissue_ontology_term_ids=tissue_ontology_term_ids,
+        )
+        start = time.perf_counter()
+        query.expression_summary(criteria)
+        query.cell_counts(criteria)
+        logger.info(
+            f"warmed snapshot {snapshot.snapshot_identifier} for {organism_ontology_term_id} in "
+            f"{(time.perf_counter() - start):.4f}s"
+        )
+
+
 def _load_snapshot(new_snapshot_identifier) -> WmgSnapshot:
-    snapshot_base_uri = _build_snapshot_base_uri(new_snapshot_identifier)
+    if mirror_dir := WmgConfig().snapshot_local_mirror_dir:
+        # All of the API server processes of a host share a single local copy of the snapshot: the cubes' files are
+        # then cached once, by the OS page cache, and the filter dimensions index is memory-mapped
+        snapshot_base_uri, mirror_lock = mirror_snapshot(
+            new_snapshot_identifier, mirror_dir, _download_snapshot, _write_filter_dimensions_index_array
+        )
+
+        def read_artifact(filename: str) -> str:
+            with open(os.path.join(snapshot_base_uri, filename)) as f:
+                return f.read()
+
+        filter_dimensions_index = _map_filter_dimensions_index_array(snapshot_base_uri)
+    else:
+        snapshot_base_uri = _build_snapshot_base_uri(new_snapshot_identifier)
+
+        def read_artifact(filename: str) -> str:
+            return _read_s3obj(f"{new_snapshot_identifier}/{filename}")
+
+        filter_dimensions_index = _load_filter_dimensions_index(read_artifact)
+        mirror_lock = None
+
     logger.info(f"Loading WMG snapshot at {snapshot_base_uri}")
+    # the cubes share a single context, and so a single tile cache, which is budgeted per process
+    ctx = create_ctx(json.loads(WmgConfig().tiledb_config_overrides))
     # TODO: Okay to keep TileDB arrays open indefinitely? Is it faster than re-opening each request?
     #  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell
     #  -data-portal/2134
     return WmgSnapshot(
         snapshot_identifier=new_snapshot_identifier,
-        expression_summary_cube=_open_cube(f"{snapshot_base_uri}/{EXPRESSION_SUMMARY_CUBE_NAME}"),
-        cell_counts_cube=_open_cube(f"{snapshot_base_uri}/{CELL_COUNTS_CUBE_NAME}"),
-        cell_type_orderings=_load_cell_type_order(new_snapshot_identifier),
-        primary_filter_dimensions=_load_primary_filter_data(new_snapshot_identifier),
+        expression_summary_cube=tiledb.open(f"{snapshot_base_uri}/{EXPRESSION_SUMMARY_CUBE_NAME}", ctx=ctx),
+        cell_counts_cube=tiledb.open(f"{snapshot_base_uri}/{CELL_COUNTS_CUBE_NAME}", ctx=ctx),
+        cell_type_orderings=_load_cell_type_order(read_artifact),
+        primary_filter_dimensions=_load_primary_filter_data(read_artifact),
+        term_id_codes=_load_term_id_codes(read_artifact),
+        filter_dimensions_index=filter_dimensions_index,
+        mirror_lock=mirror_lock,
     )
 
 
-def _open_cube(cube_uri) -> Array:
-    return tiledb.open(cube_uri, ctx=create_ctx(json.loads(WmgConfig().tiledb_config_overrides)))
+def _load_cell_type_order(read_artifact: Callable[[str], str]) -> DataFrame:
+    return pd.read_json(read_artifact(CELL_TYPE_ORDERINGS_FILENAME))
+
+
+def _load_primary_filter_data(read_artifact: Callable[[str], str]) -> Dict:
+    return json.loads(read_artifact(PRIMARY_FILTER_DIMENSIONS_FILENAME))
+
+
+def _load_term_id_codes(read_artifact: Callable[[str], str]) -> TermIdCodes:
+    return TermIdCodes.from_json(read_artifact(TERM_ID_CODES_FILENAME))
 
 
-def _load_cell_type_order(snapshot_identifier: str) -> DataFrame:
-    return pd.read_json(_read_s3obj(f"{snapshot_identifier}/{CELL_TYPE_ORDERINGS_FILENAME}"))
+def _load_filter_dimensions_index(read_artifact: Callable[[str], str]) -> DataFrame:
+    return pd.read_json(read_artifact(FILTER_DIMENSIONS_INDEX_FILENAME), orient="split")
+
+
+def _download_snapshot(snapshot_identifier: str, local_dir: str) -> None:
+    # only the data artifacts used by the API are downloaded, and not the integrated corpus
+    bucket = buckets.portal_resource.Bucket(WmgConfig().bucket)
+    snapshot_prefix = os.path.join(_build_data_path_prefix(), snapshot_identifier)
+    for cube_name in (EXPRESSION_SUMMARY_CUBE_NAME, CELL_COUNTS_CUBE_NAME):
+        download_s3_prefix(bucket, f"{snapshot_prefix}/{cube_name}", os.path.join(local_dir, cube_name))
+    for filename in (
+        CELL_TYPE_ORDERINGS_FILENAME,
+        PRIMARY_FILTER_DIMENSIONS_FILENAME,
+        TERM_ID_CODES_FILENAME,
+        FILTER_DIMENSIONS_INDEX_FILENAME,
+    ):
+        bucket.download_file(f"{snapshot_prefix}/{filename}", os.path.join(local_dir, filename))
+
+
+def _write_filter_dimensions_index_array(local_dir: str) -> None:
+    with open(os.path.join(local_dir, FILTER_DIMENSIONS_INDEX_FILENAME)) as f:
+        filter_dimensions_index = _load_filter_dimensions_index(lambda _: f.read())
+    # stored column by column, so that each column of the memory-mapped DataFrame is contiguous
+    np.save(
+        os.path.join(local_dir, FILTER_DIMENSIONS_INDEX_ARRAY_FILENAME),
+        np.ascontiguousarray(filter_dimensions_index[filter_dimensions_index_dims].to_numpy(dtype=np.uint32).T),
+    )
 
 
-def _load_primary_filter_data(snapshot_identifier: str) -> Dict:
-    return json.loads(_read_s3obj(f"{snapshot_identifier}/{PRIMARY_FILTER_DIMENSIONS_FILENAME}"))
+def _map_filter_dimensions_index_array(local_dir: str) -> DataFrame:
+    # the DataFrame is backed by the read-only memory map, so it is shared by all of the processes of the host
+    columns = np.load(os.path.join(local_dir, FILTER_DIMENSIONS_INDEX_ARRAY_FILENAME), mmap_mode="r")
+    return DataFrame(columns.T, columns=filter_dimensions_index_dims, copy=False)
 
 
 def _read_s3obj(relative_path: str) -> str:
@@ -103,10 +316,6 @@ def _read_s3obj(relative_path: str) -> str:
     return s3obj.get()["Body"].read().decode("utf-8").strip()
 
 
-# TODO: Worth doing this on a thread, continuously, rather than on-demand, in order to proactively load an updated
-#  snapshot (and maybe warm the TileDB caches?) before a user needs to query the data:
-#  https://app.zenhub.com/workspaces/single-cell-5e2a191dad828d52cc78b028/issues/chanzuckerberg/single-cell-data
-#  -portal/2134
 def _update_latest_snapshot_identifier() -> Optional[str]:
     global cached_snapshot
 
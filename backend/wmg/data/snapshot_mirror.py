@@ -0,0 +1,94 @@
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Tuple
+
+logger = logging.getLogger("wmg")
+
+# Name of the file used to serialize mirroring across the processes of a host
+MIRROR_LOCK_FILENAME = ".lock"
+
+# Number of concurrent S3 object downloads when mirroring a snapshot
+MIRROR_DOWNLOAD_THREADS = 16
+
+
+def mirror_snapshot(
+    snapshot_identifier: str,
+    mirror_dir: str,
+    download_fn: Callable[[str, str], None],
+    prepare_fn: Callable[[str], None] = lambda _: None,
+) -> Tuple[str, IO]:
+    """
+    Mirrors a snapshot to the local filesystem, once per host, and returns the path of the mirrored snapshot, along
+    with a file that holds a shared lock on it. The first process to request a snapshot downloads it
+    (`download_fn(snapshot_identifier, local_dir)`) and derives any additional local artifacts
+    (`prepare_fn(local_dir)`), while other processes wait for it and then reuse the mirror. The snapshot only becomes
+    visible at its final path once it is complete. The lock file must be kept open for as long as the snapshot is in
+    use: the mirrored snapshots that are no longer locked by any process of the host are removed.
+    """
+    local_snapshot_dir = os.path.join(mirror_dir, snapshot_identifier)
+    os.makedirs(mirror_dir, exist_ok=True)
+    with open(os.path.join(mirror_dir, MIRROR_LOCK_FILENAME), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.isdir(local_snapshot_dir):
+                logger.info(f"mirroring snapshot {snapshot_identifier} to {local_snapshot_dir}")
+                download_dir = tempfile.mkdtemp(prefix=f".{snapshot_identifier}-", dir=mirror_dir)
+                try:
+                    download_fn(snapshot_identifier, download_dir)
+                    prepare_fn(download_dir)
+                except Exception:
+                    shutil.rmtree(download_dir, ignore_errors=True)
+                    raise
+                os.rename(download_dir, local_snapshot_dir)
+            # locked while mirroring is serialized, so that the snapshot cannot be removed before it is in use
+            snapshot_lock_file = open(_snapshot_lock_path(mirror_dir, snapshot_identifier), "a")
+            fcntl.flock(snapshot_lock_file, fcntl.LOCK_SH)
+            _remove_stale_snapshots(mirror_dir)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return local_snapshot_dir, snapshot_lock_file
+
+
+def download_s3_prefix(bucket, prefix: str, local_dir: str) -> None:
+    """
+    Downloads all of the objects under the given S3 prefix (of a boto3 Bucket) to the local directory, preserving
+    their relative paths
+    """
+    prefix = prefix.rstrip("/") + "/"
+
+    def download(object_key: str) -> None:
+        local_path = os.path.join(local_dir, os.path.relpath(object_key, prefix))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        bucket.download_file(object_key, local_path)
+
+    object_keys = [obj.key for obj in bucket.objects.filter(Prefix=prefix) if not obj.key.endswith("/")]
+    with ThreadPoolExecutor(max_workers=MIRROR_DOWNLOAD_THREADS) as executor:
+        # consume the results, to raise any download error
+        list(executor.map(download, object_keys))
+
+
+def _remove_stale_snapshots(mirror_dir: str) -> None:
+    """
+    Removes the mirrored snapshots that are not locked by any process of the host (see mirror_snapshot). A snapshot
+    that is still in use is removed by a later call, once it has been released.
+    """
+    for entry in os.scandir(mirror_dir):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        snapshot_lock_path = _snapshot_lock_path(mirror_dir, entry.name)
+        with open(snapshot_lock_path, "a") as snapshot_lock_file:
+            try:
+                fcntl.flock(snapshot_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            logger.info(f"removing mirrored snapshot {entry.path}")
+            shutil.rmtree(entry.path, ignore_errors=True)
+            os.remove(snapshot_lock_path)
+
+
+def _snapshot_lock_path(mirror_dir: str, snapshot_identifier: str) -> str:
+    return os.path.join(mirror_dir, f".{snapshot_identifier}{MIRROR_LOCK_FILENAME}")
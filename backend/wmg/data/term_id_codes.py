@@ -0,0 +1,72 @@
+import json
+from typing import Dict, Iterable, List
+
+import numpy as np
+from pandas import DataFrame
+
+# Code that is never assigned to a term id (it is the upper bound of the cube dimensions' domain). Querying for it
+# matches nothing, which is the expected result when querying for term ids that are not present in a snapshot.
+NO_MATCH_CODE = np.iinfo(np.uint32).max - 1
+
+
+def term_id_as_str(term_id) -> str:
+    # the string dimensions and attributes of the integrated corpus are read as ascii bytes
+    return term_id.decode("ascii") if isinstance(term_id, bytes) else term_id
+
+
+class TermIdCodes:
+    """
+    Snapshot-level dictionaries that map the ontology term ids (and dataset ids) of each logical cube dimension to the
+    dense uint32 codes that are stored in the cubes. The code of a term id is its position in the dimension's
+    dictionary. The gene dictionary is ordered by the integrated corpus var_idx, so a gene's code is its var_idx.
+    """
+
+    def __init__(self, term_ids_by_dim: Dict[str, List[str]]):
+        term_ids_by_dim = {
+            dim_name: [term_id_as_str(term_id) for term_id in term_ids]
+            for dim_name, term_ids in term_ids_by_dim.items()
+        }
+        self.term_ids_by_dim = term_ids_by_dim
+        self._term_ids = {dim_name: np.array(term_ids, dtype=object) for dim_name, term_ids in term_ids_by_dim.items()}
+        self._codes = {
+            dim_name: {term_id: code for code, term_id in enumerate(term_ids)}
+            for dim_name, term_ids in term_ids_by_dim.items()
+        }
+
+    def encode(self, dim_name: str, term_ids: Iterable[str]) -> List[int]:
+        """
+        Returns the codes of the given term ids, omitting the term ids that are not in the dimension's dictionary
+        """
+        codes = self._codes[dim_name]
+        return [codes[term_id_as_str(term_id)] for term_id in term_ids if term_id_as_str(term_id) in codes]
+
+    def encode_array(self, dim_name: str, term_ids: Iterable[str]) -> np.ndarray:
+        """
+        Returns the codes of the given term ids (str or ascii bytes) as a uint32 array. All term ids must be in the
+        dimension's dictionary.
+        """
+        codes = self._codes[dim_name]
+        return np.array([codes[term_id_as_str(term_id)] for term_id in term_ids], dtype=np.uint32)
+
+    def decode(self, dim_name: str, codes: np.ndarray) -> np.ndarray:
+        return self._term_ids[dim_name][codes]
+
+    def decode_df(self, df: DataFrame) -> DataFrame:
+        """
+        Returns a copy of the given DataFrame, in which the codes of each dictionary-encoded column are replaced by
+        their term ids
+        """
+        return df.assign(
+            **{
+                dim_name: self.decode(dim_name, df[dim_name].values)
+                for dim_name in df.columns
+                if dim_name in self._term_ids
+            }
+        )
+
+    def to_json(self) -> str:
+        return json.dumps(self.term_ids_by_dim)
+
+    @classmethod
+    def from_json(cls, term_id_codes_json: str) -> "TermIdCodes":
+        return cls(json.loads(term_id_codes_json))
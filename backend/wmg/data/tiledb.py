@@ -9,7 +9,7 @@ from backend.corpora.common.utils.math_utils import MB, GB
 def create_ctx(config_overrides: dict = {}) -> tiledb.Ctx:
     cfg = {
         "py.init_buffer_bytes": int(0.5 * GB),
-        "sm.tile_cache_size": 100 * MB if os.getenv("DEPLOYMENT_STAGE", "test") == "test" else virtual_memory_size(0.5),
+        "sm.tile_cache_size": 100 * MB if os.getenv("DEPLOYMENT_STAGE", "test") == "test" else tile_cache_size(0.5),
         "sm.consolidation.buffer_size": consolidation_buffer_size(0.1),
         "sm.query.sparse_unordered_with_dups.non_overlapping_ranges": "true",
     }
@@ -38,6 +38,20 @@ def virtual_memory_size(vm_fraction: float) -> int:
     return fractional_mem_bytes // MB * MB  # round down to MB boundary
 
 
+def tile_cache_size(vm_fraction: float) -> int:
+    # the tile cache is private to each process, so the memory budget is split across the API server's worker
+    # processes, rather than letting each of them claim the full fraction of the host's memory
+    return virtual_memory_size(vm_fraction) // api_worker_count() // MB * MB  # round down to MB boundary
+
+
+def api_worker_count() -> int:
+    """
+    Returns the number of worker processes of the gunicorn server that runs the API. gunicorn takes it from the
+    WEB_CONCURRENCY environment variable, which is set by the API server's image. Defaults to 1 (e.g. in tests).
+    """
+    return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
 def consolidation_buffer_size(vm_fraction: float) -> int:
     # consolidation buffer heuristic to prevent thrashing: total_mem/io_concurrency_level, rounded to GB
     io_concurrency_level = int(tiledb.Config()["sm.io_concurrency_level"])
@@ -1,37 +1,81 @@
-import tiledb
-import pandas as pd
-
-from backend.wmg.data.ontology_labels import ontology_term_label, gene_term_label
-from typing import Dict, List, Iterable, Set
 import json
+from typing import Dict, List, Set
+
+import pandas as pd
+import tiledb
 
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import (
+    extract_partial_gene_ids_by_organism,
+    list_partials,
+)
+from backend.wmg.data.ontology_labels import build_gene_id_label_mapping, build_ontology_term_id_label_mapping
 from backend.wmg.data.snapshot import (
+    CELL_COUNTS_CUBE_NAME,
     CELL_TYPE_ORDERINGS_FILENAME,
-    EXPRESSION_SUMMARY_CUBE_NAME,
     PRIMARY_FILTER_DIMENSIONS_FILENAME,
+    TERM_ID_CODES_FILENAME,
 )
+from backend.wmg.data.term_id_codes import TermIdCodes
+from backend.wmg.data.utils import get_all_dataset_ids
+
+
+def generate_snapshot_artifacts(snapshot_path: str, corpus_name: str, snapshot_id: int) -> None:
+    """
+    Generate the cell type orderings and the primary filter dimensions of a snapshot in a single pass over its cell
+    counts cube, with the genes of each organism listed by the expression summary partials' metadata, rather than by
+    scanning the integrated corpus' obs and the expression summary cube
+    """
+    corpus_path = f"{snapshot_path}/{corpus_name}"
+    with open(f"{corpus_path}/{TERM_ID_CODES_FILENAME}") as f:
+        term_id_codes = TermIdCodes.from_json(f.read())
+
+    cell_counts_term_ids = extract_cell_counts_term_ids(corpus_path, term_id_codes)
+    generate_cell_ordering(snapshot_path, get_cell_types_by_tissue(cell_counts_term_ids))
+    organism_gene_ids = extract_organism_gene_ids(corpus_path)
+    generate_primary_filter_dimensions(snapshot_path, snapshot_id, cell_counts_term_ids, organism_gene_ids)
+
+
+def extract_cell_counts_term_ids(corpus_path: str, term_id_codes: TermIdCodes) -> pd.DataFrame:
+    """
+    Return the distinct (organism, tissue, cell type) term ids of the cell counts cube
+    """
+    with tiledb.open(f"{corpus_path}/{CELL_COUNTS_CUBE_NAME}") as cube:
+        codes = cube.query(
+            attrs=["cell_type_ontology_term_id"], dims=["organism_ontology_term_id", "tissue_ontology_term_id"]
+        ).df[:]
+    # the codes are decoded once deduplicated, as the cube has a row per combination of all of its dimensions
+    return term_id_codes.decode_df(codes.drop_duplicates(ignore_index=True))
+
+
+def extract_organism_gene_ids(corpus_path: str) -> Dict[str, List[str]]:
+    """
+    Return the sorted ids of the genes with non-zero expression in each organism, as listed by the expression summary
+    partials of the datasets in the integrated corpus
+    """
+    partial_dataset_ids = set(list_partials(corpus_path))
+    organism_gene_ids: Dict[str, Set[str]] = {}
+    for dataset_id in get_all_dataset_ids(corpus_path):
+        if dataset_id in partial_dataset_ids:
+            for organism, gene_ids in extract_partial_gene_ids_by_organism(corpus_path, dataset_id).items():
+                organism_gene_ids.setdefault(organism, set()).update(gene_ids)
+
+    return {organism: sorted(gene_ids) for organism, gene_ids in sorted(organism_gene_ids.items())}
 
 
-def get_cell_types_by_tissue(corpus_group: str) -> Dict:
+def get_cell_types_by_tissue(cell_counts_term_ids: pd.DataFrame) -> Dict:
     """
     Return a list of all associated cell type ontologies for each tissue contained in the
-    provided corpus
+    provided cell counts cube term ids
     """
-    with tiledb.open(f"{corpus_group}/obs", "r") as obs:
-        tissue_cell_types = (
-            obs.query(attrs=[], dims=["tissue_ontology_term_id", "cell_type_ontology_term_id"])
-            .df[:]
-            .drop_duplicates()
-            .sort_values(by="tissue_ontology_term_id")
-        )
-    unique_tissue_ontology_term_id = tissue_cell_types.tissue_ontology_term_id.unique()
-    cell_type_by_tissue = {}
-    for x in unique_tissue_ontology_term_id:
-        cell_type_by_tissue[x] = tissue_cell_types.loc[
-            tissue_cell_types["tissue_ontology_term_id"] == x, "cell_type_ontology_term_id"
-        ]
-
-    return cell_type_by_tissue
+    tissue_cell_types = (
+        cell_counts_term_ids[["tissue_ontology_term_id", "cell_type_ontology_term_id"]]
+        .drop_duplicates()
+        .sort_values(by="tissue_ontology_term_id")
+    )
+    return {
+        tissue: cell_types.cell_type_ontology_term_id
+        for tissue, cell_types in tissue_cell_types.groupby("tissue_ontology_term_id")
+    }
 
 
 def generate_cell_ordering(snapshot_path: str, cell_type_by_tissue: Dict) -> None:
@@ -100,61 +144,36 @@ def generate_cell_ordering(snapshot_path: str, cell_type_by_tissue: Dict) -> Non
     df.to_json(f"{snapshot_path}/{CELL_TYPE_ORDERINGS_FILENAME}")
 
 
-def generate_primary_filter_dimensions(snapshot_path: str, corpus_name: str, snapshot_id: int):
-
-    # TODO: remove them from WmgQuery (next 4 following functions)
-    def list_primary_filter_dimension_term_ids(cube, primary_dim_name: str):
-        return cube.query(attrs=[], dims=[primary_dim_name]).df[:].groupby([primary_dim_name]).first().index.tolist()
-
-    def list_grouped_primary_filter_dimensions_term_ids(
-        cube, primary_dim_name: str, group_by_dim: str
-    ) -> Dict[str, List[str]]:
-        return (
-            cube.query(attrs=[], dims=[primary_dim_name, group_by_dim])
-            .df[:]
-            .drop_duplicates()
-            .groupby(group_by_dim)
-            .agg(list)
-            .to_dict()[primary_dim_name]
-        )
-
-    def build_gene_id_label_mapping(gene_ontology_term_ids: List[str]) -> List[dict]:
-        return [
-            {gene_ontology_term_id: gene_term_label(gene_ontology_term_id)}
-            for gene_ontology_term_id in gene_ontology_term_ids
-        ]
-
-    def build_ontology_term_id_label_mapping(ontology_term_ids: Iterable[str]) -> List[dict]:
-        return [{ontology_term_id: ontology_term_label(ontology_term_id)} for ontology_term_id in ontology_term_ids]
-
-    with tiledb.open(f"{snapshot_path}/{corpus_name}/{EXPRESSION_SUMMARY_CUBE_NAME}") as cube:
-
-        # gene terms are grouped by organism, and represented as a nested lists in dict, keyed by organism
-        organism_gene_ids: dict[str, List[str]] = list_grouped_primary_filter_dimensions_term_ids(
-            cube, "gene_ontology_term_id", group_by_dim="organism_ontology_term_id"
-        )
-        organism_gene_terms = {
-            organism_term_id: build_gene_id_label_mapping(gene_term_ids)
-            for organism_term_id, gene_term_ids in organism_gene_ids.items()
-        }
-
-        # tissue terms are grouped by organism, and represented as a nested lists in dict, keyed by organism
-        organism_tissue_ids: dict[str, List[str]] = list_grouped_primary_filter_dimensions_term_ids(
-            cube, "tissue_ontology_term_id", group_by_dim="organism_ontology_term_id"
-        )
-        organism_tissue_terms = {
-            organism_term_id: build_ontology_term_id_label_mapping(tissue_term_ids)
-            for organism_term_id, tissue_term_ids in organism_tissue_ids.items()
-        }
-
-        result = dict(
-            snapshot_id=str(snapshot_id),
-            organism_terms=build_ontology_term_id_label_mapping(
-                list_primary_filter_dimension_term_ids(cube, "organism_ontology_term_id")
-            ),
-            tissue_terms=organism_tissue_terms,
-            gene_terms=organism_gene_terms,
-        )
-
-        with open(f"{snapshot_path}/{PRIMARY_FILTER_DIMENSIONS_FILENAME}", "w") as f:
-            json.dump(result, f)
+def generate_primary_filter_dimensions(
+    snapshot_path: str,
+    snapshot_id: int,
+    cell_counts_term_ids: pd.DataFrame,
+    organism_gene_ids: Dict[str, List[str]],
+) -> None:
+    # gene and tissue terms are grouped by organism, and represented as a nested lists in dict, keyed by organism
+    organism_gene_terms = {
+        organism_term_id: build_gene_id_label_mapping(gene_term_ids)
+        for organism_term_id, gene_term_ids in organism_gene_ids.items()
+    }
+    organism_tissue_ids = (
+        cell_counts_term_ids[["organism_ontology_term_id", "tissue_ontology_term_id"]]
+        .drop_duplicates()
+        .sort_values(by=["organism_ontology_term_id", "tissue_ontology_term_id"])
+        .groupby("organism_ontology_term_id")
+        .agg(list)
+        .to_dict()["tissue_ontology_term_id"]
+    )
+    organism_tissue_terms = {
+        organism_term_id: build_ontology_term_id_label_mapping(tissue_term_ids)
+        for organism_term_id, tissue_term_ids in organism_tissue_ids.items()
+    }
+
+    result = dict(
+        snapshot_id=str(snapshot_id),
+        organism_terms=build_ontology_term_id_label_mapping(sorted(organism_tissue_ids)),
+        tissue_terms=organism_tissue_terms,
+        gene_terms=organism_gene_terms,
+    )
+
+    with open(f"{snapshot_path}/{PRIMARY_FILTER_DIMENSIONS_FILENAME}", "w") as f:
+        json.dump(result, f)
@@ -5,9 +5,11 @@ import pathlib
 import anndata
 from pathlib import Path
 
+import pandas as pd
 import tiledb
 
-from backend.wmg.data.snapshot import EXPRESSION_SUMMARY_CUBE_NAME, CELL_COUNTS_CUBE_NAME
+from backend.wmg.data.snapshot import EXPRESSION_SUMMARY_CUBE_NAME, CELL_COUNTS_CUBE_NAME, TERM_ID_CODES_FILENAME
+from backend.wmg.data.term_id_codes import TermIdCodes, NO_MATCH_CODE
 from backend.corpora.common.utils.math_utils import GB
 from backend.wmg.data.validation import fixtures
 
@@ -30,6 +32,20 @@ class Validation:
         self.MIN_ACTB_GENE_EXPRESSION_CELL_COUNT_PERCENT = 60
         self.MIN_MALAT1_RANKIT_EXPRESSION = 4
         self.MIN_ACTB_RANKIT_EXPRESSION = 2.75
+        with open(f"{corpus_path}/{TERM_ID_CODES_FILENAME}") as f:
+            self.term_id_codes = TermIdCodes.from_json(f.read())
+
+    def read_cube(self, cube: tiledb.Array, **term_ids: str) -> pd.DataFrame:
+        """
+        Read the cube, sliced by the given term id of any of its indexed dimensions, with the term id codes decoded
+        """
+        coords = tuple(
+            (self.term_id_codes.encode(dim.name, [term_ids[dim.name]]) or [NO_MATCH_CODE])
+            if dim.name in term_ids
+            else slice(None)
+            for dim in cube.schema.domain
+        )
+        return self.term_id_codes.decode_df(cube.df[coords])
 
     def validate_cube(self):
         """
@@ -101,7 +117,7 @@ class Validation:
 
     def validate_cube_species(self):
         with tiledb.open(self.expression_summary_path, "r") as cube:
-            species_list = cube.df[:].organism_ontology_term_id.drop_duplicates().to_list()
+            species_list = self.read_cube(cube).organism_ontology_term_id.drop_duplicates().to_list()
             species_count = len(species_list)
             if self.MIN_SPECIES_COUNT > species_count:
                 self.errors.append(
@@ -117,7 +133,7 @@ class Validation:
 
     def validate_tissues_in_cube(self):
         with tiledb.open(self.expression_summary_path, "r") as cube:
-            tissue_list = cube.df[:].tissue_ontology_term_id.drop_duplicates().to_list()
+            tissue_list = self.read_cube(cube).tissue_ontology_term_id.drop_duplicates().to_list()
             tissue_count = len(tissue_list)
             if self.MIN_TISSUE_COUNT > tissue_count:
                 self.errors.append(f"Only {tissue_count} tissues included in cube")
@@ -132,14 +148,18 @@ class Validation:
     def validate_housekeeping_gene_expression_levels(self, path_to_cell_count_cube):
         with tiledb.open(path_to_cell_count_cube, "r") as cell_count_cube:
             human_ontology_id = fixtures.validation_species_ontologies["human"]
-            cell_count_human = cell_count_cube.df[:, human_ontology_id:human_ontology_id].n_cells.sum()
+            cell_count_human = self.read_cube(
+                cell_count_cube, organism_ontology_term_id=human_ontology_id
+            ).n_cells.sum()
             with tiledb.open(self.expression_summary_path) as cube:
                 MALAT1_ont_id = fixtures.validation_gene_ontologies["MALAT1"]
-                MALAT1_human_expression_cube = cube.df[
-                    MALAT1_ont_id:MALAT1_ont_id, :, human_ontology_id:human_ontology_id
-                ]
+                MALAT1_human_expression_cube = self.read_cube(
+                    cube, gene_ontology_term_id=MALAT1_ont_id, organism_ontology_term_id=human_ontology_id
+                )
                 ACTB_ont_id = fixtures.validation_gene_ontologies["ACTB"]
-                ACTB_human_expression_cube = cube.df[ACTB_ont_id:ACTB_ont_id, :, human_ontology_id:human_ontology_id]
+                ACTB_human_expression_cube = self.read_cube(
+                    cube, gene_ontology_term_id=ACTB_ont_id, organism_ontology_term_id=human_ontology_id
+                )
                 MALAT1_cell_count = MALAT1_human_expression_cube.nnz.sum()
                 ACTB_cell_count = ACTB_human_expression_cube.nnz.sum()
                 # Most cells should express both genes, more cells should express MALAT1
@@ -154,8 +174,12 @@ class Validation:
                         f"less than " f"{self.MIN_ACTB_GENE_EXPRESSION_CELL_COUNT_PERCENT}% of cells express ACTB"
                     )
 
-                MALAT1_avg_expression = cube.df[MALAT1_ont_id:MALAT1_ont_id]["sum"].sum() / MALAT1_cell_count
-                ACTB_avg_expression = cube.df[ACTB_ont_id:ACTB_ont_id]["sum"].sum() / ACTB_cell_count
+                MALAT1_avg_expression = (
+                    self.read_cube(cube, gene_ontology_term_id=MALAT1_ont_id)["sum"].sum() / MALAT1_cell_count
+                )
+                ACTB_avg_expression = (
+                    self.read_cube(cube, gene_ontology_term_id=ACTB_ont_id)["sum"].sum() / ACTB_cell_count
+                )
                 if self.MIN_MALAT1_RANKIT_EXPRESSION > MALAT1_avg_expression:
                     self.errors.append(f"MALAT1 avg rankit score is {MALAT1_avg_expression}")
                 if self.MIN_ACTB_RANKIT_EXPRESSION > ACTB_avg_expression:
@@ -168,11 +192,13 @@ class Validation:
             female_ontology_id = fixtures.validation_sex_ontologies["female"]
             male_ontology_id = fixtures.validation_sex_ontologies["male"]
             MALAT1_ont_id = fixtures.validation_gene_ontologies["MALAT1"]
-            human_malat1_cube = cube.df[MALAT1_ont_id:MALAT1_ont_id, :, human_ontology_id:human_ontology_id]
+            human_malat1_cube = self.read_cube(
+                cube, gene_ontology_term_id=MALAT1_ont_id, organism_ontology_term_id=human_ontology_id
+            )
             # slice cube by dimensions             gene_ontology      organ (all)          species
-            human_XIST_cube = cube.df[
-                sex_marker_gene_ontology_id:sex_marker_gene_ontology_id, :, human_ontology_id:human_ontology_id
-            ]
+            human_XIST_cube = self.read_cube(
+                cube, gene_ontology_term_id=sex_marker_gene_ontology_id, organism_ontology_term_id=human_ontology_id
+            )
 
             female_xist_cube = human_XIST_cube.query(f"sex_ontology_term_id == '{female_ontology_id}'")
             male_xist_cube = human_XIST_cube.query(f"sex_ontology_term_id == '{male_ontology_id}'")
@@ -213,19 +239,39 @@ class Validation:
         # other cell types
         with tiledb.open(self.expression_summary_path) as cube:
             FCN1_ont_id = fixtures.validation_gene_ontologies["FCN1"]
-            FCN1_human_lung_cube = cube.df[FCN1_ont_id:FCN1_ont_id, lung_ont_id:lung_ont_id, human_ont_id:human_ont_id]
+            FCN1_human_lung_cube = self.read_cube(
+                cube,
+                gene_ontology_term_id=FCN1_ont_id,
+                tissue_ontology_term_id=lung_ont_id,
+                organism_ontology_term_id=human_ont_id,
+            )
             self.validate_FCN1(FCN1_human_lung_cube)
 
             TUBB4B_ont_id = fixtures.validation_gene_ontologies["TUBB4B"]
-            TUBB4B_human_lung = cube.df[TUBB4B_ont_id:TUBB4B_ont_id, lung_ont_id:lung_ont_id, human_ont_id:human_ont_id]
+            TUBB4B_human_lung = self.read_cube(
+                cube,
+                gene_ontology_term_id=TUBB4B_ont_id,
+                tissue_ontology_term_id=lung_ont_id,
+                organism_ontology_term_id=human_ont_id,
+            )
             self.validate_TUBB4B(TUBB4B_human_lung)
 
             CD68_ont_id = fixtures.validation_gene_ontologies["CD68"]
-            CD68_human_lung = cube.df[CD68_ont_id:CD68_ont_id, lung_ont_id:lung_ont_id, human_ont_id:human_ont_id]
+            CD68_human_lung = self.read_cube(
+                cube,
+                gene_ontology_term_id=CD68_ont_id,
+                tissue_ontology_term_id=lung_ont_id,
+                organism_ontology_term_id=human_ont_id,
+            )
             self.validate_CD68(CD68_human_lung)
 
             AQP5_ont_id = fixtures.validation_gene_ontologies["AQP5"]
-            AQP5_human_lung = cube.df[AQP5_ont_id:AQP5_ont_id, lung_ont_id:lung_ont_id, human_ont_id:human_ont_id]
+            AQP5_human_lung = self.read_cube(
+                cube,
+                gene_ontology_term_id=AQP5_ont_id,
+                tissue_ontology_term_id=lung_ont_id,
+                organism_ontology_term_id=human_ont_id,
+            )
             self.validate_AQP5(AQP5_human_lung)
 
     def validate_FCN1(self, FCN1_human_lung_cube):
@@ -327,12 +373,18 @@ class Validation:
         MALAT1_ont_id = fixtures.validation_gene_ontologies["MALAT1"]
         CCL5_ont_id = fixtures.validation_gene_ontologies["CCL5"]
         with tiledb.open(self.expression_summary_path) as cube:
-            MALAT1_human_lung_cube = cube.df[
-                MALAT1_ont_id:MALAT1_ont_id, human_lung_int:human_lung_int, human_ont_id:human_ont_id
-            ]
-            CCL5_human_lung_cube = cube.df[
-                CCL5_ont_id:CCL5_ont_id, human_lung_int:human_lung_int, human_ont_id:human_ont_id
-            ]
+            MALAT1_human_lung_cube = self.read_cube(
+                cube,
+                gene_ontology_term_id=MALAT1_ont_id,
+                tissue_ontology_term_id=human_lung_int,
+                organism_ontology_term_id=human_ont_id,
+            )
+            CCL5_human_lung_cube = self.read_cube(
+                cube,
+                gene_ontology_term_id=CCL5_ont_id,
+                tissue_ontology_term_id=human_lung_int,
+                organism_ontology_term_id=human_ont_id,
+            )
 
             MALAT1_expression = MALAT1_human_lung_cube.query(f"dataset_id == '{self.validation_dataset_id}'")
             CCL5_expression = CCL5_human_lung_cube.query(f"dataset_id == '{self.validation_dataset_id}'")
@@ -379,7 +431,7 @@ class Validation:
     def validate_dataset_counts(self):
         # todo check # of datasets in dataset folder and number from relational db
         with tiledb.open(self.expression_summary_path) as cube:
-            datasets = cube.df[:].dataset_id.drop_duplicates()
+            datasets = self.read_cube(cube).dataset_id.drop_duplicates()
             dataset_count = len(datasets)
             if self.MIN_DATASET_COUNT > dataset_count:
                 self.errors.append("Not enough datasets in the cube")
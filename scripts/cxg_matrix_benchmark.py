@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import anndata
+import numpy as np
+import tiledb
+from scipy import sparse
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from backend.corpora.common.utils.cxg_generation_utils import convert_matrix_to_cxg_array  # noqa: E402
+
+"""
+Benchmark the CXG X matrix writer against the previous writer, which densified each block of rows to find its nonzero
+values, on the sparse X matrix of a synthetic H5AD, and verify that both write the same values
+"""
+
+
+def densifying_convert_matrix_to_cxg_array(matrix_name, matrix, ctx):
+    """
+    The previous sparse path of convert_matrix_to_cxg_array, which writes into the array created by the current one
+    """
+    number_of_rows = matrix.shape[0]
+    stride = min(int(np.power(10, np.around(np.log10(1e9 / matrix.shape[1])))), 10_000)
+    with tiledb.open(matrix_name, mode="w", ctx=ctx) as array:
+        for start_row_index in range(0, number_of_rows, stride):
+            end_row_index = min(start_row_index + stride, number_of_rows)
+            matrix_subset = matrix[start_row_index:end_row_index, :]
+            if not isinstance(matrix_subset, np.ndarray):
+                matrix_subset = matrix_subset.toarray()
+            indices = np.nonzero(matrix_subset)
+            trow = indices[0] + start_row_index
+            array[trow, indices[1]] = matrix_subset[indices[0], indices[1]]
+
+
+def synthetic_h5ad(path: str, n_cells: int, n_genes: int, density: float, seed: int) -> str:
+    X = sparse.random(n_cells, n_genes, density=density, format="csr", random_state=seed, dtype=np.float32)
+    X.data = np.round(X.data * 100) + 1
+    h5ad_path = f"{path}/synthetic.h5ad"
+    anndata.AnnData(X=X).write_h5ad(h5ad_path)
+    return h5ad_path
+
+
+def time_writer(write_fn, matrix_name: str) -> (float, int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    write_fn(matrix_name)
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak_bytes
+
+
+def read_sorted_cells(matrix_name: str) -> np.ndarray:
+    with tiledb.open(matrix_name) as array:
+        cells = array[:, :]
+    order = np.lexsort((cells["var"], cells["obs"]))
+    return np.stack([cells["obs"][order], cells["var"][order], cells[""][order]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cells", type=int, help="number of cells (rows)", default=100_000)
+    parser.add_argument("--genes", type=int, help="number of genes (columns)", default=20_000)
+    parser.add_argument("--density", type=float, help="fraction of non-zero values", default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        X = anndata.read_h5ad(synthetic_h5ad(path, args.cells, args.genes, args.density, args.seed)).X
+        print(f"matrix: {X.shape[0]} x {X.shape[1]}, nnz={X.nnz}")
+        ctx = tiledb.Ctx()
+
+        def write(matrix_name):
+            convert_matrix_to_cxg_array(matrix_name, X, True, ctx)
+
+        def write_densifying(matrix_name):
+            # create the array with an empty matrix of the same shape, then write with the previous writer
+            convert_matrix_to_cxg_array(matrix_name, sparse.csr_matrix(X.shape, dtype=X.dtype), True, ctx)
+            densifying_convert_matrix_to_cxg_array(matrix_name, X, ctx)
+
+        densifying_seconds, densifying_peak_bytes = time_writer(write_densifying, f"{path}/X_densifying")
+        seconds, peak_bytes = time_writer(write, f"{path}/X")
+        print(f"densifying writer: {densifying_seconds:.3f}s, peak {densifying_peak_bytes / 2**20:.0f}MiB")
+        print(
+            f"sparse writer:     {seconds:.3f}s ({densifying_seconds / seconds:.1f}x), "
+            f"peak {peak_bytes / 2**20:.0f}MiB"
+        )
+
+        identical = np.array_equal(read_sorted_cells(f"{path}/X_densifying"), read_sorted_cells(f"{path}/X"))
+        print(f"identical results: {identical}")
+        if not identical:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
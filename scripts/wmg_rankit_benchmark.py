@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+pkg_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))  # noqa
+sys.path.insert(0, pkg_root)  # noqa
+
+from backend.wmg.data.rankit import rankit, reference_rankit  # noqa: E402
+
+"""
+Benchmark the compiled rankit kernel against the reference, row-by-row implementation, on a random raw counts
+matrix, and verify that both return the same values
+"""
+
+
+def random_raw_counts(n_cells: int, n_genes: int, density: float, seed: int) -> sparse.csr_matrix:
+    X = sparse.random(n_cells, n_genes, density=density, format="csr", random_state=seed, dtype=np.float32)
+    X.data = np.round(X.data * 100) + 1
+    return X
+
+
+def time_rankit(rankit_fn, X: sparse.csr_matrix, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rankit_fn(X)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cells", type=int, help="number of cells (rows)", default=50_000)
+    parser.add_argument("--genes", type=int, help="number of genes (columns)", default=20_000)
+    parser.add_argument("--density", type=float, help="fraction of non-zero values", default=0.05)
+    parser.add_argument("--repeat", type=int, help="number of timed runs, of which the fastest is reported", default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    X = random_raw_counts(args.cells, args.genes, args.density, args.seed)
+    print(f"matrix: {X.shape[0]} x {X.shape[1]}, nnz={X.nnz}")
+
+    # compile the kernel before timing it
+    rankit(X[:1])
+
+    compiled_seconds = time_rankit(rankit, X, args.repeat)
+    reference_seconds = time_rankit(reference_rankit, X, 1)
+    print(f"reference rankit: {reference_seconds:.3f}s")
+    print(f"compiled rankit:  {compiled_seconds:.3f}s ({reference_seconds / compiled_seconds:.1f}x)")
+
+    identical = np.array_equal(rankit(X).data, reference_rankit(X).data)
+    print(f"identical results: {identical}")
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
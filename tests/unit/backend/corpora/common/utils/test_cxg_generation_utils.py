@@ -2,11 +2,13 @@ import json
 import unittest
 from os import path, mkdir
 from shutil import rmtree
+from unittest.mock import patch
 from uuid import uuid4
 
 import numpy as np
 import tiledb
 from pandas import Series, DataFrame
+from scipy import sparse
 
 from backend.corpora.common.utils.cxg_generation_utils import (
     convert_dictionary_to_cxg_group,
@@ -121,3 +123,35 @@ class TestCxgGenerationUtils(unittest.TestCase):
         self.assertTrue(actual_stored_array[1, 1][""] == 1)
         self.assertTrue(actual_stored_array[2, 2][""] == 2)
         self.assertTrue(actual_stored_array[:, :][""].size == 3)
+
+    @patch("backend.corpora.common.utils.cxg_generation_utils.SPARSE_MATRIX_WRITE_MAX_NNZ", 5)
+    def test__convert_matrix_to_cxg_array__sparse_matrix_writes_nonzeros_without_densifying(self):
+        matrix = sparse.random(20, 7, density=0.3, format="csr", random_state=0, dtype=np.float32)
+        # an explicitly stored zero is not written
+        matrix.data[0] = 0
+
+        for matrix_format in ("csr", "csc"):
+            with self.subTest(matrix_format=matrix_format):
+                matrix_name = f"{self.testing_cxg_temp_directory}/awesome_{matrix_format}_matrix_{uuid4()}"
+
+                with patch.object(sparse.compressed._cs_matrix, "toarray", side_effect=AssertionError("densified")):
+                    convert_matrix_to_cxg_array(matrix_name, matrix.asformat(matrix_format), True, tiledb.Ctx())
+
+                actual_stored_array = tiledb.open(matrix_name)
+                stored = actual_stored_array[:, :]
+                stored_matrix = sparse.coo_matrix((stored[""], (stored["obs"], stored["var"])), shape=matrix.shape)
+
+                self.assertTrue(isinstance(actual_stored_array, tiledb.SparseArray))
+                self.assertEqual(matrix.count_nonzero(), stored[""].size)
+                self.assertTrue((stored_matrix.toarray() == matrix.toarray()).all())
+
+    def test__convert_matrix_to_cxg_array__sparse_matrix_dense_array_writes_successfully(self):
+        matrix = sparse.random(20, 7, density=0.3, format="csr", random_state=0, dtype=np.float32)
+        matrix_name = f"{self.testing_cxg_temp_directory}/awesome_densified_matrix_{uuid4()}"
+
+        convert_matrix_to_cxg_array(matrix_name, matrix, False, tiledb.Ctx())
+
+        actual_stored_array = tiledb.open(matrix_name)
+
+        self.assertTrue(isinstance(actual_stored_array, tiledb.DenseArray))
+        self.assertTrue((actual_stored_array[:, :] == matrix.toarray()).all())
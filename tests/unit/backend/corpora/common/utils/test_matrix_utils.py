@@ -1,8 +1,12 @@
+import tempfile
 import unittest
+from unittest.mock import patch
 
+import anndata
 import numpy as np
+from scipy import sparse
 
-from backend.corpora.common.utils.matrix_utils import is_matrix_sparse
+from backend.corpora.common.utils.matrix_utils import is_matrix_sparse, sample_number_of_non_zero_elements
 
 
 class TestMatrixUtils(unittest.TestCase):
@@ -46,3 +50,31 @@ class TestMatrixUtils(unittest.TestCase):
             # Because the function returns early a log will output the _estimate_ instead of the _exact_ percentage of
             # non-zero elements in the matrix.
             self.assertIn("Percentage of non-zero elements (estimate)", logger.output[0])
+
+    def test__is_matrix_sparse__sparse_matrix_uses_structural_number_of_non_zero_elements(self):
+        matrix = sparse.random(200, 100, density=0.1, format="csr", random_state=0)
+
+        with patch.object(sparse.compressed._cs_matrix, "toarray", side_effect=AssertionError("densified")):
+            with self.assertLogs(level="INFO") as logger:
+                self.assertTrue(is_matrix_sparse(matrix, 11))
+                self.assertIn("Percentage of non-zero elements (structural)", logger.output[0])
+            self.assertFalse(is_matrix_sparse(matrix.tocsc(), 9))
+
+    def test__is_matrix_sparse__backed_sparse_matrix_uses_indptr(self):
+        matrix = sparse.random(200, 100, density=0.1, format="csr", random_state=0, dtype=np.float32)
+        with tempfile.TemporaryDirectory() as path:
+            anndata.AnnData(X=matrix).write_h5ad(f"{path}/backed.h5ad")
+            backed_matrix = anndata.read_h5ad(f"{path}/backed.h5ad", backed="r").X
+
+            with patch("backend.corpora.common.utils.matrix_utils.sample_number_of_non_zero_elements") as sample:
+                self.assertTrue(is_matrix_sparse(backed_matrix, 11))
+                self.assertFalse(is_matrix_sparse(backed_matrix, 9))
+            sample.assert_not_called()
+
+    @patch("backend.corpora.common.utils.matrix_utils.SPARSITY_SAMPLE_ROWS", 100)
+    def test__sample_number_of_non_zero_elements__counts_evenly_spread_blocks_of_rows(self):
+        matrix = np.zeros([1000, 10])
+        matrix[::2] = 1.0
+
+        self.assertEqual((500, 100), sample_number_of_non_zero_elements(matrix))
+        self.assertEqual((250, 50), sample_number_of_non_zero_elements(matrix[:50]))
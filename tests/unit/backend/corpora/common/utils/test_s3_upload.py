@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from moto import mock_s3
+
+from backend.corpora.common.utils import s3_upload
+from backend.corpora.common.utils.math_utils import MB
+from backend.corpora.common.utils.s3_buckets import buckets
+from backend.corpora.common.utils.s3_upload import UPLOAD_THREADS, UPLOAD_TRANSFER_CONFIG, upload_directory
+
+BUCKET_NAME = "test-uploads"
+
+
+@mock_s3
+@patch.multiple(
+    "backend.corpora.common.utils.s3_upload",
+    # the minimum part size of S3 multipart uploads
+    UPLOAD_TRANSFER_CONFIG=TransferConfig(multipart_threshold=5 * MB, multipart_chunksize=5 * MB),
+    SMALL_FILES_BATCH_BYTES=10,
+    UPLOAD_RETRY_DELAY_SECONDS=0,
+)
+class UploadDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        # moto does not decode the checksummed (aws-chunked) uploads of recent botocore versions
+        environ = patch.dict(os.environ, {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.local_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.local_directory.cleanup)
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET_NAME)
+        # the client is created lazily, within the mock
+        buckets._portal_client = None
+        self.addCleanup(setattr, buckets, "_portal_client", None)
+        self.files = {
+            "__tiledb_group.tdb": b"",
+            "X/__fragments/__1_1_0/a0.tdb": b"small",
+            "X/__fragments/__1_1_0/d0.tdb": b"other small",
+            "X/__fragments/__1_1_0/a1.tdb": os.urandom(11 * MB),
+        }
+        for relative_path, content in self.files.items():
+            self.write_file(relative_path, content)
+
+    def write_file(self, relative_path: str, content: bytes):
+        local_path = os.path.join(self.local_directory.name, relative_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as f:
+            f.write(content)
+
+    def assert_uploaded(self):
+        for relative_path, content in self.files.items():
+            uploaded = self.s3.get_object(Bucket=BUCKET_NAME, Key=f"dataset.cxg/{relative_path}")["Body"].read()
+            self.assertEqual(content, uploaded)
+
+    def test__upload_directory__uploads_small_and_multipart_files(self):
+        stats = upload_directory(self.local_directory.name, f"s3://{BUCKET_NAME}/dataset.cxg/", max_workers=2)
+
+        self.assert_uploaded()
+        self.assertEqual((4, 0, 0), (stats.uploaded_files, stats.skipped_files, stats.retries))
+        self.assertEqual(sum(len(content) for content in self.files.values()), stats.uploaded_bytes)
+        etag = self.s3.head_object(Bucket=BUCKET_NAME, Key="dataset.cxg/X/__fragments/__1_1_0/a1.tdb")["ETag"]
+        self.assertTrue(etag.strip('"').endswith("-3"))
+
+    def test__portal_client__pool_fits_the_concurrent_upload_requests(self):
+        max_pool_connections = buckets.portal_client.meta.config.max_pool_connections
+        self.assertGreaterEqual(max_pool_connections, UPLOAD_THREADS * UPLOAD_TRANSFER_CONFIG.max_request_concurrency)
+
+    def test__upload_directory__resumed_upload__skips_uploaded_files(self):
+        upload_directory(self.local_directory.name, f"s3://{BUCKET_NAME}/dataset.cxg")
+        self.files["X/__fragments/__1_1_0/a0.tdb"] = b"changed"
+        self.write_file("X/__fragments/__1_1_0/a0.tdb", b"changed")
+
+        stats = upload_directory(self.local_directory.name, f"s3://{BUCKET_NAME}/dataset.cxg")
+
+        self.assert_uploaded()
+        self.assertEqual((1, 3), (stats.uploaded_files, stats.skipped_files))
+
+    def test__upload_file__failed_upload__retries(self):
+        put_object = self.s3.put_object
+        attempts = []
+
+        def fail_once(**kwargs):
+            attempts.append(kwargs["Key"])
+            if len(attempts) == 1:
+                raise IOError("connection reset")
+            return put_object(**kwargs)
+
+        local_path = os.path.join(self.local_directory.name, "X/__fragments/__1_1_0/a0.tdb")
+        with patch.object(self.s3, "put_object", side_effect=fail_once):
+            uploaded, retries = s3_upload._upload_file(self.s3, local_path, BUCKET_NAME, "a0.tdb", 5, None, {})
+
+        self.assertEqual((True, 1), (uploaded, retries))
+        self.assertEqual(["a0.tdb", "a0.tdb"], attempts)
+        self.assertEqual(b"small", self.s3.get_object(Bucket=BUCKET_NAME, Key="a0.tdb")["Body"].read())
@@ -7,6 +7,7 @@ from uuid import uuid4
 import anndata
 import numpy as np
 from pandas import Series, DataFrame
+from scipy import sparse
 import tiledb
 
 from backend.corpora.common.utils.corpora_constants import CorporaConstants
@@ -142,6 +143,31 @@ class TestH5ADDataFile(unittest.TestCase):
         # Clean up
         remove(sparse_with_column_shift_filename)
 
+    def test__to_cxg__backed_anndata_and_dense(self):
+        h5ad_file = H5ADDataFile(self.sample_h5ad_filename, backed=True)
+        # a budget that only allows blocks of a single row
+        h5ad_file.to_cxg(self.sample_output_directory, 0, x_matrix_memory_budget_bytes=1)
+
+        self.assertTrue(h5ad_file.anndata.isbacked)
+        self._validate_cxg_and_h5ad_content_match(self.sample_h5ad_filename, self.sample_output_directory, False)
+
+    def test__to_cxg__backed_anndata_and_sparse_in_blocks_of_rows(self):
+        anndata = self._create_sample_anndata_dataset()
+        anndata.X = sparse.csr_matrix(np.array([[0, 1, 0, 2], [0, 0, 0, 0], [3, 0, 4, 5]], dtype=np.float32))
+        sparse_filename = self._write_anndata_to_file(anndata)
+
+        h5ad_file = H5ADDataFile(sparse_filename, backed=True)
+        # a budget that only allows blocks of about two nonzero values
+        h5ad_file.to_cxg(self.sample_output_directory, 100, x_matrix_memory_budget_bytes=64)
+
+        with tiledb.open(f"{self.sample_output_directory}/X", mode="r") as x_array:
+            x_cells = x_array[:, :]
+        actual_x_data = sparse.coo_matrix((x_cells[""], (x_cells["obs"], x_cells["var"])), shape=anndata.X.shape)
+        self.assertTrue(np.array_equal(anndata.X.toarray(), actual_x_data.toarray()))
+
+        # Clean up
+        remove(sparse_filename)
+
     def test__slash_in_attribute_name(self):
         # tiledb failure repro code from https://github.com/TileDB-Inc/TileDB-Py/issues/294
         # this fails (throws a TileDBError) for 0.8.0 and below but works for 0.8.1+
@@ -6,7 +6,8 @@ import pathlib
 import shutil
 import tempfile
 import time
-from unittest.mock import patch
+import unittest
+from unittest.mock import ANY, patch
 
 import anndata
 import boto3
@@ -26,7 +27,7 @@ from backend.corpora.common.corpora_orm import (
 from backend.corpora.common.entities.collection import Collection
 from backend.corpora.common.entities.dataset import Dataset
 from backend.corpora.common.utils.exceptions import CorporaException
-from backend.corpora.dataset_processing.exceptions import ProcessingCancelled
+from backend.corpora.dataset_processing.exceptions import ProcessingCancelled, ProcessingFailed
 from backend.corpora.dataset_processing import process
 from backend.corpora.dataset_processing.process import (
     convert_file_ignore_exceptions,
@@ -368,8 +369,8 @@ class TestDatasetProcessing(DataPortalTestCase):
             process.update_db(dataset_id, metadata={"sex": ["male", "female"]})
 
     @patch("backend.corpora.dataset_processing.process.make_cxg")
-    @patch("backend.corpora.dataset_processing.process.subprocess.run")
-    def test_create_explorer_cxg(self, mock_subprocess, mock_cxg):
+    @patch("backend.corpora.dataset_processing.process.upload_directory")
+    def test_create_explorer_cxg(self, mock_upload_directory, mock_cxg):
         mock_cxg.return_value = str(self.cxg_filename)
         dataset = self.generate_dataset(self.session)
         dataset_id = dataset.id
@@ -387,6 +388,9 @@ class TestDatasetProcessing(DataPortalTestCase):
         self.assertEqual(artifacts[0].dataset_id, dataset_id)
         self.assertEqual(artifacts[0].s3_uri, f"s3://{explorer_bucket}/{artifacts[0].id}.cxg/")
         self.assertEqual(artifacts[0].filetype, DatasetArtifactFileType.CXG)
+        mock_upload_directory.assert_called_once_with(
+            str(self.cxg_filename), artifacts[0].s3_uri, extra_args={"ACL": "bucket-owner-full-control"}
+        )
 
     @patch("backend.corpora.dataset_processing.process.make_seurat")
     def test_create_artifacts(self, make_seurat):
@@ -661,3 +665,54 @@ class TestDatasetProcessing(DataPortalTestCase):
 
         # then
         mock_make_seurat.assert_called()
+
+
+@patch.dict(
+    os.environ,
+    {"DATASET_ID": "dataset_id", "ARTIFACT_BUCKET": "artifact_bucket", "AWS_BATCH_JOB_ATTEMPT": "1"},
+)
+class TestMain(unittest.TestCase):
+    @staticmethod
+    def run_seurat_stages(dataset_id, artifact_bucket, stage_timings):
+        with process.timed_stage(stage_timings, "download"):
+            pass
+        with process.timed_stage(stage_timings, "seurat_conversion"):
+            raise ProcessingFailed({"rds_status": ConversionStatus.FAILED})
+
+    @patch.dict(os.environ, {"STEP_NAME": "seurat"})
+    @patch("backend.corpora.dataset_processing.process.update_db")
+    @patch("backend.corpora.dataset_processing.process_seurat.process")
+    def test__main__failed_step__logs_the_stage_timings_once(self, mock_process, mock_update_db):
+        mock_process.side_effect = self.run_seurat_stages
+
+        with self.assertLogs(process.logger, logging.INFO) as logs:
+            self.assertEqual(1, process.main())
+
+        mock_process.assert_called_once_with(
+            "dataset_id", "artifact_bucket", {"download": ANY, "seurat_conversion": ANY}
+        )
+        mock_update_db.assert_called_once_with("dataset_id", processing_status={"rds_status": ConversionStatus.FAILED})
+        timings_logs = [line for line in logs.output if "Batch Job Stage Timings (s): " in line]
+        self.assertEqual(1, len(timings_logs))
+        self.assertIn("'download': ", timings_logs[0])
+        self.assertIn("'seurat_conversion': ", timings_logs[0])
+
+    @patch.dict(os.environ, {"STEP_NAME": "download-validate", "DROPBOX_URL": "dropbox_url"})
+    @patch("backend.corpora.dataset_processing.process_download_validate.create_artifact")
+    @patch("backend.corpora.dataset_processing.process_download_validate.extract_metadata")
+    @patch("backend.corpora.dataset_processing.process_download_validate.validate_h5ad_file_and_add_labels")
+    @patch("backend.corpora.dataset_processing.process_download_validate.download_from_source_uri")
+    @patch("backend.corpora.dataset_processing.process_download_validate.update_db")
+    def test__main__download_validate__records_each_stage(
+        self, mock_update_db, mock_download, mock_validate, mock_extract_metadata, mock_create_artifact
+    ):
+        mock_download.return_value = "raw.h5ad"
+        mock_validate.return_value = ("local.h5ad", True)
+
+        with self.assertLogs(process.logger, logging.INFO) as logs:
+            self.assertEqual(0, process.main())
+
+        timings_logs = [line for line in logs.output if "Batch Job Stage Timings (s): " in line]
+        self.assertEqual(1, len(timings_logs))
+        for stage in ("download", "validation", "metadata", "h5ad_upload"):
+            self.assertIn(f"'{stage}': ", timings_logs[0])
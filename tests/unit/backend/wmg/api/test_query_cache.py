@@ -0,0 +1,136 @@
+import unittest
+
+from pandas import DataFrame
+
+from backend.wmg.api.query_cache import (
+    QueryResultCache,
+    build_partial_result_cache_key,
+    build_query_cache_key,
+    dataframe_size,
+)
+from backend.wmg.data.query import WmgQueryCriteria
+
+
+class QueryResultCacheTest(unittest.TestCase):
+    def test__get__counts_hits_and_misses(self):
+        cache = QueryResultCache(max_bytes=100)
+        cache.put("snapshot-1", "key", b"value")
+
+        self.assertEqual(b"value", cache.get("key"))
+        self.assertIsNone(cache.get("other-key"))
+        self.assertEqual(1, cache.stats()["hits"])
+        self.assertEqual(1, cache.stats()["misses"])
+
+    def test__put__evicts_least_recently_used_entries_beyond_max_bytes(self):
+        cache = QueryResultCache(max_bytes=10)
+        cache.put("snapshot-1", "key-1", b"1234")
+        cache.put("snapshot-1", "key-2", b"1234")
+        cache.get("key-1")
+        cache.put("snapshot-1", "key-3", b"1234")
+
+        self.assertEqual(b"1234", cache.get("key-1"))
+        self.assertIsNone(cache.get("key-2"))
+        self.assertEqual(b"1234", cache.get("key-3"))
+        self.assertEqual(1, cache.stats()["evictions"])
+        self.assertEqual(8, cache.stats()["bytes"])
+
+    def test__put__does_not_cache_values_larger_than_max_bytes(self):
+        cache = QueryResultCache(max_bytes=4)
+        cache.put("snapshot-1", "key", b"12345")
+
+        self.assertIsNone(cache.get("key"))
+
+    def test__put__for_another_snapshot__clears_entries_of_previous_snapshot(self):
+        cache = QueryResultCache(max_bytes=100)
+        cache.put("snapshot-1", "key-1", b"value")
+        cache.put("snapshot-2", "key-2", b"value")
+
+        self.assertIsNone(cache.get("key-1"))
+        self.assertEqual(b"value", cache.get("key-2"))
+        self.assertEqual(1, cache.stats()["entries"])
+
+    def test__put__interleaved_with_puts_for_previous_snapshot__keeps_entries_of_new_snapshot(self):
+        cache = QueryResultCache(max_bytes=100)
+        cache.put("snapshot-1", "key-1", b"value")
+        cache.put("snapshot-2", "key-2", b"value")
+        # requests that started on the previous snapshot complete after the refresh
+        cache.put("snapshot-1", "key-3", b"value")
+        cache.put("snapshot-2", "key-4", b"value")
+        cache.put("snapshot-1", "key-5", b"value")
+
+        for key in ("key-1", "key-3", "key-5"):
+            self.assertIsNone(cache.get(key))
+        for key in ("key-2", "key-4"):
+            self.assertEqual(b"value", cache.get(key))
+        self.assertEqual(2, cache.stats()["entries"])
+
+    def test__clear__caches_superseded_snapshot_again(self):
+        cache = QueryResultCache(max_bytes=100)
+        cache.put("snapshot-1", "key-1", b"value")
+        cache.put("snapshot-2", "key-2", b"value")
+
+        cache.clear()
+        cache.put("snapshot-1", "key-1", b"value")
+
+        self.assertEqual(b"value", cache.get("key-1"))
+
+    def test__put__measures_values_with_size_fn(self):
+        df = DataFrame(dict(nnz=[1, 2, 3]))
+        cache = QueryResultCache(max_bytes=dataframe_size(df), size_fn=dataframe_size)
+        cache.put("snapshot-1", "key", df)
+
+        self.assertIs(df, cache.get("key"))
+        self.assertEqual(dataframe_size(df), cache.stats()["bytes"])
+
+
+class BuildQueryCacheKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.criteria = WmgQueryCriteria(
+            gene_ontology_term_ids=["gene_ontology_term_id_0", "gene_ontology_term_id_1"],
+            organism_ontology_term_id="organism_ontology_term_id_0",
+            tissue_ontology_term_ids=["tissue_ontology_term_id_0", "tissue_ontology_term_id_1"],
+        )
+
+    def test__reordered_non_gene_criteria__returns_same_key(self):
+        reordered_criteria = self.criteria.copy(
+            update=dict(tissue_ontology_term_ids=["tissue_ontology_term_id_1", "tissue_ontology_term_id_0"])
+        )
+
+        self.assertEqual(
+            build_query_cache_key("snapshot-1", self.criteria, False, "nested"),
+            build_query_cache_key("snapshot-1", reordered_criteria, False, "nested"),
+        )
+
+    def test__reordered_genes__returns_different_key(self):
+        reordered_criteria = self.criteria.copy(
+            update=dict(gene_ontology_term_ids=["gene_ontology_term_id_1", "gene_ontology_term_id_0"])
+        )
+
+        self.assertNotEqual(
+            build_query_cache_key("snapshot-1", self.criteria, False, "nested"),
+            build_query_cache_key("snapshot-1", reordered_criteria, False, "nested"),
+        )
+
+    def test__different_snapshot_or_options__returns_different_keys(self):
+        keys = {
+            build_query_cache_key("snapshot-1", self.criteria, False, "nested"),
+            build_query_cache_key("snapshot-2", self.criteria, False, "nested"),
+            build_query_cache_key("snapshot-1", self.criteria, True, "nested"),
+            build_query_cache_key("snapshot-1", self.criteria, False, "compact"),
+        }
+
+        self.assertEqual(4, len(keys))
+
+    def test__different_datasets_metadata_version__returns_different_keys(self):
+        self.assertNotEqual(
+            build_query_cache_key("snapshot-1", self.criteria, True, "nested", "1:2022-06-01 00:00:00:1:None"),
+            build_query_cache_key("snapshot-1", self.criteria, True, "nested", "1:2022-06-02 00:00:00:1:None"),
+        )
+
+    def test__partial_result_key__ignores_genes(self):
+        other_genes_criteria = self.criteria.copy(update=dict(gene_ontology_term_ids=["gene_ontology_term_id_2"]))
+
+        self.assertEqual(
+            build_partial_result_cache_key("snapshot-1", self.criteria, "cell_type_agg"),
+            build_partial_result_cache_key("snapshot-1", other_genes_criteria, "cell_type_agg"),
+        )
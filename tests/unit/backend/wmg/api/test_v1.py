@@ -2,8 +2,13 @@ import json
 import unittest
 from unittest.mock import patch
 
+import numpy as np
+from pandas import DataFrame
+
 from backend.corpora.api_server.app import app
-from backend.wmg.api.v1 import find_dim_option_values
+from backend.wmg.api.query_cache import clear_query_caches
+from backend.wmg.api.v1 import build_ordered_cell_types_by_tissue_update_depths
+from backend.wmg.data.query import WmgQuery
 from backend.wmg.data.schemas.cube_schema import cube_non_indexed_dims
 from tests.unit.backend.corpora.fixtures.environment_setup import EnvironmentSetup
 from tests.unit.backend.wmg.fixtures.test_primary_filters import (
@@ -33,6 +38,8 @@ class WmgApiV1Tests(unittest.TestCase):
         super().setUp()
         with EnvironmentSetup(dict(APP_NAME="corpora-api")):
             self.app = app.test_client(use_cookies=False)
+        # the temporary test snapshots all share the same identifier
+        clear_query_caches()
 
     @classmethod
     def setUpClass(cls) -> None:
@@ -49,7 +56,7 @@ class WmgApiV1Tests(unittest.TestCase):
 
         self.assertEqual(200, response.status_code)
 
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__primary_filter_dimensions__returns_valid_response_body(
@@ -79,7 +86,7 @@ class WmgApiV1Tests(unittest.TestCase):
 
         self.assertEqual(expected, json.loads(response.data))
 
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_single_primary_dims__returns_200_and_correct_response(
@@ -141,7 +148,163 @@ class WmgApiV1Tests(unittest.TestCase):
             }
             self.assertEqual(expected_response, json.loads(response.data))
 
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.api.v1.ontology_term_label")
+    @patch("backend.wmg.api.v1.load_snapshot")
+    def test__query_repeated_request__returns_cached_response_and_supports_etag(
+        self, load_snapshot, ontology_term_label, gene_term_label
+    ):
+        with create_temp_wmg_snapshot(dim_size=2) as snapshot:
+            load_snapshot.return_value = snapshot
+            ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
+
+            request = dict(
+                filter=dict(
+                    gene_ontology_term_ids=["gene_ontology_term_id_0"],
+                    organism_ontology_term_id="organism_ontology_term_id_0",
+                    tissue_ontology_term_ids=["tissue_ontology_term_id_0", "tissue_ontology_term_id_1"],
+                )
+            )
+            reordered_request = dict(
+                filter=dict(
+                    request["filter"],
+                    tissue_ontology_term_ids=list(reversed(request["filter"]["tissue_ontology_term_ids"])),
+                )
+            )
+
+            with patch.object(
+                WmgQuery, "expression_summary", autospec=True, side_effect=WmgQuery.expression_summary
+            ) as mock_expression_summary:
+                response = self.app.post("/wmg/v1/query", json=request)
+                cached_response = self.app.post("/wmg/v1/query", json=reordered_request)
+                not_modified_response = self.app.post(
+                    "/wmg/v1/query", json=request, headers={"If-None-Match": response.headers["ETag"]}
+                )
+
+                self.assertEqual(1, mock_expression_summary.call_count)
+
+            self.assertEqual(200, cached_response.status_code)
+            self.assertEqual(response.data, cached_response.data)
+            self.assertEqual(response.headers["ETag"], cached_response.headers["ETag"])
+            self.assertEqual("no-cache", response.headers["Cache-Control"])
+            self.assertEqual(304, not_modified_response.status_code)
+            self.assertEqual(b"", not_modified_response.data)
+
+    @patch("backend.wmg.api.v1.fetch_datasets_metadata_version")
+    @patch("backend.wmg.api.v1.fetch_datasets_metadata")
+    @patch("backend.wmg.data.ontology_labels.ontology_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.api.v1.ontology_term_label")
+    @patch("backend.wmg.api.v1.load_snapshot")
+    def test__query_updated_datasets_metadata__does_not_return_cached_response(
+        self,
+        load_snapshot,
+        ontology_term_label,
+        gene_term_label,
+        filter_dims_ontology_term_label,
+        fetch_datasets_metadata,
+        fetch_datasets_metadata_version,
+    ):
+        with create_temp_wmg_snapshot(dim_size=1) as snapshot:
+            load_snapshot.return_value = snapshot
+            ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            filter_dims_ontology_term_label.side_effect = ontology_term_label.side_effect
+            gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
+            request = dict(
+                filter=dict(
+                    gene_ontology_term_ids=["gene_ontology_term_id_0"],
+                    organism_ontology_term_id="organism_ontology_term_id_0",
+                    tissue_ontology_term_ids=["tissue_ontology_term_id_0"],
+                ),
+                include_filter_dims=True,
+            )
+
+            fetch_datasets_metadata_version.return_value = "metadata-version-1"
+            fetch_datasets_metadata.return_value = mock_datasets_metadata(["dataset_id_0"])
+            response = self.app.post("/wmg/v1/query", json=request)
+            cached_response = self.app.post("/wmg/v1/query", json=request)
+
+            fetch_datasets_metadata_version.return_value = "metadata-version-2"
+            fetch_datasets_metadata.return_value = [dict(mock_datasets_metadata(["dataset_id_0"])[0], label="renamed")]
+            updated_response = self.app.post(
+                "/wmg/v1/query", json=request, headers={"If-None-Match": response.headers["ETag"]}
+            )
+
+            self.assertEqual(2, fetch_datasets_metadata.call_count)
+            self.assertEqual(response.headers["ETag"], cached_response.headers["ETag"])
+            self.assertEqual(200, updated_response.status_code)
+            self.assertNotEqual(response.headers["ETag"], updated_response.headers["ETag"])
+            self.assertEqual("renamed", json.loads(updated_response.data)["filter_dims"]["datasets"][0]["label"])
+
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.api.v1.ontology_term_label")
+    @patch("backend.wmg.api.v1.load_snapshot")
+    def test__query_added_gene__reads_only_added_gene_from_cube(
+        self, load_snapshot, ontology_term_label, gene_term_label
+    ):
+        with create_temp_wmg_snapshot(dim_size=3) as snapshot:
+            load_snapshot.return_value = snapshot
+            ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
+
+            one_gene_filter = dict(
+                gene_ontology_term_ids=["gene_ontology_term_id_2"],
+                organism_ontology_term_id="organism_ontology_term_id_0",
+                tissue_ontology_term_ids=["tissue_ontology_term_id_0", "tissue_ontology_term_id_1"],
+            )
+            two_genes_filter = dict(
+                one_gene_filter, gene_ontology_term_ids=["gene_ontology_term_id_2", "gene_ontology_term_id_0"]
+            )
+
+            with patch.object(
+                WmgQuery, "expression_summary", autospec=True, side_effect=WmgQuery.expression_summary
+            ) as mock_expression_summary, patch.object(
+                WmgQuery, "cell_counts", autospec=True, side_effect=WmgQuery.cell_counts
+            ) as mock_cell_counts:
+                self.app.post("/wmg/v1/query", json=dict(filter=one_gene_filter))
+                incremental_response = self.app.post("/wmg/v1/query", json=dict(filter=two_genes_filter))
+
+                self.assertEqual(2, mock_expression_summary.call_count)
+                self.assertEqual(
+                    ["gene_ontology_term_id_0"], mock_expression_summary.call_args[0][1].gene_ontology_term_ids
+                )
+                self.assertEqual(1, mock_cell_counts.call_count)
+
+            clear_query_caches()
+            full_response = self.app.post("/wmg/v1/query", json=dict(filter=two_genes_filter))
+
+            self.assertEqual(json.loads(full_response.data), json.loads(incremental_response.data))
+
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.api.v1.ontology_term_label")
+    @patch("backend.wmg.api.v1.load_snapshot")
+    def test__query_compact_response_format__returns_same_data_as_nested_response_format(
+        self, load_snapshot, ontology_term_label, gene_term_label
+    ):
+        dim_size = 2
+        with create_temp_wmg_snapshot(dim_size=dim_size) as snapshot:
+            load_snapshot.return_value = snapshot
+            ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
+
+            query_filter = dict(
+                gene_ontology_term_ids=["gene_ontology_term_id_0", "gene_ontology_term_id_1"],
+                organism_ontology_term_id="organism_ontology_term_id_0",
+                tissue_ontology_term_ids=["tissue_ontology_term_id_0", "tissue_ontology_term_id_1"],
+            )
+
+            nested_response = self.app.post("/wmg/v1/query", json=dict(filter=query_filter))
+            compact_response = self.app.post("/wmg/v1/query", json=dict(filter=query_filter, response_format="compact"))
+
+            self.assertEqual(200, compact_response.status_code)
+            nested = json.loads(nested_response.data)
+            compact = json.loads(compact_response.data)
+            self.assertEqual(nested["expression_summary"], expand_compact_expression_summary(compact))
+            self.assertEqual(nested["term_id_labels"]["cell_types"], expand_compact_cell_types(compact))
+            self.assertEqual(nested["term_id_labels"]["genes"], compact["term_id_labels"]["genes"])
+
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_request_multi_primary_dims_only__returns_200_and_correct_response(
@@ -347,7 +510,7 @@ class WmgApiV1Tests(unittest.TestCase):
             }
             self.assertEqual(expected, json.loads(response.data))
 
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_explicit_cell_ordering__returns_correct_cell_ordering(
@@ -414,7 +577,7 @@ class WmgApiV1Tests(unittest.TestCase):
             }
             self.assertEqual(expected, json.loads(response.data)["term_id_labels"]["cell_types"])
 
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_total_cell_count_per_cell_type(self, load_snapshot, ontology_term_label, gene_term_label):
@@ -526,12 +689,20 @@ class WmgApiV1Tests(unittest.TestCase):
 
         self.assertEqual(400, response.status_code)
 
+    @patch("backend.wmg.api.v1.fetch_datasets_metadata_version", return_value="metadata-version-1")
     @patch("backend.wmg.api.v1.fetch_datasets_metadata")
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.ontology_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_request_with_filter_dims__returns_valid_filter_dims__base_case(
-        self, load_snapshot, ontology_term_label, gene_term_label, fetch_datasets_metadata
+        self,
+        load_snapshot,
+        ontology_term_label,
+        filter_dims_ontology_term_label,
+        gene_term_label,
+        fetch_datasets_metadata,
+        fetch_datasets_metadata_version,
     ):
         # mock the functions in the ontology_labels module, so we can assert deterministic values in the
         # "term_id_labels" portion of the response body; note that the correct behavior of the ontology_labels
@@ -539,6 +710,7 @@ class WmgApiV1Tests(unittest.TestCase):
         dim_size = 1
         with create_temp_wmg_snapshot(dim_size=dim_size) as snapshot:
             ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            filter_dims_ontology_term_label.side_effect = ontology_term_label.side_effect
             gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
             fetch_datasets_metadata.return_value = mock_datasets_metadata([f"dataset_id_{i}" for i in range(dim_size)])
             load_snapshot.return_value = snapshot
@@ -580,12 +752,20 @@ class WmgApiV1Tests(unittest.TestCase):
             }
             self.assertEqual(json.loads(response.data)["filter_dims"], expected_filters)
 
+    @patch("backend.wmg.api.v1.fetch_datasets_metadata_version", return_value="metadata-version-1")
     @patch("backend.wmg.api.v1.fetch_datasets_metadata")
-    @patch("backend.wmg.api.v1.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.gene_term_label")
+    @patch("backend.wmg.data.ontology_labels.ontology_term_label")
     @patch("backend.wmg.api.v1.ontology_term_label")
     @patch("backend.wmg.api.v1.load_snapshot")
     def test__query_request_with_filter_dims__returns_valid_filter_dims(
-        self, load_snapshot, ontology_term_label, gene_term_label, fetch_datasets_metadata
+        self,
+        load_snapshot,
+        ontology_term_label,
+        filter_dims_ontology_term_label,
+        gene_term_label,
+        fetch_datasets_metadata,
+        fetch_datasets_metadata_version,
     ):
         # mock the functions in the ontology_labels module, so we can assert deterministic values in the
         # "term_id_labels" portion of the response body; note that the correct behavior of the ontology_labels
@@ -600,6 +780,7 @@ class WmgApiV1Tests(unittest.TestCase):
             # thus filtering for dev_stage_0 should return filter options that include ethnicity 0,1 &2 but
             # filtering for dev_stage_1 or dev_stage_2 should only return ethnicity 0 (and vice versa)
             ontology_term_label.side_effect = lambda ontology_term_id: f"{ontology_term_id}_label"
+            filter_dims_ontology_term_label.side_effect = ontology_term_label.side_effect
             gene_term_label.side_effect = lambda gene_term_id: f"{gene_term_id}_label"
             fetch_datasets_metadata.return_value = mock_datasets_metadata([f"dataset_id_{i}" for i in range(dim_size)])
             # setup up API endpoints to use a mocked cube
@@ -790,9 +971,12 @@ class WmgApiV1Tests(unittest.TestCase):
                 self.assertEqual(dev_stage_terms_eth_2_dev_2, dev_stage_terms_eth_2_no_dev_filter)
                 self.assertNotEqual(eth_stage_terms_eth_2_dev_2, ethnicity_terms_eth_2_no_dev_filter)
 
-            with self.subTest("Additional queries are not performed when the secondary dimensions are not set"):
-                with patch("backend.wmg.api.v1.find_dim_option_values") as mock_dims:
-                    mock_dims.side_effect = find_dim_option_values
+            with self.subTest(
+                "The expression summary cube is queried once, regardless of the secondary dimension criteria"
+            ):
+                with patch.object(
+                    WmgQuery, "expression_summary", autospec=True, side_effect=WmgQuery.expression_summary
+                ) as mock_expression_summary:
                     full_filters = dict(
                         gene_ontology_term_ids=["gene_ontology_term_id_0"],
                         organism_ontology_term_id="organism_ontology_term_id_0",
@@ -808,10 +992,11 @@ class WmgApiV1Tests(unittest.TestCase):
                         filter=full_filters,
                         include_filter_dims=True,
                     )
+                    clear_query_caches()
                     self.app.post("/wmg/v1/query", json=full_filters_request)
-                    self.assertEqual(mock_dims.call_count, 5)
+                    self.assertEqual(mock_expression_summary.call_count, 1)
 
-                    mock_dims.reset_mock()
+                    mock_expression_summary.reset_mock()
                     no_secondary_filters = dict(
                         gene_ontology_term_ids=["gene_ontology_term_id_0"],
                         organism_ontology_term_id="organism_ontology_term_id_0",
@@ -827,10 +1012,11 @@ class WmgApiV1Tests(unittest.TestCase):
                         filter=no_secondary_filters,
                         include_filter_dims=True,
                     )
+                    clear_query_caches()
                     self.app.post("/wmg/v1/query", json=no_secondary_filters_request)
-                    mock_dims.assert_not_called()
-                    # technically not necessary
-                    mock_dims.reset_mock()
+                    self.assertEqual(mock_expression_summary.call_count, 1)
+
+                    mock_expression_summary.reset_mock()
 
                     two_secondary_filters = dict(
                         gene_ontology_term_ids=["gene_ontology_term_id_0"],
@@ -846,8 +1032,59 @@ class WmgApiV1Tests(unittest.TestCase):
                         filter=two_secondary_filters,
                         include_filter_dims=True,
                     )
+                    clear_query_caches()
                     self.app.post("/wmg/v1/query", json=two_secondary_filters_request)
-                    self.assertEqual(mock_dims.call_count, 2)
+                    self.assertEqual(mock_expression_summary.call_count, 1)
+
+
+class BuildOrderedCellTypesUpdateDepthsTest(unittest.TestCase):
+    def test__removed_cell_types__descendants_move_up_one_level_per_removed_ancestor(self):
+        cell_types = DataFrame(
+            dict(
+                depth=[0, 1, 2, 3, 2, 1, 0, 1],
+                n_cells_cell_type=[10, np.nan, np.nan, 10, 10, 10, np.nan, 10],
+            )
+        )
+
+        result = build_ordered_cell_types_by_tissue_update_depths(cell_types)
+
+        self.assertEqual([0, 1, 1, 1, 1, 1, 0, 0], result["depth"].tolist())
+
+
+def expand_compact_expression_summary(compact_response: dict) -> dict:
+    term_ids = compact_response["expression_summary"]["term_ids"]
+    columns = compact_response["expression_summary"]["columns"]
+    expression_summary = {}
+    for i in range(len(columns["gene"])):
+        gene = term_ids["genes"][columns["gene"][i]]
+        tissue = term_ids["tissues"][columns["tissue"][i]]
+        expression_summary.setdefault(gene, {}).setdefault(tissue, []).append(
+            dict(
+                id=term_ids["cell_types"][columns["cell_type"][i]],
+                n=columns["n"][i],
+                me=columns["me"][i],
+                pc=columns["pc"][i],
+                tpc=columns["tpc"][i],
+            )
+        )
+    return expression_summary
+
+
+def expand_compact_cell_types(compact_response: dict) -> dict:
+    compact_cell_types = compact_response["term_id_labels"]["cell_types"]
+    term_ids = compact_cell_types["term_ids"]
+    columns = compact_cell_types["columns"]
+    cell_types = {}
+    for i in range(len(columns["tissue"])):
+        cell_types.setdefault(term_ids["tissues"][columns["tissue"][i]], []).append(
+            dict(
+                cell_type_ontology_term_id=term_ids["cell_types"][columns["cell_type"][i]],
+                cell_type=compact_cell_types["cell_type_labels"][columns["cell_type"][i]],
+                total_count=columns["total_count"][i],
+                depth=columns["depth"][i],
+            )
+        )
+    return cell_types
 
 
 # mock the dataset and collection entity data that would otherwise be fetched from the db; in this test
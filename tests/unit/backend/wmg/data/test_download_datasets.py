@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_s3
+
+from backend.corpus_asset_pipelines.integrated_corpus.extract import download_dataset, download_datasets
+from backend.corpora.common.utils.s3_buckets import buckets
+
+BUCKET_NAME = "test-datasets"
+
+
+@mock_s3
+@patch("backend.corpus_asset_pipelines.integrated_corpus.extract.DOWNLOAD_RETRY_DELAY_SECONDS", 0)
+class DownloadDatasetsTest(unittest.TestCase):
+    def setUp(self):
+        # moto does not decode the checksummed (aws-chunked) uploads of recent botocore versions
+        environ = patch.dict(os.environ, {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.dataset_directory = tempfile.TemporaryDirectory()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET_NAME)
+        self.s3_uris = {}
+        for dataset_id in ("dataset_0", "dataset_1"):
+            self.s3.put_object(Bucket=BUCKET_NAME, Key=f"{dataset_id}/local.h5ad", Body=dataset_id.encode())
+            self.s3_uris[dataset_id] = f"s3://{BUCKET_NAME}/{dataset_id}/local.h5ad"
+        # the client is created lazily, within the mock
+        buckets._portal_client = None
+
+    def tearDown(self):
+        self.dataset_directory.cleanup()
+        buckets._portal_client = None
+
+    def local_path(self, dataset_id: str) -> str:
+        return f"{self.dataset_directory.name}/{dataset_id}/local.h5ad"
+
+    def test__download_datasets__downloads_each_dataset(self):
+        dataset_ids = list(download_datasets(self.s3_uris, self.dataset_directory.name, max_workers=2))
+
+        self.assertEqual({"dataset_0", "dataset_1"}, set(dataset_ids))
+        for dataset_id in dataset_ids:
+            with open(self.local_path(dataset_id), "rb") as f:
+                self.assertEqual(dataset_id.encode(), f.read())
+
+    def test__download_dataset__already_downloaded__skips_unchanged_dataset(self):
+        s3_uri, local_path = self.s3_uris["dataset_0"], self.local_path("dataset_0")
+
+        self.assertEqual(len(b"dataset_0"), download_dataset(s3_uri, local_path))
+        self.assertEqual(0, download_dataset(s3_uri, local_path))
+
+        self.s3.put_object(Bucket=BUCKET_NAME, Key="dataset_0/local.h5ad", Body=b"dataset_0 updated")
+        self.assertEqual(len(b"dataset_0 updated"), download_dataset(s3_uri, local_path))
+        with open(local_path, "rb") as f:
+            self.assertEqual(b"dataset_0 updated", f.read())
+
+    def test__download_dataset__failed_download__retries(self):
+        download_file = buckets.portal_client.download_file
+        attempts = []
+
+        def fail_once(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise IOError("connection reset")
+            return download_file(*args, **kwargs)
+
+        with patch.object(buckets.portal_client, "download_file", side_effect=fail_once):
+            download_dataset(self.s3_uris["dataset_0"], self.local_path("dataset_0"))
+
+        self.assertEqual(2, len(attempts))
+        with open(self.local_path("dataset_0"), "rb") as f:
+            self.assertEqual(b"dataset_0", f.read())
+
+    def test__download_datasets__failed_dataset__is_not_yielded(self):
+        s3_uris = {**self.s3_uris, "missing_dataset": f"s3://{BUCKET_NAME}/missing_dataset/local.h5ad"}
+
+        dataset_ids = list(download_datasets(s3_uris, self.dataset_directory.name))
+
+        self.assertEqual({"dataset_0", "dataset_1"}, set(dataset_ids))
+        self.assertFalse(os.path.exists(self.local_path("missing_dataset")))
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tiledb
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.load import CubeWriter
+from backend.wmg.data.schemas.cube_schema import cube_indexed_dims, cube_non_indexed_dims, expression_summary_schema
+from backend.wmg.data.utils import create_empty_cube
+
+
+def cube_cells(n_cells: int, offset: int) -> (list, dict):
+    codes = np.arange(offset, offset + n_cells)
+    dims = [codes, codes % 3, codes % 2]
+    vals = {
+        "sum": codes * 0.5,
+        "nnz": codes,
+        "n_cells": codes + 1,
+        **{dim_name: codes % 5 for dim_name in cube_non_indexed_dims},
+    }
+    return dims, vals
+
+
+class CubeWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.uri = f"{self.tmp_dir}/expression_summary"
+        create_empty_cube(self.uri, expression_summary_schema)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test__append__writes_cells_in_bounded_batches_of_typed_buffers(self):
+        with tiledb.open(self.uri, "w") as cube:
+            writer = CubeWriter(cube, batch_cells=4)
+            for n_cells, offset in [(3, 0), (6, 3), (0, 9), (1, 9)]:
+                writer.append(*cube_cells(n_cells, offset))
+            writer.flush()
+
+        self.assertEqual(3, writer.n_writes)
+        self.assertEqual(np.uint32, writer.dim_buffers[0].dtype)
+        self.assertEqual(np.float32, writer.attr_buffers["sum"].dtype)
+        self.assertEqual(3, len(tiledb.array_fragments(self.uri)))
+
+        with tiledb.open(self.uri) as cube:
+            cells = cube.df[:].sort_values("gene_ontology_term_id", ignore_index=True)
+        dims, vals = cube_cells(10, 0)
+        for dim_name, dim in zip(cube_indexed_dims, dims):
+            self.assertEqual(dim.tolist(), cells[dim_name].tolist())
+        for attr_name, attr in vals.items():
+            self.assertEqual(attr.tolist(), cells[attr_name].tolist())
+
+    def test__flush__no_buffered_cells__does_not_write(self):
+        with tiledb.open(self.uri, "w") as cube:
+            writer = CubeWriter(cube, batch_cells=4)
+            writer.append(*cube_cells(4, 0))
+            writer.flush()
+
+        self.assertEqual(1, writer.n_writes)
+        self.assertEqual(1, len(tiledb.array_fragments(self.uri)))
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import (
+    extract_partial_gene_ids_by_organism,
+    load,
+    partials_path,
+    regroup_partial,
+)
+
+
+class ExpressionSummaryPartialsTest(unittest.TestCase):
+    def setUp(self):
+        groups = pd.DataFrame(
+            {
+                "tissue_ontology_term_id": ["UBERON:0002048", "UBERON:0002048", "UBERON:0000178"],
+                "sex_ontology_term_id": ["PATO:0000383", "PATO:0000384", "PATO:0000383"],
+                "n_cells": [3, 4, 5],
+            }
+        )
+        values = pd.DataFrame(
+            {
+                "group_idx": np.array([0, 1, 1, 2], dtype=np.uint32),
+                "gene_idx": np.array([0, 0, 1, 1], dtype=np.uint32),
+                "sum": np.array([1.0, 2.0, 3.0, 4.0], dtype=np.float32),
+                "nnz": np.array([1, 2, 3, 4], dtype=np.uint64),
+            }
+        )
+        self.partial = (groups, ["ENSG00000000003", "ENSG00000000005"], values)
+
+    def test__regroup_partial__same_dims__returns_partial(self):
+        regrouped = regroup_partial(self.partial, ["tissue_ontology_term_id", "sex_ontology_term_id"])
+
+        self.assertIs(self.partial, regrouped)
+
+    def test__regroup_partial__fewer_dims__aggregates_groups(self):
+        groups, gene_ids, values = regroup_partial(self.partial, ["tissue_ontology_term_id"])
+
+        self.assertEqual(["UBERON:0002048", "UBERON:0000178"], groups.tissue_ontology_term_id.tolist())
+        self.assertEqual([7, 5], groups.n_cells.tolist())
+        self.assertEqual(["ENSG00000000003", "ENSG00000000005"], gene_ids)
+        self.assertEqual([(0, 0, 3.0, 3), (0, 1, 3.0, 3), (1, 1, 4.0, 4)], list(values.itertuples(index=False)))
+
+    def test__regroup_partial__missing_dims__raises(self):
+        with self.assertRaises(ValueError):
+            regroup_partial(self.partial, ["tissue_ontology_term_id", "disease_ontology_term_id"])
+
+    def test__extract_partial_gene_ids_by_organism__groups_genes_by_organism(self):
+        groups, gene_ids, values = self.partial
+        corpus_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, corpus_path)
+        os.makedirs(partials_path(corpus_path))
+        single_organism_groups = groups.assign(organism_ontology_term_id="NCBITaxon:9606")
+        load(corpus_path, "single_organism", (single_organism_groups, gene_ids, values))
+        organism_groups = groups.assign(
+            organism_ontology_term_id=["NCBITaxon:9606", "NCBITaxon:10090", "NCBITaxon:10090"]
+        )
+        load(corpus_path, "organisms", (organism_groups, gene_ids, values))
+
+        self.assertEqual(
+            {"NCBITaxon:9606": ["ENSG00000000003", "ENSG00000000005"]},
+            extract_partial_gene_ids_by_organism(corpus_path, "single_organism"),
+        )
+        self.assertEqual(
+            {"NCBITaxon:9606": ["ENSG00000000003"], "NCBITaxon:10090": ["ENSG00000000003", "ENSG00000000005"]},
+            extract_partial_gene_ids_by_organism(corpus_path, "organisms"),
+        )
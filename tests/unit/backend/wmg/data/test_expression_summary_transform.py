@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tiledb
+from scipy import sparse
+
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.transform import reduce_X
+from backend.wmg.data.schemas.corpus_schema import INTEGRATED_ARRAY_NAME
+
+
+class ReduceXTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.X = sparse.random(50, 37, density=0.3, format="coo", random_state=0, dtype=np.float32)
+        # small var_idx tiles, so that the genes are split into several partitions
+        tiledb.Array.create(
+            f"{self.tmp_dir}/{INTEGRATED_ARRAY_NAME}",
+            tiledb.ArraySchema(
+                domain=tiledb.Domain(
+                    [
+                        tiledb.Dim(name="obs_idx", domain=(0, 1000), tile=8, dtype=np.uint32),
+                        tiledb.Dim(name="var_idx", domain=(0, 1000), tile=4, dtype=np.uint32),
+                    ]
+                ),
+                sparse=True,
+                allows_duplicates=True,
+                attrs=[tiledb.Attr(name="rankit", dtype=np.float32)],
+                tile_order="col-major",
+            ),
+        )
+        with tiledb.open(f"{self.tmp_dir}/{INTEGRATED_ARRAY_NAME}", "w") as X:
+            X[self.X.row.astype(np.uint32), self.X.col.astype(np.uint32)] = {"rankit": self.X.data}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test__reduce_X__in_gene_partitions__sums_by_cube_row(self):
+        # 3 cube rows, and obs that are not reduced
+        cube_indices = np.arange(50, dtype=np.int64) % 4 - 1
+        obs_idx_ranges = [(0, 19), (30, 49)]
+
+        for max_workers in (1, 3, 16):
+            with self.subTest(max_workers=max_workers):
+                cube_sum = np.zeros((3, 37), dtype=np.float32)
+                cube_nnz = np.zeros((3, 37), dtype=np.uint64)
+
+                reduce_X(self.tmp_dir, cube_indices, cube_sum, cube_nnz, obs_idx_ranges, max_workers=max_workers)
+
+                X = self.X.toarray()
+                reduced_obs = np.r_[0:20, 30:50]
+                for cube_idx in range(3):
+                    rows = reduced_obs[cube_indices[reduced_obs] == cube_idx]
+                    np.testing.assert_allclose(X[rows].sum(axis=0), cube_sum[cube_idx], rtol=1e-6)
+                    np.testing.assert_array_equal(np.count_nonzero(X[rows], axis=0), cube_nnz[cube_idx])
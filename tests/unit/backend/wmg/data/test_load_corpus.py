@@ -7,20 +7,41 @@ from unittest.mock import patch
 
 import anndata
 import numpy as np
+import pandas as pd
+import scanpy
 import tiledb
 from scipy import sparse
 from scipy.sparse import coo_matrix, csr_matrix
+from backend.corpora.common.utils.math_utils import MB
 from backend.wmg.data.rankit import rankit
 from backend.wmg.data.cube_pipeline import load_data_and_create_cube
 from backend.corpus_asset_pipelines.integrated_corpus.job import build_integrated_corpus
-from backend.corpus_asset_pipelines.integrated_corpus.load import load_dataset
+from backend.corpus_asset_pipelines.integrated_corpus.load import load_dataset, remove_datasets_from_corpus
+from backend.corpus_asset_pipelines.summary_cubes.cell_count import create_cell_count_cube
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.job import create_expression_summary_cube
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.extract import extract_obs_data
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.partials import (
+    EXPRESSION_SUMMARY_PARTIALS_NAME,
+    extract_partial,
+    list_partials,
+    update_expression_summary_partials,
+)
+from backend.corpus_asset_pipelines.summary_cubes.expression_summary.transform import make_cube_index
+from backend.corpus_asset_pipelines.summary_cubes.term_id_codes import create_term_id_codes
 from backend.corpus_asset_pipelines.integrated_corpus.validate import validate_dataset_properties
 from backend.corpus_asset_pipelines.integrated_corpus.transform import (
     filter_out_rankits_with_low_expression_counts,
     apply_pre_concatenation_filters,
+    compute_pre_concatenation_filter_mask,
+)
+from backend.wmg.data.constants import (
+    GENE_EXPRESSION_COUNT_MIN_THRESHOLD,
+    RANKIT_RAW_EXPR_COUNT_FILTERING_MIN_THRESHOLD,
 )
-from backend.wmg.data.constants import RANKIT_RAW_EXPR_COUNT_FILTERING_MIN_THRESHOLD
-from backend.wmg.data.schemas.corpus_schema import create_tdb, OBS_ARRAY_NAME, VAR_ARRAY_NAME
+from backend.wmg.data.schemas.corpus_schema import create_tdb, INTEGRATED_ARRAY_NAME, OBS_ARRAY_NAME, VAR_ARRAY_NAME
+from backend.wmg.data.schemas.cube_schema import cube_indexed_dims_no_gene_ontology, cube_non_indexed_dims
+from backend.wmg.data.snapshot import CELL_COUNTS_CUBE_NAME, EXPRESSION_SUMMARY_CUBE_NAME
+from backend.wmg.data.utils import get_all_dataset_ids
 from tests.unit.backend.wmg.fixtures.test_anndata_object import create_anndata_test_object
 
 
@@ -69,6 +90,8 @@ class TestCorpusLoad(unittest.TestCase):
     def tearDown(self) -> None:
         super().tearDown()
         shutil.rmtree(self.corpus_path)
+        # the dataset ids of the corpus are cached, and the next test creates a corpus at the same path
+        get_all_dataset_ids.cache_clear()
 
     @patch("backend.corpus_asset_pipelines.integrated_corpus.job.tiledb.consolidate")
     @patch("backend.corpus_asset_pipelines.integrated_corpus.job.tiledb.vacuum")
@@ -80,7 +103,7 @@ class TestCorpusLoad(unittest.TestCase):
         self.assertEqual(mock_consolidate.call_count, 3)
 
     @patch("backend.corpus_asset_pipelines.integrated_corpus.load.update_corpus_var")
-    @patch("backend.corpus_asset_pipelines.integrated_corpus.job.validate_dataset_properties")
+    @patch("backend.corpus_asset_pipelines.integrated_corpus.job.validate_backed_dataset_properties")
     def test_invalid_datasets_are_not_added_to_corpus(self, mock_validation, mock_global_var):
         mock_validation.return_value = False
         build_integrated_corpus(self.path_to_datasets, self.corpus_path)
@@ -105,6 +128,225 @@ class TestCorpusLoad(unittest.TestCase):
             total_stored_genes = len(set(var_df["gene_ontology_term_id"].to_numpy(dtype=str)))
         self.assertEqual(large_gene_count, total_stored_genes)
 
+    def test__build_integrated_corpus__in_parallel__loads_same_corpus_as_sequential_build(self):
+        def read_corpus(corpus_path):
+            with tiledb.open(f"{corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+                obs_df = obs.df[:][["obs_idx", "dataset_id", "dataset_local_cell_id"]]
+            with tiledb.open(f"{corpus_path}/{VAR_ARRAY_NAME}", "r") as var:
+                var_df = var.df[:][["var_idx", "gene_ontology_term_id"]]
+            with tiledb.open(f"{corpus_path}/{INTEGRATED_ARRAY_NAME}", "r") as integrated:
+                integrated_df = integrated.df[:]
+            # identify the expression values by their cell and gene ids, as their obs_idx and var_idx may differ
+            return (
+                integrated_df.merge(obs_df, on="obs_idx")
+                .merge(var_df, on="var_idx")[["dataset_id", "dataset_local_cell_id", "gene_ontology_term_id", "rankit"]]
+                .sort_values(by=["dataset_id", "dataset_local_cell_id", "gene_ontology_term_id"], ignore_index=True)
+            )
+
+        parallel_corpus_name = "test-group-parallel"
+        create_tdb(self.tmp_dir, parallel_corpus_name)
+        parallel_corpus_path = f"{self.tmp_dir}/{parallel_corpus_name}"
+        try:
+            build_integrated_corpus(self.path_to_datasets, self.corpus_path)
+            build_integrated_corpus(self.path_to_datasets, parallel_corpus_path, max_workers=2)
+
+            expected = read_corpus(self.corpus_path)
+            actual = read_corpus(parallel_corpus_path)
+            self.assertGreater(len(expected), 0)
+            self.assertTrue(expected.equals(actual))
+            with tiledb.open(f"{parallel_corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+                self.assertTrue(obs.df[:].obs_idx.is_unique)
+        finally:
+            shutil.rmtree(parallel_corpus_path)
+
+    # consolidating a corpus of several datasets with the default buffer size needs more memory than a test host has
+    @patch("backend.wmg.data.tiledb.consolidation_buffer_size", return_value=64 * MB)
+    def test__cubes_recomposed_from_updated_partials__match_cubes_built_from_scratch(
+        self, mock_consolidation_buffer_size
+    ):
+        def create_cubes(corpus_path):
+            term_id_codes = create_term_id_codes(corpus_path)
+            added_dataset_ids, removed_dataset_ids = update_expression_summary_partials(corpus_path)
+            create_expression_summary_cube(corpus_path, term_id_codes)
+            create_cell_count_cube(corpus_path, term_id_codes)
+            return added_dataset_ids, removed_dataset_ids
+
+        def read_cube(corpus_path, cube_name):
+            term_id_codes = create_term_id_codes(corpus_path)
+            with tiledb.open(f"{corpus_path}/{cube_name}", "r") as cube:
+                cube_df = term_id_codes.decode_df(cube.df[:])
+            return cube_df.sort_values(by=list(cube_df.columns), ignore_index=True)
+
+        def read_dataset_obs_idx(corpus_path, dataset_id):
+            with tiledb.open(f"{corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+                obs_df = obs.df[:]
+            return obs_df.obs_idx.values[obs_df.dataset_id == dataset_id]
+
+        def read_expression_obs_idx(corpus_path):
+            with tiledb.open(f"{corpus_path}/{INTEGRATED_ARRAY_NAME}", "r") as X:
+                return X.query(attrs=[], dims=["obs_idx"])[:]["obs_idx"]
+
+        def dataset_directory(name, datasets):
+            path = f"{self.tmp_dir}/{name}"
+            for dataset_name, anndata_object in datasets.items():
+                os.makedirs(f"{path}/{dataset_name}")
+                anndata_object.write(f"{path}/{dataset_name}/local.h5ad")
+            return path
+
+        # the datasets have distinct gene sets, as cells expressing fewer than 500 genes are filtered out
+        kept_dataset = create_anndata_test_object(num_genes=1000, num_cells=300)
+        removed_dataset = create_anndata_test_object(num_genes=900, num_cells=200)
+        added_dataset = create_anndata_test_object(num_genes=1100, num_cells=200)
+        previous_datasets = dataset_directory(
+            "previous_datasets", {"kept_dataset": kept_dataset, "removed_dataset": removed_dataset}
+        )
+        added_datasets = dataset_directory("added_datasets", {"added_dataset": added_dataset})
+        all_datasets = dataset_directory("all_datasets", {"kept_dataset": kept_dataset, "added_dataset": added_dataset})
+        previous_corpus_name = "test-group-previous"
+        create_tdb(self.tmp_dir, previous_corpus_name)
+        previous_corpus_path = f"{self.tmp_dir}/{previous_corpus_name}"
+        incremental_corpus_path = f"{self.tmp_dir}/test-group-incremental"
+        try:
+            build_integrated_corpus(previous_datasets, previous_corpus_path)
+            create_cubes(previous_corpus_path)
+            # the incremental build starts from the integrated corpus and partials of the previous snapshot
+            os.mkdir(incremental_corpus_path)
+            for name in (OBS_ARRAY_NAME, VAR_ARRAY_NAME, INTEGRATED_ARRAY_NAME, EXPRESSION_SUMMARY_PARTIALS_NAME):
+                shutil.copytree(f"{previous_corpus_path}/{name}", f"{incremental_corpus_path}/{name}")
+            removed_dataset_obs_idx = read_dataset_obs_idx(incremental_corpus_path, "removed_dataset")
+            n_expression_values = len(read_expression_obs_idx(incremental_corpus_path))
+            remove_datasets_from_corpus(incremental_corpus_path, ["removed_dataset"])
+            # the expression values of the removed dataset are deleted from the integrated array
+            remaining_expression_obs_idx = read_expression_obs_idx(incremental_corpus_path)
+            self.assertLess(len(remaining_expression_obs_idx), n_expression_values)
+            self.assertFalse(np.isin(remaining_expression_obs_idx, removed_dataset_obs_idx).any())
+            self.assertTrue(
+                np.isin(
+                    remaining_expression_obs_idx, read_dataset_obs_idx(incremental_corpus_path, "kept_dataset")
+                ).all()
+            )
+            build_integrated_corpus(added_datasets, incremental_corpus_path)
+            self.assertEqual((["added_dataset"], ["removed_dataset"]), create_cubes(incremental_corpus_path))
+
+            build_integrated_corpus(all_datasets, self.corpus_path)
+            create_cubes(self.corpus_path)
+
+            for cube_name in (EXPRESSION_SUMMARY_CUBE_NAME, CELL_COUNTS_CUBE_NAME):
+                with self.subTest(cube_name=cube_name):
+                    expected = read_cube(self.corpus_path, cube_name)
+                    actual = read_cube(incremental_corpus_path, cube_name)
+                    self.assertEqual({"kept_dataset", "added_dataset"}, set(expected.dataset_id))
+                    self.assertTrue(expected.equals(actual))
+        finally:
+            for path in (
+                previous_corpus_path,
+                incremental_corpus_path,
+                previous_datasets,
+                added_datasets,
+                all_datasets,
+            ):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def test__update_expression_summary_partials__in_chunks_of_cube_rows__creates_same_partials(self):
+        build_integrated_corpus(self.path_to_datasets, self.corpus_path)
+        chunked_corpus_path = f"{self.tmp_dir}/test-group-chunked"
+        shutil.copytree(self.corpus_path, chunked_corpus_path)
+        try:
+            update_expression_summary_partials(self.corpus_path)
+            # a single cube row per chunk, so that the cube rows of each dataset span many chunks
+            update_expression_summary_partials(chunked_corpus_path, max_accumulator_bytes=1)
+
+            dataset_ids = list_partials(self.corpus_path)
+            self.assertEqual(["larger_test_dataset"], dataset_ids)
+            self.assertEqual(dataset_ids, list_partials(chunked_corpus_path))
+            for dataset_id in dataset_ids:
+                expected_groups, expected_gene_ids, expected_values = extract_partial(self.corpus_path, dataset_id)
+                actual_groups, actual_gene_ids, actual_values = extract_partial(chunked_corpus_path, dataset_id)
+                self.assertGreater(len(expected_groups), 1)
+                self.assertTrue(expected_groups.equals(actual_groups))
+                self.assertEqual(expected_gene_ids, actual_gene_ids)
+                self.assertTrue(
+                    expected_values.sort_values(by=["group_idx", "gene_idx"], ignore_index=True).equals(
+                        actual_values.sort_values(by=["group_idx", "gene_idx"], ignore_index=True)
+                    )
+                )
+        finally:
+            shutil.rmtree(chunked_corpus_path)
+
+    def test__make_cube_index__in_batches_of_obs__matches_cell_labels(self):
+        build_integrated_corpus(self.path_to_datasets, self.corpus_path)
+        cube_dims = cube_indexed_dims_no_gene_ontology + cube_non_indexed_dims
+        with tiledb.open(f"{self.corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+            # the cube index holds the cube dimensions as they are read from the obs array, as ascii bytes
+            cell_labels = obs.query(use_arrow=False).df[:].set_index("obs_idx")[cube_dims]
+
+        for dataset_ids in (None, ["larger_test_dataset"], []):
+            with self.subTest(dataset_ids=dataset_ids):
+                cube_index, cube_indices, obs_idx_ranges = make_cube_index(self.corpus_path, cube_dims, dataset_ids)
+
+                expected_cell_labels = (
+                    cell_labels
+                    if dataset_ids is None
+                    else cell_labels[cell_labels.dataset_id.isin([dataset_id.encode() for dataset_id in dataset_ids])]
+                )
+                expected_n = expected_cell_labels.value_counts()
+                self.assertEqual(np.uint32, cube_indices.dtype)
+                self.assertEqual(len(expected_n), len(cube_index))
+                self.assertTrue(expected_n.sort_index().equals(cube_index.n.sort_index().rename(None)))
+                # each cell maps to the cube row of its labels, and every other obs_idx to len(cube_index)
+                cube_idx = cube_index.cube_idx.reindex(pd.MultiIndex.from_frame(expected_cell_labels)).values
+                self.assertEqual(cube_idx.tolist(), cube_indices[expected_cell_labels.index.values].tolist())
+                self.assertEqual(len(cube_indices) - len(expected_cell_labels), (cube_indices == len(cube_index)).sum())
+                self.assertEqual(
+                    {
+                        dataset_id: (obs_idx.min(), obs_idx.max())
+                        for dataset_id, obs_idx in expected_cell_labels.index.to_series().groupby(
+                            expected_cell_labels.dataset_id
+                        )
+                    },
+                    obs_idx_ranges,
+                )
+
+    @patch("backend.wmg.data.tiledb.consolidation_buffer_size", return_value=64 * MB)
+    def test__create_term_id_codes__reads_obs_one_dataset_at_a_time(self, mock_consolidation_buffer_size):
+        cube_dims = cube_indexed_dims_no_gene_ontology + cube_non_indexed_dims
+        datasets_path = f"{self.tmp_dir}/term_id_codes_datasets"
+        for dataset_name in ("dataset_0", "dataset_1"):
+            anndata_object = create_anndata_test_object(num_genes=1000, num_cells=100)
+            # every cube dimension is labeled, as in the datasets of the portal
+            for dim_name in cube_dims:
+                if dim_name != "dataset_id" and dim_name not in anndata_object.obs:
+                    anndata_object.obs[dim_name] = np.random.choice(
+                        [f"{dim_name}_{dataset_name}", f"{dim_name}_shared"], size=anndata_object.n_obs
+                    )
+            os.makedirs(f"{datasets_path}/{dataset_name}")
+            anndata_object.write(f"{datasets_path}/{dataset_name}/local.h5ad")
+        try:
+            build_integrated_corpus(datasets_path, self.corpus_path)
+            with tiledb.open(f"{self.corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+                obs_df = obs.df[:]
+
+            obs_batches = []
+
+            def extract_obs_data_batches(*args, **kwargs):
+                for obs_batch in extract_obs_data(*args, **kwargs):
+                    obs_batches.append(obs_batch)
+                    yield obs_batch
+
+            with patch(
+                "backend.corpus_asset_pipelines.summary_cubes.term_id_codes.extract_obs_data", extract_obs_data_batches
+            ):
+                term_id_codes = create_term_id_codes(self.corpus_path)
+
+            self.assertEqual(2, len(obs_batches))
+            for obs_batch in obs_batches:
+                self.assertEqual(1, obs_batch.dataset_id.nunique())
+                self.assertLess(len(obs_batch), len(obs_df))
+            for dim_name in cube_dims:
+                self.assertEqual(sorted(obs_df[dim_name].unique().tolist()), term_id_codes.term_ids_by_dim[dim_name])
+        finally:
+            shutil.rmtree(datasets_path)
+
     def test_mapping_between_local_file_and_global_tdb_is_valid_and_consistent_as_datasets_are_added(self):
         """
         DO NOT DELETE THIS TEST
@@ -265,6 +507,39 @@ class TestCorpusLoad(unittest.TestCase):
         # because we replaced the assay type for one cell in the original anndata object
         self.assertEqual(corpus_cell_count, CELL_COUNT - 1)
 
+    def test__pre_concatenation_filter_mask__backed_anndata__matches_scanpy_filters(self):
+        test_anndata_object = create_anndata_test_object(num_genes=1000, num_cells=200)
+        # some cells express fewer genes, and some are generated by assays that are not included
+        test_anndata_object.X[:50] = test_anndata_object.X[:50].multiply(
+            np.random.random(test_anndata_object.X[:50].shape) > 0.6
+        )
+        test_anndata_object.obs["assay_ontology_term_id"].cat.add_categories(["NOT_INCLUDED"], inplace=True)
+        test_anndata_object.obs["assay_ontology_term_id"][::7] = "NOT_INCLUDED"
+        h5ad_path = f"{self.tmp_dir}/filtered_test_dataset.h5ad"
+        test_anndata_object.write(h5ad_path)
+        expected = test_anndata_object.copy()
+        scanpy.pp.filter_cells(expected, min_genes=GENE_EXPRESSION_COUNT_MIN_THRESHOLD)
+        expected = expected[expected.obs["assay_ontology_term_id"] != "NOT_INCLUDED"]
+
+        backed_anndata_object = anndata.read_h5ad(h5ad_path, backed="r")
+        try:
+            mask = compute_pre_concatenation_filter_mask(backed_anndata_object)
+            self.assertLess(0, mask.sum())
+            self.assertEqual(expected.obs_names.tolist(), backed_anndata_object.obs_names[mask].tolist())
+
+            # only the filtered cells are loaded, from the blocks of rows of the backed expression matrix
+            load_dataset(self.corpus_path, backed_anndata_object, "dataset_0", obs_mask=mask)
+        finally:
+            backed_anndata_object.file.close()
+            os.remove(h5ad_path)
+        with tiledb.open(f"{self.corpus_path}/{OBS_ARRAY_NAME}", "r") as obs:
+            obs_df = obs.df[:].sort_values("obs_idx", ignore_index=True)
+        with tiledb.open(f"{self.corpus_path}/{INTEGRATED_ARRAY_NAME}", "r") as integrated:
+            integrated_df = integrated.df[:]
+        self.assertEqual(expected.obs_names.tolist(), obs_df.dataset_local_cell_id.tolist())
+        self.assertEqual(list(range(len(expected))), obs_df.obs_idx.tolist())
+        self.assertEqual(set(range(len(expected))), set(integrated_df.obs_idx))
+
     def test_dataset_validation_checks_correct_expression_matrix(self):
         with self.subTest("Test dataset with sparse X and raw is valid"):
             valid_anndata_object = create_anndata_test_object(num_genes=3, num_cells=5)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_s3
+
+from backend.wmg.data.load_cube import download_artifacts_from_s3
+
+BUCKET_NAME = "test-wmg"
+
+
+@mock_s3
+@patch("backend.wmg.data.load_cube.wmg_bucket_name", BUCKET_NAME)
+@patch("backend.wmg.data.load_cube.stack_name", "/rdev-stack")
+class DownloadArtifactsTest(unittest.TestCase):
+    def setUp(self):
+        # moto does not decode the checksummed (aws-chunked) uploads of recent botocore versions
+        environ = patch.dict(os.environ, {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.snapshot_path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.snapshot_path.cleanup)
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket=BUCKET_NAME)
+        for key in (
+            "corpus/obs/__schema/__1",
+            "corpus/obs/__fragments/__1/a0.tdb",
+            "corpus/obs_other/__schema/__1",
+            "corpus/term_id_codes.json",
+            "corpus/var/__schema/__1",
+        ):
+            self.s3.put_object(Bucket=BUCKET_NAME, Key=f"rdev-stack/1650000000/{key}", Body=key.encode())
+
+    def test__download_artifacts_from_s3__downloads_only_the_given_arrays_and_files(self):
+        download_artifacts_from_s3(self.snapshot_path.name, 1650000000, ["corpus/obs", "corpus/term_id_codes.json"])
+
+        downloaded = {
+            os.path.relpath(os.path.join(directory, filename), self.snapshot_path.name)
+            for directory, _, filenames in os.walk(self.snapshot_path.name)
+            for filename in filenames
+        }
+        self.assertEqual(
+            {"corpus/obs/__schema/__1", "corpus/obs/__fragments/__1/a0.tdb", "corpus/term_id_codes.json"}, downloaded
+        )
+        with open(os.path.join(self.snapshot_path.name, "corpus/obs/__fragments/__1/a0.tdb"), "rb") as f:
+            self.assertEqual(b"corpus/obs/__fragments/__1/a0.tdb", f.read())
@@ -0,0 +1,54 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+from scipy import sparse
+
+from backend.wmg.data.rankit import rankit, reference_rankit
+
+
+class RankitTest(unittest.TestCase):
+    def test__rankit__matches_reference_implementation(self):
+        for dtype in (np.float32, np.float64):
+            with self.subTest(dtype=dtype):
+                X = sparse.random(100, 2000, density=0.2, format="csr", random_state=0, dtype=np.float64)
+                # integral values, as for raw counts, so that rows have ties
+                X.data = (np.round(X.data * 50) + 1).astype(dtype)
+
+                actual = rankit(X)
+                expected = reference_rankit(X)
+
+                self.assertEqual(expected.dtype, actual.dtype)
+                np.testing.assert_array_equal(expected.indptr, actual.indptr)
+                np.testing.assert_array_equal(expected.indices, actual.indices)
+                np.testing.assert_array_equal(expected.data, actual.data)
+
+    def test__rankit__ranks_ties_equally(self):
+        X = sparse.csr_matrix(np.array([[5.0, 0.0, 1.0, 5.0, 3.0], [0.0, 0.0, 2.0, 0.0, 0.0]]))
+
+        actual = rankit(X, offset=0.0)
+
+        row_0 = actual.data[actual.indptr[0] : actual.indptr[1]]
+        self.assertEqual(row_0[0], row_0[2])
+        self.assertLess(row_0[1], row_0[3])
+        self.assertLess(row_0[3], row_0[0])
+        # a single value is ranked at the median of the distribution
+        self.assertEqual([0.0], list(actual.data[actual.indptr[1] : actual.indptr[2]]))
+
+    def test__rankit__empty_rows__are_skipped(self):
+        X = sparse.csr_matrix(np.array([[0.0, 0.0], [1.0, 2.0]]))
+
+        actual = rankit(X)
+
+        self.assertEqual(2, actual.nnz)
+        np.testing.assert_array_equal(reference_rankit(X[1:]).data, actual.data)
+
+    def test__rankit__max_workers__sizes_thread_pool(self):
+        X = sparse.random(3000, 100, density=0.2, format="csr", random_state=0, dtype=np.float64)
+
+        with patch("backend.wmg.data.rankit.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as thread_pool_executor:
+            actual = rankit(X, max_workers=2)
+
+        thread_pool_executor.assert_called_once_with(max_workers=2)
+        np.testing.assert_array_equal(reference_rankit(X).data, actual.data)
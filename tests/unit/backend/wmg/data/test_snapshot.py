@@ -0,0 +1,136 @@
+import importlib.util
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+import backend.wmg.data.snapshot as snapshot_module
+from backend.wmg.data.snapshot import load_snapshot, refresh_snapshot
+
+
+class SnapshotRefreshTest(unittest.TestCase):
+    def setUp(self):
+        snapshot_module.cached_snapshot = None
+        snapshot_module._snapshot_refresher = None
+
+    def tearDown(self):
+        snapshot_module.cached_snapshot = None
+        snapshot_module._snapshot_refresher = None
+
+    @patch("backend.wmg.data.snapshot._start_snapshot_refresher")
+    @patch("backend.wmg.data.snapshot._load_snapshot")
+    @patch("backend.wmg.data.snapshot._read_s3obj")
+    def test__load_snapshot__reads_s3_only_on_first_call(self, read_s3obj, _load_snapshot, start_refresher):
+        read_s3obj.return_value = "snapshot-1"
+        _load_snapshot.return_value = MagicMock(snapshot_identifier="snapshot-1")
+
+        first = load_snapshot()
+        second = load_snapshot()
+
+        self.assertIs(first, second)
+        read_s3obj.assert_called_once()
+        _load_snapshot.assert_called_once_with("snapshot-1")
+        start_refresher.assert_called()
+
+    @patch("backend.wmg.data.snapshot._start_snapshot_refresher")
+    @patch("backend.wmg.data.snapshot._load_snapshot")
+    @patch("backend.wmg.data.snapshot._read_s3obj")
+    def test__load_snapshot__restarts_dead_refresher(self, read_s3obj, _load_snapshot, start_refresher):
+        current_snapshot = MagicMock(snapshot_identifier="snapshot-1")
+        snapshot_module.cached_snapshot = current_snapshot
+        snapshot_module._snapshot_refresher = MagicMock(is_alive=MagicMock(return_value=False))
+
+        self.assertIs(current_snapshot, load_snapshot())
+        start_refresher.assert_called_once()
+        read_s3obj.assert_not_called()
+        _load_snapshot.assert_not_called()
+
+    @unittest.skipUnless(importlib.util.find_spec("gevent"), "requires gevent")
+    def test__start_snapshot_refresher__gevent_patched__refreshes_without_blocking_other_greenlets(self):
+        # gevent must patch before anything else is imported, and cannot be undone, so this runs in a new interpreter
+        script = textwrap.dedent(
+            """
+            from gevent import monkey
+
+            monkey.patch_all()
+
+            import time
+            from unittest.mock import patch
+
+            import gevent
+
+            import backend.wmg.data.snapshot as snapshot_module
+
+            refreshing = []
+
+
+            def refresh_snapshot():
+                refreshing.append(True)
+                # blocks the thread it runs on, as the snapshot load and warm up do
+                monkey.get_original("time", "sleep")(1.5)
+
+
+            with patch.object(snapshot_module, "refresh_snapshot", refresh_snapshot), patch.object(
+                snapshot_module, "WmgConfig"
+            ) as wmg_config:
+                wmg_config.return_value.snapshot_refresh_interval_seconds = 0
+                snapshot_module._start_snapshot_refresher()
+                while not refreshing:
+                    gevent.sleep(0.01)
+                start = time.perf_counter()
+                gevent.sleep(0.1)
+                print(time.perf_counter() - start)
+                assert snapshot_module._snapshot_refresher.is_alive()
+            """
+        )
+
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60)
+
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertLess(float(result.stdout.strip().splitlines()[-1]), 1.0)
+
+    @patch("backend.wmg.data.snapshot.WmgConfig")
+    @patch("backend.wmg.data.snapshot._refresh_snapshot_periodically")
+    def test__start_snapshot_refresher__refresher_stopped__is_not_alive(self, refresh_periodically, wmg_config):
+        stopped = threading.Event()
+        refresh_periodically.side_effect = lambda *args: stopped.set()
+        wmg_config.return_value.snapshot_refresh_interval_seconds = "60"
+
+        snapshot_module._start_snapshot_refresher()
+
+        self.assertTrue(stopped.wait(timeout=5))
+        refresh_periodically.assert_called_once_with(60, time.sleep)
+        for _ in range(100):
+            if not snapshot_module._snapshot_refresher.is_alive():
+                break
+            time.sleep(0.01)
+        self.assertFalse(snapshot_module._snapshot_refresher.is_alive())
+
+    @patch("backend.wmg.data.snapshot._warm_snapshot")
+    @patch("backend.wmg.data.snapshot._load_snapshot")
+    @patch("backend.wmg.data.snapshot._read_s3obj")
+    def test__refresh_snapshot__swaps_in_warmed_snapshot_when_updated(self, read_s3obj, _load_snapshot, warm_snapshot):
+        snapshot_module.cached_snapshot = MagicMock(snapshot_identifier="snapshot-1")
+        new_snapshot = MagicMock(snapshot_identifier="snapshot-2")
+        read_s3obj.return_value = "snapshot-2"
+        _load_snapshot.return_value = new_snapshot
+
+        self.assertTrue(refresh_snapshot())
+        warm_snapshot.assert_called_once_with(new_snapshot)
+        self.assertIs(new_snapshot, snapshot_module.cached_snapshot)
+
+    @patch("backend.wmg.data.snapshot._warm_snapshot")
+    @patch("backend.wmg.data.snapshot._load_snapshot")
+    @patch("backend.wmg.data.snapshot._read_s3obj")
+    def test__refresh_snapshot__keeps_snapshot_when_not_updated(self, read_s3obj, _load_snapshot, warm_snapshot):
+        current_snapshot = MagicMock(snapshot_identifier="snapshot-1")
+        snapshot_module.cached_snapshot = current_snapshot
+        read_s3obj.return_value = "snapshot-1"
+
+        self.assertFalse(refresh_snapshot())
+        _load_snapshot.assert_not_called()
+        warm_snapshot.assert_not_called()
+        self.assertIs(current_snapshot, snapshot_module.cached_snapshot)
@@ -0,0 +1,143 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from pandas import DataFrame
+
+from backend.corpora.common.utils.math_utils import MB
+from backend.wmg.data.schemas.cube_schema import filter_dimensions_index_dims
+from backend.wmg.data.snapshot import (
+    FILTER_DIMENSIONS_INDEX_FILENAME,
+    _map_filter_dimensions_index_array,
+    _write_filter_dimensions_index_array,
+)
+from backend.wmg.data.snapshot_mirror import mirror_snapshot
+from backend.wmg.data.tiledb import api_worker_count, tile_cache_size
+
+
+def write_artifact(snapshot_identifier: str, local_dir: str) -> None:
+    with open(os.path.join(local_dir, "artifact.json"), "w") as f:
+        f.write(snapshot_identifier)
+
+
+class MirrorSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.mirror_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.mirror_dir.cleanup()
+
+    def test__mirror_snapshot__downloads_snapshot_once(self):
+        download_fn = MagicMock(side_effect=write_artifact)
+        prepare_fn = MagicMock()
+
+        first, first_lock = mirror_snapshot("snapshot-1", self.mirror_dir.name, download_fn, prepare_fn)
+        second, second_lock = mirror_snapshot("snapshot-1", self.mirror_dir.name, download_fn, prepare_fn)
+
+        self.assertEqual(first, second)
+        with open(os.path.join(first, "artifact.json")) as f:
+            self.assertEqual("snapshot-1", f.read())
+        download_fn.assert_called_once()
+        prepare_fn.assert_called_once()
+        first_lock.close()
+        second_lock.close()
+
+    def test__mirror_snapshot__removes_snapshots_no_longer_in_use(self):
+        _, snapshot_0_lock = mirror_snapshot("snapshot-0", self.mirror_dir.name, write_artifact)
+        _, snapshot_1_lock = mirror_snapshot("snapshot-1", self.mirror_dir.name, write_artifact)
+        # another process is still serving snapshot-0, after all of the processes moved on from snapshot-1
+        snapshot_1_lock.close()
+        _, snapshot_2_lock = mirror_snapshot("snapshot-2", self.mirror_dir.name, write_artifact)
+
+        self.assertEqual(["snapshot-0", "snapshot-2"], self.list_snapshots())
+
+        snapshot_0_lock.close()
+        _, snapshot_3_lock = mirror_snapshot("snapshot-3", self.mirror_dir.name, write_artifact)
+
+        self.assertEqual(["snapshot-2", "snapshot-3"], self.list_snapshots())
+        snapshot_2_lock.close()
+        snapshot_3_lock.close()
+
+    def test__mirror_snapshot__snapshot_locked_by_another_process__is_not_removed(self):
+        _, snapshot_0_lock = mirror_snapshot("snapshot-0", self.mirror_dir.name, write_artifact)
+        snapshot_0_lock.close()
+        # held by another process, as by another worker of the API server
+        script = textwrap.dedent(
+            f"""
+            import sys
+
+            from backend.wmg.data.snapshot_mirror import mirror_snapshot
+
+            _, snapshot_lock = mirror_snapshot("snapshot-0", {self.mirror_dir.name!r}, None)
+            print("locked", flush=True)
+            sys.stdin.read()
+            """
+        )
+        other_process = subprocess.Popen(
+            [sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        try:
+            self.assertEqual("locked", other_process.stdout.readline().strip())
+
+            _, snapshot_1_lock = mirror_snapshot("snapshot-1", self.mirror_dir.name, write_artifact)
+
+            self.assertEqual(["snapshot-0", "snapshot-1"], self.list_snapshots())
+        finally:
+            other_process.communicate(timeout=30)
+        mirror_snapshot("snapshot-1", self.mirror_dir.name, write_artifact)[1].close()
+
+        self.assertEqual(["snapshot-1"], self.list_snapshots())
+        snapshot_1_lock.close()
+
+    def test__mirror_snapshot__failed_download__leaves_no_snapshot(self):
+        download_fn = MagicMock(side_effect=IOError("download failed"))
+
+        with self.assertRaises(IOError):
+            mirror_snapshot("snapshot-1", self.mirror_dir.name, download_fn)
+
+        self.assertEqual([".lock"], os.listdir(self.mirror_dir.name))
+
+    def list_snapshots(self):
+        return sorted(name for name in os.listdir(self.mirror_dir.name) if not name.startswith("."))
+
+    def test__filter_dimensions_index_array__is_memory_mapped(self):
+        n_rows = 5
+        filter_dimensions_index = DataFrame(
+            {
+                dim_name: np.arange(n_rows, dtype=np.uint32) + i
+                for i, dim_name in enumerate(filter_dimensions_index_dims)
+            }
+        )
+        filter_dimensions_index.to_json(
+            os.path.join(self.mirror_dir.name, FILTER_DIMENSIONS_INDEX_FILENAME), orient="split", index=False
+        )
+
+        _write_filter_dimensions_index_array(self.mirror_dir.name)
+        mapped_filter_dimensions_index = _map_filter_dimensions_index_array(self.mirror_dir.name)
+
+        self.assertTrue((filter_dimensions_index.values == mapped_filter_dimensions_index.values).all())
+        # backed by the read-only memory map, rather than by a private copy
+        self.assertFalse(mapped_filter_dimensions_index[filter_dimensions_index_dims[0]].values.flags.writeable)
+
+
+class TileCacheSizeTest(unittest.TestCase):
+    @patch("backend.wmg.data.tiledb.virtual_memory_size", return_value=1000 * MB)
+    def test__tile_cache_size__is_split_across_workers(self, virtual_memory_size):
+        with patch("backend.wmg.data.tiledb.api_worker_count", return_value=3):
+            self.assertEqual(333 * MB, tile_cache_size(0.5))
+        with patch("backend.wmg.data.tiledb.api_worker_count", return_value=1):
+            self.assertEqual(1000 * MB, tile_cache_size(0.5))
+
+    @patch.dict(os.environ, {"WEB_CONCURRENCY": "3"})
+    def test__api_worker_count__reads_web_concurrency(self):
+        self.assertEqual(3, api_worker_count())
+
+    def test__api_worker_count__not_configured__returns_1(self):
+        with patch.dict(os.environ):
+            os.environ.pop("WEB_CONCURRENCY", None)
+            self.assertEqual(1, api_worker_count())
@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from backend.wmg.data.term_id_codes import TermIdCodes
+
+
+class TermIdCodesTest(unittest.TestCase):
+    def setUp(self):
+        self.term_id_codes = TermIdCodes(
+            {
+                "tissue_ontology_term_id": ["UBERON:0000178", "UBERON:0002048"],
+                "dataset_id": ["dataset_id_0", "dataset_id_1", "dataset_id_2"],
+            }
+        )
+
+    def test__encode_array_and_decode__round_trips(self):
+        term_ids = ["dataset_id_2", "dataset_id_0", "dataset_id_2"]
+
+        codes = self.term_id_codes.encode_array("dataset_id", term_ids)
+
+        self.assertEqual(np.uint32, codes.dtype)
+        self.assertEqual([2, 0, 2], codes.tolist())
+        self.assertEqual(term_ids, self.term_id_codes.decode("dataset_id", codes).tolist())
+
+    def test__decode_df__decodes_only_encoded_columns(self):
+        df = pd.DataFrame(
+            {
+                "tissue_ontology_term_id": np.array([1, 0], dtype=np.uint32),
+                "dataset_id": np.array([0, 2], dtype=np.uint32),
+                "n_cells": np.array([1, 2], dtype=np.uint32),
+            }
+        )
+
+        decoded = self.term_id_codes.decode_df(df)
+
+        self.assertEqual(["UBERON:0002048", "UBERON:0000178"], decoded.tissue_ontology_term_id.tolist())
+        self.assertEqual(["dataset_id_0", "dataset_id_2"], decoded.dataset_id.tolist())
+        self.assertEqual([1, 2], decoded.n_cells.tolist())
+
+    def test__decode_df__empty_df(self):
+        df = pd.DataFrame({"dataset_id": np.array([], dtype=np.uint32)})
+
+        self.assertTrue(self.term_id_codes.decode_df(df).empty)
+
+    def test__json__round_trips(self):
+        term_id_codes = TermIdCodes.from_json(self.term_id_codes.to_json())
+
+        self.assertEqual(self.term_id_codes.term_ids_by_dim, term_id_codes.term_ids_by_dim)
+
+    def test__encode_array__ascii_bytes_term_ids(self):
+        term_id_codes = TermIdCodes({"dataset_id": [b"dataset_id_0", b"dataset_id_1"]})
+
+        self.assertEqual(["dataset_id_0", "dataset_id_1"], term_id_codes.term_ids_by_dim["dataset_id"])
+        self.assertEqual([1, 0], term_id_codes.encode_array("dataset_id", [b"dataset_id_1", "dataset_id_0"]).tolist())
@@ -1,3 +1,13 @@
+import json
+import tempfile
+from unittest.mock import patch
+
+import pandas as pd
+
+from backend.wmg.data.snapshot import PRIMARY_FILTER_DIMENSIONS_FILENAME
+from backend.wmg.data.transform import extract_organism_gene_ids, generate_primary_filter_dimensions
+
+
 def test_get_cells_by_tissue_type_performs_correctly_on_known_data():
     pass
 
@@ -6,5 +16,51 @@ def test_generate_cell_ordering_returns_cells_in_correct_order_for_all_tissues()
     pass
 
 
+@patch("backend.wmg.data.ontology_labels.ontology_term_label", new=lambda term_id: f"{term_id}_label")
+@patch("backend.wmg.data.ontology_labels.gene_term_label", new=lambda gene_id: f"{gene_id}_label")
 def test__generate_primary_filter_dimensions():
-    pass
+    cell_counts_term_ids = pd.DataFrame(
+        {
+            "organism_ontology_term_id": ["NCBITaxon:9606", "NCBITaxon:9606", "NCBITaxon:10090"],
+            "tissue_ontology_term_id": ["UBERON:0002048", "UBERON:0000178", "UBERON:0002048"],
+            "cell_type_ontology_term_id": ["CL:0000003", "CL:0000003", "CL:0000003"],
+        }
+    )
+    organism_gene_ids = {"NCBITaxon:10090": ["ENSMUSG00000000001"], "NCBITaxon:9606": ["ENSG1", "ENSG2"]}
+
+    with tempfile.TemporaryDirectory() as snapshot_path:
+        generate_primary_filter_dimensions(snapshot_path, 1, cell_counts_term_ids, organism_gene_ids)
+        with open(f"{snapshot_path}/{PRIMARY_FILTER_DIMENSIONS_FILENAME}") as f:
+            primary_filter_dimensions = json.load(f)
+
+    assert primary_filter_dimensions == dict(
+        snapshot_id="1",
+        organism_terms=[{"NCBITaxon:10090": "NCBITaxon:10090_label"}, {"NCBITaxon:9606": "NCBITaxon:9606_label"}],
+        tissue_terms={
+            "NCBITaxon:10090": [{"UBERON:0002048": "UBERON:0002048_label"}],
+            "NCBITaxon:9606": [
+                {"UBERON:0000178": "UBERON:0000178_label"},
+                {"UBERON:0002048": "UBERON:0002048_label"},
+            ],
+        },
+        gene_terms={
+            "NCBITaxon:10090": [{"ENSMUSG00000000001": "ENSMUSG00000000001_label"}],
+            "NCBITaxon:9606": [{"ENSG1": "ENSG1_label"}, {"ENSG2": "ENSG2_label"}],
+        },
+    )
+
+
+@patch("backend.wmg.data.transform.extract_partial_gene_ids_by_organism")
+@patch("backend.wmg.data.transform.list_partials", return_value=["dataset_0", "dataset_1"])
+@patch("backend.wmg.data.transform.get_all_dataset_ids", return_value=["dataset_0", "dataset_1", "dataset_2"])
+def test__extract_organism_gene_ids__sorts_the_gene_ids_of_each_organism(_, __, extract_partial_gene_ids):
+    # the genes of each partial are in gene code (var_idx) order, while the primary filter dimensions list them sorted
+    extract_partial_gene_ids.side_effect = lambda corpus_path, dataset_id: {
+        "dataset_0": {"NCBITaxon:9606": ["ENSG3", "ENSG1"]},
+        "dataset_1": {"NCBITaxon:9606": ["ENSG2", "ENSG1"], "NCBITaxon:10090": ["ENSMUSG1"]},
+    }[dataset_id]
+
+    organism_gene_ids = extract_organism_gene_ids("corpus")
+
+    assert organism_gene_ids == {"NCBITaxon:10090": ["ENSMUSG1"], "NCBITaxon:9606": ["ENSG1", "ENSG2", "ENSG3"]}
+    assert list(organism_gene_ids) == ["NCBITaxon:10090", "NCBITaxon:9606"]
@@ -2,9 +2,9 @@ import contextlib
 import os
 import sys
 import tempfile
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from itertools import filterfalse, cycle, islice
-from typing import List, Callable, Tuple, Dict, NamedTuple
+from typing import List, Callable, Tuple, Dict, NamedTuple, Iterable
 
 import numpy as np
 import pandas as pd
@@ -15,6 +15,7 @@ from pandas import DataFrame
 from backend.corpora.common.corpora_orm import DbDataset, CollectionVisibility, DbCollection
 from backend.corpora.common.entities import Collection
 from backend.corpora.common.utils.db_session import db_session_manager
+from backend.corpus_asset_pipelines.summary_cubes import filter_dimensions_index
 from backend.wmg.data.schemas.cube_schema import (
     cube_indexed_dims,
     cube_logical_attrs,
@@ -25,7 +26,8 @@ from backend.wmg.data.schemas.cube_schema import (
     cell_counts_indexed_dims,
     cell_counts_logical_dims,
 )
-from backend.wmg.data.snapshot import WmgSnapshot, CELL_TYPE_ORDERINGS_FILENAME
+from backend.wmg.data.snapshot import WmgSnapshot, CELL_TYPE_ORDERINGS_FILENAME, TERM_ID_CODES_FILENAME
+from backend.wmg.data.term_id_codes import TermIdCodes
 from backend.wmg.data.tiledb import create_ctx
 from tests.unit.backend.wmg.fixtures.test_primary_filters import build_precomputed_primary_filters
 
@@ -142,7 +144,7 @@ def create_temp_wmg_snapshot(
     cell_ordering_generator_fn: Callable[[List[str]], List[int]] = forward_cell_type_ordering,
 ) -> WmgSnapshot:
     with tempfile.TemporaryDirectory() as cube_dir:
-        expression_summary_cube_dir, cell_counts_cube_dir = create_cubes(
+        expression_summary_cube_dir, cell_counts_cube_dir, term_id_codes = create_cubes(
             cube_dir,
             dim_size,
             exclude_logical_coord_fn=exclude_logical_coord_fn,
@@ -150,8 +152,9 @@ def create_temp_wmg_snapshot(
             cell_counts_fn=cell_counts_generator_fn,
         )
 
-        cell_type_orderings = build_cell_orderings(cell_counts_cube_dir, cell_ordering_generator_fn)
+        cell_type_orderings = build_cell_orderings(cell_counts_cube_dir, term_id_codes, cell_ordering_generator_fn)
         primary_filter_dimensions = build_precomputed_primary_filters()
+        filter_dimensions_index_df = filter_dimensions_index.transform(filter_dimensions_index.extract(cube_dir))
 
         with tiledb.open(expression_summary_cube_dir, ctx=create_ctx()) as expression_summary_cube:
             with tiledb.open(cell_counts_cube_dir, ctx=create_ctx()) as cell_counts_cube:
@@ -161,16 +164,21 @@ def create_temp_wmg_snapshot(
                     cell_counts_cube=cell_counts_cube,
                     cell_type_orderings=cell_type_orderings,
                     primary_filter_dimensions=primary_filter_dimensions,
+                    term_id_codes=term_id_codes,
+                    filter_dimensions_index=filter_dimensions_index_df,
                 )
 
 
-def build_cell_orderings(cell_counts_cube_dir_, cell_ordering_generator_fn) -> DataFrame:
+def build_cell_orderings(cell_counts_cube_dir_, term_id_codes: TermIdCodes, cell_ordering_generator_fn) -> DataFrame:
     cell_type_orderings = []
     with tiledb.open(cell_counts_cube_dir_, ctx=create_ctx()) as cell_counts_cube:
-        tissue_ontology_term_ids = cell_counts_cube.df[:]["tissue_ontology_term_id"].unique()
+        cell_counts = term_id_codes.decode_df(cell_counts_cube.df[:])
+        tissue_ontology_term_ids = cell_counts["tissue_ontology_term_id"].unique()
         for tissue_ontology_term_id in tissue_ontology_term_ids:
             cell_type_ontology_term_ids = sorted(
-                cell_counts_cube.df[tissue_ontology_term_id]["cell_type_ontology_term_id"].unique()
+                cell_counts[cell_counts["tissue_ontology_term_id"] == tissue_ontology_term_id][
+                    "cell_type_ontology_term_id"
+                ].unique()
             )
             ordering = cell_ordering_generator_fn(cell_type_ontology_term_ids)
             cell_type_orderings.append(
@@ -215,24 +223,51 @@ def create_cubes(
     exclude_logical_coord_fn: Callable[[List[str], Tuple], bool] = None,
     expression_summary_vals_fn: Callable[[List[Tuple]], Dict[str, List]] = random_expression_summary_values,
     cell_counts_fn: Callable[[List[Tuple]], List[int]] = random_cell_counts_values,
-) -> Tuple[str, str]:
-    coords, dim_values = build_coords(
+) -> Tuple[str, str, TermIdCodes]:
+    expression_summary_coords, expression_summary_dim_values = build_coords(
         cube_logical_dims, dim_size, dim_ontology_term_ids_generator_fn, exclude_logical_coord_fn
     )
-    expression_summary_cube_dir = create_expression_summary_cube(
-        data_dir, coords, dim_values, expression_summary_vals_fn=expression_summary_vals_fn
+    cell_counts_coords, cell_counts_dim_values = build_coords(
+        cell_counts_logical_dims, dim_size, dim_ontology_term_ids_generator_fn, exclude_logical_coord_fn
+    )
+    term_id_codes = build_term_id_codes(
+        [
+            zip(cube_logical_dims, expression_summary_dim_values),
+            zip(cell_counts_logical_dims, cell_counts_dim_values),
+        ]
     )
 
-    coords, dim_values = build_coords(
-        cell_counts_logical_dims, dim_size, dim_ontology_term_ids_generator_fn, exclude_logical_coord_fn
+    expression_summary_cube_dir = create_expression_summary_cube(
+        data_dir,
+        expression_summary_coords,
+        expression_summary_dim_values,
+        term_id_codes,
+        expression_summary_vals_fn=expression_summary_vals_fn,
+    )
+    cell_counts_cube_dir = create_cell_counts_cube(
+        data_dir, cell_counts_coords, cell_counts_dim_values, term_id_codes, cell_counts_fn=cell_counts_fn
     )
-    cell_counts_cube_dir = create_cell_counts_cube(data_dir, coords, dim_values, cell_counts_fn=cell_counts_fn)
 
-    return expression_summary_cube_dir, cell_counts_cube_dir
+    return expression_summary_cube_dir, cell_counts_cube_dir, term_id_codes
+
 
+def build_term_id_codes(logical_dims_values: List[Iterable[Tuple[str, List[str]]]]) -> TermIdCodes:
+    term_ids_by_dim: Dict[str, set] = defaultdict(set)
+    for dims_values in logical_dims_values:
+        for dim_name, values in dims_values:
+            term_ids_by_dim[dim_name].update(values)
+    return TermIdCodes({dim_name: sorted(term_ids) for dim_name, term_ids in term_ids_by_dim.items()})
 
-def create_cell_counts_cube(data_dir, coords, dim_values, cell_counts_fn: Callable[[List[Tuple]], List[int]]) -> str:
+
+def encode_dim_values(logical_dims: List[str], dim_values: List[List], term_id_codes: TermIdCodes) -> List[np.ndarray]:
+    return [term_id_codes.encode_array(logical_dims[i], dim_values[i]) for i in range(len(logical_dims))]
+
+
+def create_cell_counts_cube(
+    data_dir, coords, dim_values, term_id_codes: TermIdCodes, cell_counts_fn: Callable[[List[Tuple]], List[int]]
+) -> str:
     cube_dir = f"{data_dir}/cell_counts"
+    dim_values = encode_dim_values(cell_counts_logical_dims, dim_values, term_id_codes)
     tiledb.Array.create(cube_dir, cell_counts_schema, overwrite=True)
 
     with tiledb.open(cube_dir, mode="w") as cube:
@@ -255,9 +290,11 @@ def create_expression_summary_cube(
     data_dir,
     coords,
     dim_values,
+    term_id_codes: TermIdCodes,
     expression_summary_vals_fn: Callable[[List[tuple]], Dict[str, List]] = random_expression_summary_values,
 ) -> str:
     cube_dir = f"{data_dir}/expression_summary"
+    dim_values = encode_dim_values(cube_logical_dims, dim_values, term_id_codes)
     tiledb.Array.create(cube_dir, expression_summary_schema, overwrite=True)
 
     with tiledb.open(cube_dir, mode="w") as cube:
@@ -309,7 +346,7 @@ if __name__ == "__main__":
     output_cube_dir = sys.argv[1]
     if not os.path.isdir(output_cube_dir):
         sys.exit(f"invalid dir {output_cube_dir} for cube")
-    _, cell_counts_cube_dir = create_cubes(
+    _, cell_counts_cube_dir, term_id_codes = create_cubes(
         output_cube_dir,
         dim_size=4,
         dim_ontology_term_ids_generator_fn=semi_real_dimension_values_generator,
@@ -317,5 +354,12 @@ if __name__ == "__main__":
         expression_summary_vals_fn=random_expression_summary_values,
         cell_counts_fn=random_cell_counts_values,
     )
-    cell_counts_df = build_cell_orderings(cell_counts_cube_dir, cell_ordering_generator_fn=forward_cell_type_ordering)
+    cell_counts_df = build_cell_orderings(
+        cell_counts_cube_dir, term_id_codes, cell_ordering_generator_fn=forward_cell_type_ordering
+    )
     cell_counts_df.to_json(os.path.join(output_cube_dir, CELL_TYPE_ORDERINGS_FILENAME), orient="records")
+    with open(os.path.join(output_cube_dir, TERM_ID_CODES_FILENAME), "w") as f:
+        f.write(term_id_codes.to_json())
+    filter_dimensions_index.load(
+        output_cube_dir, filter_dimensions_index.transform(filter_dimensions_index.extract(output_cube_dir))
+    )
@@ -1,14 +1,15 @@
 import unittest
-from typing import NamedTuple
 
 from backend.wmg.api.v1 import get_dot_plot_data, agg_cell_type_counts, agg_tissue_counts
-from backend.wmg.data.query import WmgQueryCriteria, WmgQuery
-from backend.wmg.data.schemas.cube_schema import cube_non_indexed_dims
+from backend.wmg.data.query import WmgQueryCriteria, WmgQuery, build_attr_query_cond_expr, encode_criteria
+from backend.wmg.data.schemas.cube_schema import cube_non_indexed_dims, cube_indexed_dims
+from backend.wmg.data.term_id_codes import TermIdCodes, NO_MATCH_CODE
 from tests.unit.backend.wmg.fixtures.test_snapshot import (
     create_temp_wmg_snapshot,
     all_ones_expression_summary_values,
     all_tens_cell_counts_values,
     all_X_cell_counts_values,
+    exclude_dev_stage_and_ethnicity_for_secondary_filter_test,
 )
 
 
@@ -554,36 +555,85 @@ class QueryTest(unittest.TestCase):
         )
 
 
-class QueryPrimaryFilterDimensionsTest(unittest.TestCase):
-    def test__single_dimension__returns_all_dimension_and_terms(self):
-        dim_size = 3
-        with create_temp_wmg_snapshot(dim_size=dim_size) as snapshot:
-            result = WmgQuery(snapshot).list_primary_filter_dimension_term_ids("gene_ontology_term_id")
-            self.assertEquals(["gene_ontology_term_id_0", "gene_ontology_term_id_1", "gene_ontology_term_id_2"], result)
+class QueryConditionTest(unittest.TestCase):
+    def setUp(self):
+        self.term_id_codes = TermIdCodes(
+            {
+                "gene_ontology_term_id": ["gene_ontology_term_id_0"],
+                "organism_ontology_term_id": ["organism_ontology_term_id_0"],
+                "tissue_ontology_term_id": ["tissue_ontology_term_id_0"],
+                "dataset_id": ["dataset_id_0", "dataset_id_1"],
+                "sex_ontology_term_id": ["sex_ontology_term_id_0", "sex_ontology_term_id_1", "sex_ontology_term_id_2"],
+            }
+        )
 
-    def test__multiple_dimensions__returns_all_dimensions_and_terms_as_tuples(self):
-        dim_size = 3
+    def test__no_attr_criteria__returns_empty_expression(self):
+        criteria = WmgQueryCriteria(
+            gene_ontology_term_ids=["gene_ontology_term_id_0"],
+            organism_ontology_term_id="organism_ontology_term_id_0",
+            tissue_ontology_term_ids=["tissue_ontology_term_id_0"],
+        )
 
-        def exclude_one_gene_per_organism(logical_coord: NamedTuple) -> bool:
-            # HACK: method called during building of both "expr summary" and "cell count" cubes, but the latter does not
-            # include gene_ontology_term_id
-            if "gene_ontology_term_id" not in logical_coord._fields:
-                return False
-            return logical_coord.gene_ontology_term_id == logical_coord.organism_ontology_term_id.replace(
-                "organism", "gene"
-            )
+        encoded_criteria = encode_criteria(criteria, self.term_id_codes)
+
+        self.assertEqual("", build_attr_query_cond_expr(encoded_criteria, cube_indexed_dims))
+
+    def test__single_and_multi_valued_attr_criteria__pushes_down_equality_and_range_conditions(self):
+        criteria = WmgQueryCriteria(
+            gene_ontology_term_ids=["gene_ontology_term_id_0"],
+            organism_ontology_term_id="organism_ontology_term_id_0",
+            tissue_ontology_term_ids=["tissue_ontology_term_id_0"],
+            dataset_ids=["dataset_id_1"],
+            sex_ontology_term_ids=["sex_ontology_term_id_2", "sex_ontology_term_id_0"],
+        )
 
+        encoded_criteria = encode_criteria(criteria, self.term_id_codes)
+
+        self.assertEqual(
+            "dataset_id == 1 and sex_ontology_term_id >= 0 and sex_ontology_term_id <= 2",
+            build_attr_query_cond_expr(encoded_criteria, cube_indexed_dims),
+        )
+
+    def test__unknown_term_ids__encoded_as_no_match_code(self):
+        criteria = WmgQueryCriteria(
+            gene_ontology_term_ids=["gene_ontology_term_id_0", "unknown_gene"],
+            organism_ontology_term_id="unknown_organism",
+            tissue_ontology_term_ids=["tissue_ontology_term_id_0"],
+            dataset_ids=["unknown_dataset"],
+        )
+
+        encoded_criteria = encode_criteria(criteria, self.term_id_codes)
+
+        self.assertEqual([0], encoded_criteria["gene_ontology_term_id"])
+        self.assertEqual([NO_MATCH_CODE], encoded_criteria["organism_ontology_term_id"])
+        self.assertEqual([NO_MATCH_CODE], encoded_criteria["dataset_id"])
+        self.assertEqual([], encoded_criteria["sex_ontology_term_id"])
+
+
+class QueryFilterDimensionsTest(unittest.TestCase):
+    def test__secondary_dims__restricted_by_criteria_of_other_dims_only(self):
+        dim_size = 3
         with create_temp_wmg_snapshot(
-            dim_size=dim_size, exclude_logical_coord_fn=exclude_one_gene_per_organism
+            dim_size=dim_size, exclude_logical_coord_fn=exclude_dev_stage_and_ethnicity_for_secondary_filter_test
         ) as snapshot:
-            result = WmgQuery(snapshot).list_grouped_primary_filter_dimensions_term_ids(
-                "gene_ontology_term_id", "organism_ontology_term_id"
+            criteria = WmgQueryCriteria(
+                gene_ontology_term_ids=["gene_ontology_term_id_0"],
+                organism_ontology_term_id="organism_ontology_term_id_0",
+                tissue_ontology_term_ids=["tissue_ontology_term_id_0"],
+                development_stage_ontology_term_ids=["development_stage_ontology_term_id_1"],
             )
-            self.assertEquals(
-                {
-                    "organism_ontology_term_id_0": ["gene_ontology_term_id_1", "gene_ontology_term_id_2"],
-                    "organism_ontology_term_id_1": ["gene_ontology_term_id_0", "gene_ontology_term_id_2"],
-                    "organism_ontology_term_id_2": ["gene_ontology_term_id_0", "gene_ontology_term_id_1"],
-                },
-                result,
+
+            result = WmgQuery(snapshot).list_filter_dimension_term_ids(
+                criteria, ["dataset_id", "development_stage_ontology_term_id", "ethnicity_ontology_term_id"]
             )
+
+        expected = {
+            "dataset_id": ["dataset_id_0", "dataset_id_1", "dataset_id_2"],
+            "development_stage_ontology_term_id": [
+                "development_stage_ontology_term_id_0",
+                "development_stage_ontology_term_id_1",
+                "development_stage_ontology_term_id_2",
+            ],
+            "ethnicity_ontology_term_id": ["ethnicity_ontology_term_id_0"],
+        }
+        self.assertEqual(expected, result)